@@ -0,0 +1,50 @@
+import argparse
+import os, sys
+import statistics
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from insurance.predictor import ModelResolver
+from insurance.bundle import load_bundle
+from insurance.utils import load_object
+
+
+def load_separate_files(model_resolver:ModelResolver):
+    #what batch prediction did before bundles : one dill file per object
+    load_object(file_path=model_resolver.get_latest_transformer_path())
+    load_object(file_path=model_resolver.get_latest_model_path())
+    load_object(file_path=model_resolver.get_latest_target_encoder_path())
+
+
+def measure_load_time(load, runs:int)->list:
+    #one untimed load first so imports of sklearn and friends are not counted
+    load()
+    samples = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        load()
+        samples.append(time.perf_counter() - start_time)
+    return samples
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare load time of the model bundle with the separate dill files")
+    parser.add_argument("--model-registry", default="saved_models")
+    parser.add_argument("--runs", type=int, default=50)
+    args = parser.parse_args()
+
+    model_resolver = ModelResolver(model_registry=args.model_registry)
+    bundle_path = model_resolver.get_latest_bundle_path()
+    if bundle_path is None:
+        raise SystemExit(f"Latest version of {args.model_registry} has no model bundle, push a model first")
+
+    loads = {"dill files": lambda: load_separate_files(model_resolver),
+             "bundle": lambda: load_bundle(file_path=bundle_path),
+             "bundle mmap": lambda: load_bundle(file_path=bundle_path, use_mmap=True),
+             "bundle unverified": lambda: load_bundle(file_path=bundle_path, verify=False)}
+    print(f"loading version {model_resolver.get_latest_version()} of {args.model_registry} over {args.runs} runs")
+    for name, load in loads.items():
+        samples = measure_load_time(load, runs=args.runs)
+        print(f"{name:<18} min : {min(samples)*1000:.2f} ms, median : {statistics.median(samples)*1000:.2f} ms, max : {max(samples)*1000:.2f} ms")
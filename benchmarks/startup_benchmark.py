@@ -0,0 +1,38 @@
+import argparse
+import os, sys
+import statistics
+import subprocess
+
+#every sample runs in a fresh interpreter so it measures a cold import, like a short lived batch container
+MEASURE_SCRIPT = """
+import sys, time
+start_time = time.perf_counter()
+import {module}
+elapsed_time = time.perf_counter() - start_time
+heavy_modules = [name for name in ("pymongo", "scipy", "sklearn") if name in sys.modules]
+print(elapsed_time, ",".join(heavy_modules))
+"""
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure_import_time(module:str, runs:int)->tuple:
+    samples = []
+    heavy_modules = ""
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", MEASURE_SCRIPT.format(module=module)], cwd=ROOT_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip().splitlines()[-1]
+        elapsed_time, _, heavy_modules = output.partition(" ")
+        samples.append(float(elapsed_time))
+    return samples, heavy_modules
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure cold import time of an insurance module")
+    parser.add_argument("--module", default="insurance.pipeline.batch_prediction")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    samples, heavy_modules = measure_import_time(module=args.module, runs=args.runs)
+    print(f"import {args.module} over {args.runs} runs")
+    print(f"min : {min(samples)*1000:.1f} ms, median : {statistics.median(samples)*1000:.1f} ms, max : {max(samples)*1000:.1f} ms")
+    print(f"heavy modules loaded : {heavy_modules or 'none'}")
@@ -0,0 +1,151 @@
+import os, sys
+import queue
+import shutil
+import threading
+import numpy as np
+import pandas as pd
+from insurance.logger import logging
+from insurance.exception import InsuranceException
+from insurance import utils
+
+
+def write_atomically(file_path:str, write):
+    #write gets a temporary path next to the artifact which is renamed into place once complete, a failed or
+    #interrupted write never leaves a truncated artifact that a stage cache entry could point to
+    tmp_path = f"{file_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    try:
+        write(tmp_path)
+        if os.path.isdir(tmp_path) and os.path.isdir(file_path):
+            #columnar dataframes are directories, which os.replace can not swap over an existing one
+            shutil.rmtree(file_path)
+        os.replace(tmp_path, file_path)
+    except Exception:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class ArtifactStore:
+    #stages of one run hand objects to each other through this process wide cache, keyed by the artifact path,
+    #while a background thread writes them to that path. Files stay the record for later runs and auditing.
+    #Readers in other processes only see a file after flush.
+    def __init__(self, enabled:bool=True):
+        self.enabled = enabled
+        self.objects = dict()
+        self.lock = threading.Lock()
+        self.write_errors = []
+        self.write_queue = None
+        self.writer_pid = None
+
+    def start_writer(self):
+        #a forked child inherits the queue but not the writer thread, it gets its own
+        if self.writer_pid != os.getpid():
+            self.write_queue = queue.Queue()
+            self.write_errors = []
+            self.writer_pid = os.getpid()
+            threading.Thread(target=self.write_loop, args=(self.write_queue,), daemon=True).start()
+
+    def write_loop(self, write_queue:queue.Queue):
+        while True:
+            file_path, write = write_queue.get()
+            try:
+                write()
+            except Exception as e:
+                logging.info(f"Writing artifact {file_path} failed : {e}")
+                self.write_errors.append(e)
+            finally:
+                write_queue.task_done()
+
+    def put(self, file_path:str, obj, write):
+        #write(path) writes obj to the given path, it is called with a temporary path
+        try:
+            if not self.enabled:
+                write_atomically(file_path=file_path, write=write)
+                return
+            with self.lock:
+                self.objects[os.path.abspath(file_path)] = obj
+                self.start_writer()
+                self.write_queue.put((file_path, lambda: write_atomically(file_path=file_path, write=write)))
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def get(self, file_path:str):
+        with self.lock:
+            return self.objects.get(os.path.abspath(file_path))
+
+    def flush(self):
+        try:
+            with self.lock:
+                write_queue = self.write_queue if self.writer_pid == os.getpid() else None
+            if write_queue is not None:
+                write_queue.join()
+            if len(self.write_errors) > 0:
+                error, self.write_errors = self.write_errors[0], []
+                raise error
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def clear(self):
+        try:
+            self.flush()
+            with self.lock:
+                self.objects = dict()
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def save_object(self, file_path:str, obj:object):
+        try:
+            self.put(file_path=file_path, obj=obj, write=lambda path: utils.save_object(file_path=path, obj=obj))
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def load_object(self, file_path:str)->object:
+        try:
+            obj = self.get(file_path=file_path)
+            return utils.load_object(file_path=file_path) if obj is None else obj
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def save_dataframe(self, file_path:str, df:pd.DataFrame, file_format:str="csv")->str:
+        #a copy is kept so later changes by the caller do not reach readers or the file, written through it is not needed
+        try:
+            if self.enabled:
+                df = df.copy()
+            dataframe_path = utils.get_dataframe_path(file_path=file_path, file_format=file_format)
+            self.put(file_path=dataframe_path, obj=df, write=lambda path: utils.save_dataframe(file_path=path, df=df, file_format=file_format))
+            return dataframe_path
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def load_dataframe(self, file_path:str)->pd.DataFrame:
+        #every reader gets its own copy as stages change dataframes in place
+        try:
+            df = self.get(file_path=file_path)
+            return utils.load_dataframe(file_path=file_path) if df is None else df.copy()
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def save_numpy_array_data(self, file_path:str, array:np.ndarray):
+        try:
+            if self.enabled:
+                array = np.array(array)
+                array.flags.writeable = False
+            self.put(file_path=file_path, obj=array, write=lambda path: utils.save_numpy_array_data(file_path=path, array=array))
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def load_numpy_array_data(self, file_path:str, mmap_mode:str=None)->np.ndarray:
+        #like np.load, a read only memory map gets the shared read only array and any other mode a writable copy
+        try:
+            array = self.get(file_path=file_path)
+            if array is None:
+                return utils.load_numpy_array_data(file_path=file_path, mmap_mode=mmap_mode)
+            return array if mmap_mode == 'r' else array.copy()
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+#components used outside the training pipeline write straight to files, the pipeline enables it from its config
+artifact_store = ArtifactStore(enabled=False)
@@ -0,0 +1,65 @@
+import os, sys
+from insurance.logger import logging
+from insurance.exception import InsuranceException
+from insurance.utils import get_file_hash
+
+
+class BlobStore:
+    #content addressed storage : every distinct file content is kept once under blob_dir/<aa>/<sha256> and the
+    #files that hold it are hard links to the blob, so readers keep using their usual paths. A blob whose link
+    #count dropped to one is not referenced anymore and is removed by collect_garbage. Interned files are made
+    #read only, they must never be rewritten in place, only replaced.
+    def __init__(self, blob_dir:str):
+        self.blob_dir = blob_dir
+
+    def get_blob_path(self, digest:str)->str:
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def intern_file(self, file_path:str)->str:
+        try:
+            digest = get_file_hash(file_path=file_path)
+            blob_path = self.get_blob_path(digest=digest)
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            try:
+                #the first file with this content becomes the blob
+                os.link(file_path, blob_path)
+                os.chmod(blob_path, 0o444)
+            except FileExistsError:
+                os.link(blob_path, f"{file_path}.link")
+                os.replace(f"{file_path}.link", file_path)
+            return digest
+        except OSError as e:
+            #e.g. the artifact dir is on another file system than the registry, the file is kept as a copy
+            logging.info(f"Could not link {file_path} into {self.blob_dir}, keeping a copy : {e}")
+            return None
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def intern_dir(self, dir_path:str)->dict:
+        try:
+            digests = dict()
+            for root, _, file_names in os.walk(dir_path):
+                for file_name in sorted(file_names):
+                    file_path = os.path.join(root, file_name)
+                    digests[os.path.relpath(file_path, dir_path)] = self.intern_file(file_path=file_path)
+            logging.info(f"Interned {len(digests)} files of {dir_path} into {self.blob_dir}")
+            return digests
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def collect_garbage(self, dry_run:bool=False)->list:
+        try:
+            removed_blobs = []
+            if not os.path.isdir(self.blob_dir):
+                return removed_blobs
+            for root, _, file_names in os.walk(self.blob_dir):
+                for file_name in file_names:
+                    blob_path = os.path.join(root, file_name)
+                    if os.stat(blob_path).st_nlink == 1:
+                        removed_blobs.append(blob_path)
+                        if not dry_run:
+                            os.remove(blob_path)
+            logging.info(f"Removed {len(removed_blobs)} unreferenced blobs from {self.blob_dir}")
+            return removed_blobs
+        except Exception as e:
+            raise InsuranceException(e, sys)
@@ -0,0 +1,116 @@
+import os, sys
+import json
+import mmap
+import pickle
+import hashlib
+from typing import Optional
+from insurance.exception import InsuranceException
+
+BUNDLE_MAGIC = b"INSBNDL1"
+BUNDLE_FORMAT_VERSION = 1
+#every section starts on this boundary so arrays can be used in place from a memory map
+BUNDLE_ALIGNMENT = 64
+
+
+def _align(offset:int)->int:
+    return -(-offset // BUNDLE_ALIGNMENT) * BUNDLE_ALIGNMENT
+
+
+def save_bundle(file_path:str, objects:dict, schema:Optional[dict]=None):
+    #layout : magic | header length (8 bytes) | json header | payload. Every object is a protocol 5 pickle
+    #whose contiguous numpy arrays are written out of band as raw aligned sections of the payload. The file only
+    #depends on the objects, registry version and push time are kept in the registry index, so the same bundle
+    #can be linked into the pusher dir and the registry and deduplicated across versions.
+    try:
+        sections = []
+        object_layout = dict()
+        payload_size = 0
+        for name, obj in objects.items():
+            buffers = []
+            data = memoryview(pickle.dumps(obj, protocol=5, buffer_callback=buffers.append))
+            spans = []
+            for section in [data] + [buffer.raw() for buffer in buffers]:
+                offset = _align(payload_size)
+                sections.append((offset, section))
+                spans.append([offset, section.nbytes])
+                payload_size = offset + section.nbytes
+            object_layout[name] = {"type": f"{type(obj).__module__}.{type(obj).__name__}", "pickle": spans[0], "buffers": spans[1:]}
+
+        #the checksum covers the payload exactly as it is written, alignment padding included
+        payload_hash = hashlib.sha256()
+        position = 0
+        for offset, section in sections:
+            payload_hash.update(bytes(offset - position))
+            payload_hash.update(section)
+            position = offset + section.nbytes
+
+        header = {"format_version": BUNDLE_FORMAT_VERSION, "schema": schema or dict(), "objects": object_layout, "payload_size": payload_size,
+                  "checksum": {"algorithm": "sha256", "value": payload_hash.hexdigest()}}
+        header_bytes = json.dumps(header, sort_keys=True).encode()
+        payload_offset = _align(len(BUNDLE_MAGIC) + 8 + len(header_bytes))
+
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(f"{file_path}.tmp", "wb") as file_obj:
+            file_obj.write(BUNDLE_MAGIC)
+            file_obj.write(len(header_bytes).to_bytes(8, "little"))
+            file_obj.write(header_bytes)
+            file_obj.write(bytes(payload_offset - file_obj.tell()))
+            for section_offset, section in sections:
+                file_obj.write(bytes(payload_offset + section_offset - file_obj.tell()))
+                file_obj.write(section)
+            file_obj.flush()
+            os.fsync(file_obj.fileno())
+        os.replace(f"{file_path}.tmp", file_path)
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def read_bundle_header(data)->tuple:
+    try:
+        if bytes(data[:len(BUNDLE_MAGIC)]) != BUNDLE_MAGIC:
+            raise Exception(f"Not a model bundle, magic bytes do not match")
+        header_size = int.from_bytes(data[len(BUNDLE_MAGIC):len(BUNDLE_MAGIC) + 8], "little")
+        header_end = len(BUNDLE_MAGIC) + 8 + header_size
+        header = json.loads(bytes(data[len(BUNDLE_MAGIC) + 8:header_end]))
+        if header["format_version"] != BUNDLE_FORMAT_VERSION:
+            raise Exception(f"Bundle format version {header['format_version']} is not supported")
+        return header, _align(header_end)
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def read_bundle_file_header(file_path:str)->dict:
+    #only reads the header, e.g. for the schema of a bundle without loading its objects
+    try:
+        with open(file_path, "rb") as file_obj:
+            prefix = file_obj.read(len(BUNDLE_MAGIC) + 8)
+            data = prefix + file_obj.read(int.from_bytes(prefix[len(BUNDLE_MAGIC):], "little"))
+        header, _ = read_bundle_header(memoryview(data))
+        return header
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def load_bundle(file_path:str, use_mmap:bool=False, verify:bool=True)->tuple:
+    #the file is read with a single read (or memory mapped) and numpy arrays of the objects are read only
+    #views into it, nothing is copied. Returns the header and a dict of the objects.
+    try:
+        with open(file_path, "rb") as file_obj:
+            if use_mmap:
+                data = memoryview(mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ))
+            else:
+                data = memoryview(file_obj.read())
+        header, payload_offset = read_bundle_header(data)
+        payload = data[payload_offset:payload_offset + header["payload_size"]]
+        if payload.nbytes != header["payload_size"]:
+            raise Exception(f"Bundle {file_path} is truncated")
+        if verify and hashlib.sha256(payload).hexdigest() != header["checksum"]["value"]:
+            raise Exception(f"Bundle {file_path} is corrupted, checksum does not match")
+        objects = dict()
+        for name, layout in header["objects"].items():
+            pickle_offset, pickle_size = layout["pickle"]
+            buffers = [payload[offset:offset + size] for offset, size in layout["buffers"]]
+            objects[name] = pickle.loads(payload[pickle_offset:pickle_offset + pickle_size], buffers=buffers)
+        return header, objects
+    except Exception as e:
+        raise InsuranceException(e, sys)
@@ -5,9 +5,29 @@ from insurance.entity import artifact_entity
 import pandas as pd
 import numpy as np
 import os, sys
+import time
+from typing import Optional
 from insurance import utils
+from insurance.artifact_store import artifact_store
 from sklearn.model_selection import train_test_split
 
+MANIFEST_FILE_NAME = "manifest.yaml"
+PARTITION_FILE_NAME = "part-{:05d}.csv"
+
+
+def _encode_watermark(value)->dict:
+    #ObjectId is not a yaml type so it is kept as its hex string
+    if type(value).__name__ == "ObjectId":
+        return {"value": str(value), "type": "objectid"}
+    return {"value": value, "type": "native"}
+
+
+def _decode_watermark(watermark:dict):
+    if watermark["type"] == "objectid":
+        from bson import ObjectId
+        return ObjectId(watermark["value"])
+    return watermark["value"]
+
 
 class DataIngestion:
     def __init__(self, data_ingestion_config:config_entity.DataIngestionConfig):
@@ -18,39 +38,246 @@ class DataIngestion:
             raise InsuranceException(e, sys)
 
 
-    def initiate_data_ingestion(self)->artifact_entity.DataIngestionArtifact:
+    def export_collection(self, query:Optional[dict]=None)->pd.DataFrame:
+        try:
+            if self.data_ingestion_config.num_partitions > 1 and query is None:
+                return utils.get_collection_as_dataframe_parallel(database_name =self.data_ingestion_config.database_name, collection_name = self.data_ingestion_config.collection_name,
+                                                                  num_partitions=self.data_ingestion_config.num_partitions,
+                                                                  partition_field=self.data_ingestion_config.partition_field,
+                                                                  batch_size=self.data_ingestion_config.batch_size)
+            return utils.get_collection_as_dataframe(database_name =self.data_ingestion_config.database_name, collection_name = self.data_ingestion_config.collection_name,
+                                                     batch_size=self.data_ingestion_config.batch_size, query=query)
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def save_dataframe(self, file_path:str, df:pd.DataFrame)->str:
+        try:
+            file_format = self.data_ingestion_config.file_format
+            dataframe_path = artifact_store.save_dataframe(file_path=file_path, df=df, file_format=file_format)
+            if file_format != "csv" and self.data_ingestion_config.export_csv:
+                artifact_store.save_dataframe(file_path=file_path, df=df, file_format="csv")
+            return dataframe_path
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def run_preflight_profile(self, query:Optional[dict]=None)->str:
+        try:
+            profile = utils.profile_collection(database_name=self.data_ingestion_config.database_name,
+                                               collection_name=self.data_ingestion_config.collection_name,
+                                               numeric_fields=self.data_ingestion_config.preflight_numeric_fields,
+                                               categorical_fields=self.data_ingestion_config.preflight_categorical_fields,
+                                               query=query)
+            utils.write_yaml_file(file_path=self.data_ingestion_config.profile_file_path, data=profile)
+            logging.info(f"Pre-flight profile : {profile}")
+
+            if profile["count"] == 0:
+                raise Exception(f"Rejecting load, no documents to export from collection : {self.data_ingestion_config.collection_name}")
+            threshold = self.data_ingestion_config.preflight_missing_threshold
+            broken_fields = [field for field, field_profile in profile["fields"].items() if field_profile["null_ratio"] > threshold]
+            if len(broken_fields) > 0:
+                raise Exception(f"Rejecting load, fields {broken_fields} have more than {threshold} missing values, see {self.data_ingestion_config.profile_file_path}")
+            return self.data_ingestion_config.profile_file_path
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def get_source_state(self)->dict:
+        #server side summary of the collection used to fingerprint this stage, in place edits
+        #that keep counts, sums, ranges and distinct values unchanged are not noticed
+        try:
+            profile = utils.profile_collection(database_name=self.data_ingestion_config.database_name,
+                                               collection_name=self.data_ingestion_config.collection_name,
+                                               numeric_fields=self.data_ingestion_config.preflight_numeric_fields,
+                                               categorical_fields=self.data_ingestion_config.preflight_categorical_fields)
+            max_watermark = utils.get_max_field_value(database_name=self.data_ingestion_config.database_name,
+                                                      collection_name=self.data_ingestion_config.collection_name,
+                                                      field=self.data_ingestion_config.watermark_field)
+            return {"profile": profile, "max_watermark": str(max_watermark)}
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def read_manifest(self)->dict:
         try:
-            logging.info(f"Exporting collection data as dataframe")
-            df:pd.DataFrame = utils.get_collection_as_dataframe(database_name =self.data_ingestion_config.database_name, collection_name = self.data_ingestion_config.collection_name)
+            manifest_path = os.path.join(self.data_ingestion_config.partitioned_feature_store_dir, MANIFEST_FILE_NAME)
+            if not os.path.exists(manifest_path):
+                return {"watermark_field": self.data_ingestion_config.watermark_field, "watermark": None, "partitions": []}
+            manifest = utils.read_yaml_file(file_path=manifest_path)
+            if manifest["watermark_field"] != self.data_ingestion_config.watermark_field:
+                raise Exception(f"Feature store watermark field : {manifest['watermark_field']} does not match configured field : {self.data_ingestion_config.watermark_field}")
+            return manifest
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def write_manifest(self, manifest:dict):
+        try:
+            #the manifest is replaced atomically, a partition that is not listed in it is never read and
+            #partitions still being written behind are on disk before they are listed
+            artifact_store.flush()
+            manifest_path = os.path.join(self.data_ingestion_config.partitioned_feature_store_dir, MANIFEST_FILE_NAME)
+            utils.write_yaml_file(file_path=f"{manifest_path}.tmp", data=manifest)
+            os.replace(f"{manifest_path}.tmp", manifest_path)
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def ingest_increment(self)->tuple:
+        try:
+            feature_store_dir = self.data_ingestion_config.partitioned_feature_store_dir
+            watermark_field = self.data_ingestion_config.watermark_field
+            manifest = self.read_manifest()
+            lower_watermark = None if manifest["watermark"] is None else _decode_watermark(manifest["watermark"])
+
+            #upper bound is fixed first so documents inserted while exporting are left for the next run
+            upper_watermark = utils.get_max_field_value(database_name=self.data_ingestion_config.database_name,
+                                                        collection_name=self.data_ingestion_config.collection_name,
+                                                        field=watermark_field)
+            logging.info(f"Watermark on {watermark_field} : {lower_watermark}, latest value in collection : {upper_watermark}")
+
+            new_df = None
+            new_partition_file_path = None
+            profile_file_path = None
+            export_time = 0.0
+            if upper_watermark is not None and (lower_watermark is None or upper_watermark > lower_watermark):
+                condition = {"$lte": upper_watermark}
+                if lower_watermark is not None:
+                    condition["$gt"] = lower_watermark
+                if self.data_ingestion_config.preflight_profile:
+                    profile_file_path = self.run_preflight_profile(query={watermark_field: condition})
+                start_time = time.perf_counter()
+                new_df = self.export_collection(query={watermark_field: condition})
+                export_time = time.perf_counter() - start_time
+                new_df.replace(to_replace="na", value=np.NAN, inplace=True)
+
+                partition_file_path = os.path.join(feature_store_dir, PARTITION_FILE_NAME.format(len(manifest["partitions"])))
+                logging.info(f"Save {new_df.shape[0]} new rows as partition : {partition_file_path}")
+                new_partition_file_path = self.save_dataframe(file_path=partition_file_path, df=new_df)
+
+                manifest["partitions"].append(os.path.basename(new_partition_file_path))
+                manifest["watermark"] = _encode_watermark(upper_watermark)
+                self.write_manifest(manifest=manifest)
+            else:
+                logging.info(f"No new documents since last ingestion")
 
-            logging.info(f"Save data in feature store")
+            if len(manifest["partitions"]) == 0:
+                raise Exception(f"Feature store : {feature_store_dir} has no partitions and collection has no documents")
+            partition_file_paths = [os.path.join(feature_store_dir, partition_file_name) for partition_file_name in manifest["partitions"]]
+            new_rows = 0 if new_df is None else new_df.shape[0]
+            return partition_file_paths, new_rows, new_partition_file_path, profile_file_path, export_time
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def split_by_hash(self, get_chunks)->tuple:
+        try:
+            file_format = self.data_ingestion_config.file_format
+            train_file_path = utils.get_dataframe_path(file_path=self.data_ingestion_config.train_file_path, file_format=file_format)
+            test_file_path = utils.get_dataframe_path(file_path=self.data_ingestion_config.test_file_path, file_format=file_format)
+            get_test_mask = lambda chunk_df: utils.get_hash_split_mask(df=chunk_df, test_size=self.data_ingestion_config.test_size,
+                                                                        key_columns=self.data_ingestion_config.split_key_columns)
+
+            writers = []
+            if file_format == "npy":
+                #first pass only keeps the split mask of every chunk and the column layout so the
+                #train and test columns can be preallocated and filled in the second pass
+                test_masks = []
+                layout = dict()
+                for chunk_df in get_chunks():
+                    test_masks.append(get_test_mask(chunk_df))
+                    utils.update_columnar_layout(layout=layout, df=chunk_df)
+                num_rows = sum(len(test_mask) for test_mask in test_masks)
+                num_test_rows = int(sum(test_mask.sum() for test_mask in test_masks))
+                writers = [utils.ColumnarDataFrameWriter(dir_path=train_file_path, num_rows=num_rows-num_test_rows, layout=layout),
+                           utils.ColumnarDataFrameWriter(dir_path=test_file_path, num_rows=num_test_rows, layout=layout)]
+                chunks = zip(get_chunks(), test_masks)
+            else:
+                chunks = ((chunk_df, get_test_mask(chunk_df)) for chunk_df in get_chunks())
+
+            write_csv = file_format == "csv" or self.data_ingestion_config.export_csv
+            os.makedirs(os.path.dirname(self.data_ingestion_config.train_file_path), exist_ok=True)
+            is_first_chunk = True
+            for chunk_df, test_mask in chunks:
+                train_chunk_df, test_chunk_df = chunk_df[~test_mask], chunk_df[test_mask]
+                if len(writers) > 0:
+                    writers[0].write(df=train_chunk_df)
+                    writers[1].write(df=test_chunk_df)
+                if write_csv:
+                    mode = "w" if is_first_chunk else "a"
+                    train_chunk_df.to_csv(path_or_buf=self.data_ingestion_config.train_file_path, index=False, header=is_first_chunk, mode=mode)
+                    test_chunk_df.to_csv(path_or_buf=self.data_ingestion_config.test_file_path, index=False, header=is_first_chunk, mode=mode)
+                is_first_chunk = False
+            for writer in writers:
+                writer.close()
+            return train_file_path, test_file_path
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def initiate_data_ingestion(self)->artifact_entity.DataIngestionArtifact:
+        try:
+            new_partition_file_path = None
+            profile_file_path = None
+            if self.data_ingestion_config.incremental:
+                logging.info(f"Exporting new documents into partitioned feature store")
+                partition_file_paths, ingested_rows, new_partition_file_path, profile_file_path, elapsed_time = self.ingest_increment()
+                feature_store_file_path = self.data_ingestion_config.partitioned_feature_store_dir
+            else:
+                if self.data_ingestion_config.preflight_profile:
+                    logging.info(f"Profiling collection before export")
+                    profile_file_path = self.run_preflight_profile()
+                logging.info(f"Exporting collection data as dataframe")
+                #only the export is timed, not the profile before it or the writes after it
+                start_time = time.perf_counter()
+                df:pd.DataFrame = self.export_collection()
+                elapsed_time = time.perf_counter() - start_time
+                ingested_rows = df.shape[0]
+            rows_per_second = ingested_rows/elapsed_time if elapsed_time > 0 else None
+            logging.info(f"Exported {ingested_rows} rows in {elapsed_time:.2f} seconds ({rows_per_second} rows/sec)")
 
-            #Removing na values with nan
-            df.replace(to_replace="na", value=np.NAN, inplace=True)
-            logging.info(f"Create feature store folder if not available")
+            if not self.data_ingestion_config.incremental:
+                logging.info(f"Save data in feature store")
 
-            feature_store_dir = os.path.dirname(self.data_ingestion_config.feature_store_file_path)
-            os.makedirs(feature_store_dir, exist_ok=True)
+                #Removing na values with nan
+                df.replace(to_replace="na", value=np.NAN, inplace=True)
 
-            logging.info(f"Save dataframe into feature store folder")
-            df.to_csv(path_or_buf=self.data_ingestion_config.feature_store_file_path, index=False, header=True)
+                logging.info(f"Save dataframe into feature store folder")
+                feature_store_file_path = self.save_dataframe(file_path=self.data_ingestion_config.feature_store_file_path, df=df)
 
-            logging.info(f"Split dataset into train and test set")
-            train_df, test_df = train_test_split(df,test_size=self.data_ingestion_config.test_size, random_state=42)
+            chunk_size = self.data_ingestion_config.split_chunk_size
+            if self.data_ingestion_config.split_mode == "hash":
+                logging.info(f"Split dataset into train and test set by hashing rows in chunks of {chunk_size}")
+                if self.data_ingestion_config.incremental:
+                    get_chunks = lambda: (chunk_df for partition_file_path in partition_file_paths
+                                          for chunk_df in utils.iter_dataframe_chunks(file_path=partition_file_path, chunk_size=chunk_size))
+                else:
+                    get_chunks = lambda: (df.iloc[start:start+chunk_size] for start in range(0, max(df.shape[0], 1), chunk_size))
+                train_file_path, test_file_path = self.split_by_hash(get_chunks=get_chunks)
+            else:
+                if self.data_ingestion_config.incremental:
+                    logging.info(f"Reading union of {len(partition_file_paths)} feature store partitions")
+                    df = pd.concat([artifact_store.load_dataframe(file_path=partition_file_path) for partition_file_path in partition_file_paths], ignore_index=True)
 
-            logging.info(f"Create dataset folder if not available")
-            dataset_dir = os.path.dirname(self.data_ingestion_config.train_file_path)
-            os.makedirs(dataset_dir, exist_ok=True)
+                logging.info(f"Split dataset into train and test set")
+                train_df, test_df = train_test_split(df,test_size=self.data_ingestion_config.test_size, random_state=42)
 
-            logging.info(f"Save train and test dataframe in database folder")
-            train_df.to_csv(path_or_buf=self.data_ingestion_config.train_file_path, index=False, header=True)
-            test_df.to_csv(path_or_buf=self.data_ingestion_config.test_file_path, index=False, header=True)
+                logging.info(f"Save train and test dataframe in database folder")
+                train_file_path = self.save_dataframe(file_path=self.data_ingestion_config.train_file_path, df=train_df)
+                test_file_path = self.save_dataframe(file_path=self.data_ingestion_config.test_file_path, df=test_df)
 
             #prepare data ingestion artifact
             data_ingestion_artifact = artifact_entity.DataIngestionArtifact(
-                feature_store_file_path = self.data_ingestion_config.feature_store_file_path,
-                train_file_path = self.data_ingestion_config.train_file_path, 
-                test_file_path = self.data_ingestion_config.test_file_path)
+                feature_store_file_path = feature_store_file_path,
+                train_file_path = train_file_path,
+                test_file_path = test_file_path,
+                ingested_rows = ingested_rows,
+                rows_per_second = rows_per_second,
+                new_partition_file_path = new_partition_file_path,
+                profile_file_path = profile_file_path,
+                partition_file_paths = partition_file_paths if self.data_ingestion_config.incremental else None,
+                split_mode = self.data_ingestion_config.split_mode)
 
             
             logging.info(f"Data ingestion artifact: {data_ingestion_artifact}")
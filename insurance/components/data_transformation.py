@@ -6,11 +6,30 @@ import os, sys
 from sklearn.impute import SimpleImputer
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import RobustScaler
-import pandas as pd
 import numpy as np
 from insurance.config import TARGET_COLUMN
-from sklearn.preprocessing import LabelEncoder
+from insurance.encoder import CategoricalEncoder, UNKNOWN_CATEGORY_CODE
+from insurance.sketch import QuantileSketch, CategoryCounter
+from insurance.predictor import ModelResolver
 from insurance import utils
+from insurance.artifact_store import artifact_store, write_atomically
+
+#RobustScaler default quantile_range
+SCALER_QUANTILES = [0.25, 0.5, 0.75]
+
+
+def get_quantiles_from_counts(values:np.ndarray, counts:np.ndarray, q:list)->np.ndarray:
+    #same linear interpolation as np.percentile over np.repeat(values, counts) without materializing it,
+    #counts are exact category counts or the weights of quantile sketch items
+    try:
+        order = np.argsort(values)
+        values, cumulative_counts = values[order], np.cumsum(counts[order])
+        positions = np.asarray(q, dtype=np.float64)*(cumulative_counts[-1] - 1)
+        lower = values[np.searchsorted(cumulative_counts, np.floor(positions), side="right")]
+        upper = values[np.searchsorted(cumulative_counts, np.ceil(positions), side="right")]
+        return lower + (upper - lower)*(positions - np.floor(positions))
+    except Exception as e:
+        raise InsuranceException(e, sys)
 
 
 
@@ -40,11 +59,144 @@ class DataTransformation:
             raise InsuranceException(e, sys)
 
 
+    def load_latest_preprocessing(self):
+        #encoder and transformer of the latest saved model, None when there is none to reuse
+        try:
+            model_resolver = ModelResolver(model_registry=self.data_transformation_config.saved_model_dir)
+            if model_resolver.get_latest_dir_path() is None:
+                logging.info(f"No saved model found, fitting encoder and transformer")
+                return None
+            label_encoder = utils.load_object(file_path=model_resolver.get_latest_target_encoder_path())
+            if not isinstance(label_encoder, CategoricalEncoder):
+                logging.info(f"Latest saved model has no CategoricalEncoder, fitting encoder and transformer")
+                return None
+            tranformation_pipeline = utils.load_object(file_path=model_resolver.get_latest_transformer_path())
+            logging.info(f"Reusing encoder and transformer of {model_resolver.get_latest_dir_path()}")
+            return label_encoder, tranformation_pipeline
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def fit_chunked(self, file_path:str):
+        try:
+            #one pass: categories and exact code counts for categorical columns, quantile sketches of the imputed
+            #values for numeric columns. Codes are positions in the sorted categories, so their quantiles follow
+            #from the counts once all categories are known.
+            label_encoder = CategoricalEncoder(columns=self.data_transformation_config.categorical_columns)
+            summaries = dict()
+            first_chunk = None
+            num_rows = 0
+            for chunk in utils.iter_dataframe_chunks(file_path=file_path, chunk_size=self.data_transformation_config.chunk_size):
+                input_feature_df = chunk.drop(TARGET_COLUMN, axis=1)
+                if first_chunk is None:
+                    first_chunk = input_feature_df
+                    summaries = {column: CategoryCounter() if column in label_encoder.columns
+                                 else QuantileSketch(k=self.data_transformation_config.sketch_size, seed=42)
+                                 for column in input_feature_df.columns}
+                label_encoder.partial_fit(input_feature_df)
+                for column, summary in summaries.items():
+                    if isinstance(summary, CategoryCounter):
+                        summary.update(input_feature_df[column])
+                    else:
+                        summary.update(input_feature_df[column].astype("float64").fillna(0).to_numpy())
+                num_rows += len(chunk)
+            if first_chunk is None:
+                raise Exception(f'No rows found in {file_path}')
+
+            quantiles = []
+            for column, summary in summaries.items():
+                if isinstance(summary, CategoryCounter):
+                    categories = label_encoder.categories_[column]
+                    codes = np.append(categories.get_indexer(list(summary.counts)), UNKNOWN_CATEGORY_CODE)
+                    counts = np.append(list(summary.counts.values()), summary.null_count)
+                    quantiles.append(get_quantiles_from_counts(values=codes.astype(np.float64), counts=counts, q=SCALER_QUANTILES))
+                else:
+                    items, weights = summary.weighted_items()
+                    quantiles.append(get_quantiles_from_counts(values=items, counts=weights, q=SCALER_QUANTILES))
+            quantiles = np.array(quantiles)
+
+            #the pipeline is fitted on the first chunk for its bookkeeping, then center and scale are replaced
+            tranformation_pipeline = DataTransformation.get_data_transformer_object()
+            tranformation_pipeline.fit(label_encoder.transform(first_chunk))
+            scaler = tranformation_pipeline.named_steps['scaler']
+            scale = quantiles[:, 2] - quantiles[:, 0]
+            scaler.center_ = quantiles[:, 1]
+            scaler.scale_ = np.where(scale == 0, 1.0, scale)
+            logging.info(f"Fitted transformer on {num_rows} rows, center : {scaler.center_}, scale : {scaler.scale_}")
+            return label_encoder, tranformation_pipeline, num_rows
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def transform_chunked(self, file_path:str, output_file_path:str, label_encoder:CategoricalEncoder, tranformation_pipeline:Pipeline, num_rows:int=None):
+        try:
+            if num_rows is None:
+                num_rows = sum(len(chunk) for chunk in utils.iter_dataframe_chunks(file_path=file_path, chunk_size=self.data_transformation_config.chunk_size))
+            num_columns = len(tranformation_pipeline.feature_names_in_) + 1
+            os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+
+            def write(path:str):
+                #features and target share one preallocated buffer, the last column is the target
+                output_arr = np.lib.format.open_memmap(path, mode="w+", dtype=np.float64, shape=(num_rows, num_columns))
+                offset = 0
+                for chunk in utils.iter_dataframe_chunks(file_path=file_path, chunk_size=self.data_transformation_config.chunk_size):
+                    input_feature_df = label_encoder.transform(chunk.drop(TARGET_COLUMN, axis=1))
+                    output_arr[offset:offset+len(chunk), :-1] = tranformation_pipeline.transform(input_feature_df)
+                    output_arr[offset:offset+len(chunk), -1] = chunk[TARGET_COLUMN].to_numpy(dtype=np.float64)
+                    offset += len(chunk)
+                if offset != num_rows:
+                    raise Exception(f'Expected {num_rows} rows in {file_path} but read {offset}')
+                output_arr.flush()
+                del output_arr
+
+            #filled under a temporary name and renamed into place, an interrupted run never leaves a truncated array
+            write_atomically(file_path=output_file_path, write=write)
+            logging.info(f"Written {num_rows} transformed rows into {output_file_path}")
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def initiate_chunked_data_transformation(self)->artifact_entity.DataTransformationArtifact:
+        try:
+            #train and test files are streamed from disk
+            artifact_store.flush()
+            preprocessing = self.load_latest_preprocessing() if self.data_transformation_config.reuse_preprocessing else None
+            if preprocessing is None:
+                logging.info(f"Fitting transformer in chunks of {self.data_transformation_config.chunk_size} rows")
+                label_encoder, tranformation_pipeline, num_rows = self.fit_chunked(file_path=self.data_ingestion_artifact.train_file_path)
+            else:
+                (label_encoder, tranformation_pipeline), num_rows = preprocessing, None
+
+            logging.info(f"Transforming train and test file in chunks")
+            self.transform_chunked(file_path=self.data_ingestion_artifact.train_file_path, output_file_path=self.data_transformation_config.transformed_train_path,
+                                   label_encoder=label_encoder, tranformation_pipeline=tranformation_pipeline, num_rows=num_rows)
+            self.transform_chunked(file_path=self.data_ingestion_artifact.test_file_path, output_file_path=self.data_transformation_config.transformed_test_path,
+                                   label_encoder=label_encoder, tranformation_pipeline=tranformation_pipeline)
+
+            #save transformed objects
+            artifact_store.save_object(file_path= self.data_transformation_config.transform_object_path, obj= tranformation_pipeline)
+            artifact_store.save_object(file_path= self.data_transformation_config.target_encoder_path, obj= label_encoder)
+
+            data_transformation_artifact = artifact_entity.DataTransformationArtifact(
+                transform_object_path=self.data_transformation_config.transform_object_path,
+                transformed_train_path=self.data_transformation_config.transformed_train_path,
+                transformed_test_path=self.data_transformation_config.transformed_test_path,
+                target_encoder_path=self.data_transformation_config.target_encoder_path)
+
+            logging.info(f"Data transformation object : {data_transformation_artifact}")
+            return data_transformation_artifact
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
     def initiate_data_transformation(self)->artifact_entity.DataTransformationArtifact:
         try:
+            if self.data_transformation_config.chunked:
+                return self.initiate_chunked_data_transformation()
+
             #reading training and testing file
-            train_df = pd.read_csv(self.data_ingestion_artifact.train_file_path)
-            test_df = pd.read_csv(self.data_ingestion_artifact.test_file_path)
+            train_df = artifact_store.load_dataframe(file_path=self.data_ingestion_artifact.train_file_path)
+            test_df = artifact_store.load_dataframe(file_path=self.data_ingestion_artifact.test_file_path)
 
             #selecting input feature for train and test dataframe
             input_feature_train_df = train_df.drop(TARGET_COLUMN, axis=1)
@@ -58,19 +210,18 @@ class DataTransformation:
             target_feature_train_arr = target_feature_train_df.squeeze()
             target_feature_test_arr = target_feature_test_df.squeeze()
 
-            #transformation on categorical columns in input feature dataframe
-            label_encoder = LabelEncoder()
-            for col in input_feature_train_df.columns:
-                if input_feature_test_df[col].dtypes == 'O':
-                    input_feature_train_df[col] = label_encoder.fit_transform(input_feature_train_df[col])
-                    input_feature_test_df[col] = label_encoder.fit_transform(input_feature_test_df[col])
-                else:
-                    input_feature_train_df[col] = input_feature_train_df[col]
-                    input_feature_test_df[col] = input_feature_test_df[col]
+            preprocessing = self.load_latest_preprocessing() if self.data_transformation_config.reuse_preprocessing else None
+            if preprocessing is None:
+                #transformation on categorical columns in input feature dataframe, fitted on train only
+                label_encoder = CategoricalEncoder(columns=self.data_transformation_config.categorical_columns)
+                label_encoder.fit(input_feature_train_df)
+                tranformation_pipeline = DataTransformation.get_data_transformer_object()
+                tranformation_pipeline.fit(label_encoder.transform(input_feature_train_df))
+            else:
+                label_encoder, tranformation_pipeline = preprocessing
 
-            
-            tranformation_pipeline = DataTransformation.get_data_transformer_object()
-            tranformation_pipeline.fit(input_feature_train_df)
+            input_feature_train_df = label_encoder.transform(input_feature_train_df)
+            input_feature_test_df = label_encoder.transform(input_feature_test_df)
 
             input_feature_train_arr = tranformation_pipeline.transform(input_feature_train_df)
             input_feature_test_arr = tranformation_pipeline.transform(input_feature_test_df)
@@ -80,12 +231,12 @@ class DataTransformation:
             test_arr = np.c_[input_feature_test_arr, target_feature_test_arr]
 
             #save numpy array
-            utils.save_numpy_array_data(file_path= self.data_transformation_config.transformed_train_path, array=train_arr)
-            utils.save_numpy_array_data(file_path= self.data_transformation_config.transformed_test_path, array= test_arr)
+            artifact_store.save_numpy_array_data(file_path= self.data_transformation_config.transformed_train_path, array=train_arr)
+            artifact_store.save_numpy_array_data(file_path= self.data_transformation_config.transformed_test_path, array= test_arr)
 
             #save transformed objects
-            utils.save_object(file_path= self.data_transformation_config.transform_object_path, obj= tranformation_pipeline)
-            utils.save_object(file_path= self.data_transformation_config.target_encoder_path, obj= label_encoder)
+            artifact_store.save_object(file_path= self.data_transformation_config.transform_object_path, obj= tranformation_pipeline)
+            artifact_store.save_object(file_path= self.data_transformation_config.target_encoder_path, obj= label_encoder)
 
 
             data_transformation_artifact = artifact_entity.DataTransformationArtifact(
@@ -3,12 +3,50 @@ from insurance.entity import artifact_entity
 from insurance.logger import logging
 from insurance.exception import InsuranceException
 from typing import Optional
-from scipy.stats import ks_2samp
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from scipy.stats import ks_2samp, kstwo
 import numpy as np
 import pandas as pd
 import os, sys
 from insurance.config import TARGET_COLUMN
 from insurance import utils
+from insurance.artifact_store import artifact_store
+from insurance.sketch import new_column_summary, ks_2samp_sketch, CategoryCounter
+
+#ks_2samp computes exact p-values up to this sample size and uses the asymptotic distribution above it
+KS_EXACT_MAX_SAMPLES = 10000
+
+
+def ks_2samp_presorted(base_sorted:np.ndarray, current_data)->tuple:
+    #same result as ks_2samp(base, current) but the base sample is already sorted
+    current_sorted = np.sort(np.asarray(current_data))
+    n1, n2 = base_sorted.shape[0], current_sorted.shape[0]
+    if max(n1, n2) <= KS_EXACT_MAX_SAMPLES:
+        distribution = ks_2samp(base_sorted, current_sorted)
+        return float(distribution.statistic), float(distribution.pvalue)
+    data_all = np.concatenate([base_sorted, current_sorted])
+    cdf_diffs = np.searchsorted(base_sorted, data_all, side='right')/n1 - np.searchsorted(current_sorted, data_all, side='right')/n2
+    statistic = max(np.clip(-cdf_diffs.min(), 0, 1), cdf_diffs.max())
+    m, n = sorted([float(n1), float(n2)], reverse=True)
+    pvalue = np.clip(kstwo.sf(statistic, np.round(m*n/(m+n))), 0, 1)
+    return float(statistic), float(pvalue)
+
+
+def summarize_dataframe(df:pd.DataFrame, categorical_columns:dict, sketch_size:int, seed:int)->dict:
+    summaries = dict()
+    for column, is_categorical in categorical_columns.items():
+        values = df[column].astype(object) if is_categorical else pd.to_numeric(df[column], errors="coerce")
+        summaries[column] = new_column_summary(is_categorical=is_categorical, k=sketch_size, seed=seed).update(values)
+    return summaries
+
+
+def merge_summaries(summaries:dict, other:dict)->dict:
+    #columns whose kind was only decided in a later chunk are missing from the summaries of earlier chunks
+    for column, summary in other.items():
+        summaries[column] = summary if column not in summaries else summaries[column].merge(summary)
+    return summaries
+
 
 class DataValidation:
     def __init__(self, data_validation_config:config_entity.DataValidationConfig,
@@ -87,42 +125,198 @@ class DataValidation:
             raise InsuranceException(e, sys)
 
 
-    def initiate_data_validation(self)->artifact_entity.DataValidationArtifact:
+    def submit_data_drift(self, reference_profile:dict, current_df:pd.DataFrame, executor)->dict:
+        try:
+            #every column is an independent test, results are collected in base column order
+            return {base_column: executor.submit(ks_2samp_presorted, reference_profile["sorted_values"][base_column], np.asarray(current_df[base_column]))
+                    for base_column in reference_profile["columns"]}
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def collect_data_drift(self, drift_futures:dict, report_key_name:str):
+        try:
+            drift_report = dict()
+            for base_column, drift_future in drift_futures.items():
+                # Null hypothesis is base column data and current column data drawn from same distribution
+                _, pvalue = drift_future.result()
+                drift_report[base_column] = {
+                    "pvalue" : pvalue,
+                    "same_distribution" : bool(pvalue>0.05)
+                }
+            self.validation_eror[report_key_name] = drift_report
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def build_reference_profile(self, base_file_hash:str)->dict:
         try:
             logging.info(f"Reading base dataframe")
             base_df = pd.read_csv(self.data_validation_config.base_file_path)
             logging.info(f"Replacing na values in base dataframe")
             base_df.replace({"na":np.NAN}, inplace=True)
+            null_ratios = base_df.isna().mean()
             logging.info(f"Dropping missing values columns from base dataframe")
             base_df = self.drop_missing_values_columns(df=base_df, report_key_name="missing_values_in_base_dataset")
+            base_df = utils.convert_columns_float(df=base_df, exclude_columns=[TARGET_COLUMN])
 
-            logging.info(f"Reading train dataframe")
-            train_df = pd.read_csv(self.data_ingestion_artifact.train_file_path)
-            logging.info(f"Reading test dataframe")
-            test_df = pd.read_csv(self.data_ingestion_artifact.test_file_path)
-            
-            logging.info(f"Dropping missing values columns from train dataframe")
-            train_df = self.drop_missing_values_columns(df=train_df, report_key_name="missing_values_in_train_dataset")
-            logging.info(f"Dropping missing values columns from test dataframe")
-            tets_df = self.drop_missing_values_columns(df=test_df, report_key_name="missing_values_in_test_dataset")
+            return {
+                "base_file_hash": base_file_hash,
+                "missing_threshold": self.data_validation_config.missing_threshold,
+                "missing_values_in_base_dataset": self.validation_eror["missing_values_in_base_dataset"],
+                "columns": list(base_df.columns),
+                "sorted_values": {column: np.sort(base_df[column].to_numpy()) for column in base_df.columns},
+                "category_frequencies": {column: base_df[column].value_counts(normalize=True, dropna=False).to_dict()
+                                         for column in base_df.columns if base_df[column].dtype == 'O'},
+                "null_ratios": null_ratios.to_dict(),
+            }
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def summarize_file(self, file_path:str, categorical_columns:Optional[dict]=None)->tuple:
+        #categorical_columns gives known column kinds (e.g. from the reference profile), other columns are
+        #categorical when their first non null value is a string. Chunks where a column is still all null only
+        #count its nulls, a column that never has a value is summarized as numeric
+        try:
+            chunk_size = self.data_validation_config.chunk_size
+            workers = self.data_validation_config.sketch_workers
+            categorical_columns = dict(categorical_columns or dict())
+            columns = []
+            undecided_null_counts = dict()
+            summaries = dict()
+            num_rows = 0
+            pending = deque()
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for chunk_number, chunk_df in enumerate(utils.iter_dataframe_chunks(file_path=file_path, chunk_size=chunk_size)):
+                    chunk_df = chunk_df.replace({"na":np.NAN})
+                    if chunk_number == 0:
+                        columns = list(chunk_df.columns)
+                    for column in columns:
+                        if column in categorical_columns:
+                            continue
+                        if chunk_df[column].notna().any():
+                            categorical_columns[column] = chunk_df[column].dtype == 'O'
+                        else:
+                            undecided_null_counts[column] = undecided_null_counts.get(column, 0) + chunk_df.shape[0]
+                    num_rows += chunk_df.shape[0]
+                    pending.append(executor.submit(summarize_dataframe, chunk_df, {column: is_categorical for column, is_categorical in categorical_columns.items() if column in columns},
+                                                   self.data_validation_config.sketch_size, chunk_number))
+                    #chunk sketches are merged in chunk order so the report is deterministic
+                    while len(pending) > 0 and (len(pending) >= 2*workers or pending[0].done()):
+                        summaries = merge_summaries(summaries=summaries, other=pending.popleft().result())
+                while len(pending) > 0:
+                    summaries = merge_summaries(summaries=summaries, other=pending.popleft().result())
+
+            for column in columns:
+                if column not in summaries:
+                    summaries[column] = new_column_summary(is_categorical=categorical_columns.get(column, False), k=self.data_validation_config.sketch_size)
+                summaries[column].null_count += undecided_null_counts.get(column, 0)
+            return {column: summaries[column] for column in columns}, num_rows
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def drop_missing_values_summaries(self, summaries:dict, num_rows:int, report_key_name:str)->dict:
+        try:
+            threshold = self.data_validation_config.missing_threshold
+            logging.info(f"Selecting column names which contain null values more than {threshold}")
+            drop_column_names = [column for column, summary in summaries.items() if summary.null_count/max(num_rows, 1) > threshold]
+            logging.info(f"Columns to drop : {drop_column_names}")
+            self.validation_eror[report_key_name] = drop_column_names
+            return {column: summary for column, summary in summaries.items() if column not in drop_column_names}
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def data_drift_from_sketches(self, base_summaries:dict, current_summaries:dict, report_key_name:str):
+        try:
+            drift_report = dict()
+            for base_column, base_summary in base_summaries.items():
+                # Null hypothesis is base column data and current column data drawn from same distribution
+                _, pvalue, error_bound = ks_2samp_sketch(base_summary=base_summary, current_summary=current_summaries[base_column])
+                drift_report[base_column] = {
+                    "pvalue" : pvalue,
+                    "same_distribution" : bool(pvalue>0.05),
+                    "error_bound" : error_bound
+                }
+            self.validation_eror[report_key_name] = drift_report
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def build_reference_sketch_profile(self, base_file_hash:str)->dict:
+        try:
+            summaries, num_rows = self.summarize_file(file_path=self.data_validation_config.base_file_path)
+            summaries = self.drop_missing_values_summaries(summaries=summaries, num_rows=num_rows, report_key_name="missing_values_in_base_dataset")
+            return {
+                "base_file_hash": base_file_hash,
+                "missing_threshold": self.data_validation_config.missing_threshold,
+                "sketch_size": self.data_validation_config.sketch_size,
+                "missing_values_in_base_dataset": self.validation_eror["missing_values_in_base_dataset"],
+                "columns": list(summaries.keys()),
+                "summaries": summaries,
+            }
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def get_reference_profile(self, streaming:bool=False)->dict:
+        try:
+            base_file_hash = utils.get_file_hash(file_path=self.data_validation_config.base_file_path)
+            profile_file_name = f"{base_file_hash}.sketch.pkl" if streaming else f"{base_file_hash}.pkl"
+            profile_path = os.path.join(self.data_validation_config.reference_profile_dir, profile_file_name)
+            if os.path.exists(profile_path):
+                reference_profile = utils.load_object(file_path=profile_path)
+                if reference_profile["missing_threshold"] == self.data_validation_config.missing_threshold and \
+                    reference_profile.get("sketch_size") == (self.data_validation_config.sketch_size if streaming else None):
+                    logging.info(f"Using cached reference profile : {profile_path}")
+                    self.validation_eror["missing_values_in_base_dataset"] = reference_profile["missing_values_in_base_dataset"]
+                    return reference_profile
+
+            logging.info(f"Compiling reference profile of base file : {self.data_validation_config.base_file_path}")
+            if streaming:
+                reference_profile = self.build_reference_sketch_profile(base_file_hash=base_file_hash)
+            else:
+                reference_profile = self.build_reference_profile(base_file_hash=base_file_hash)
+            utils.save_object(file_path=profile_path, obj=reference_profile)
+            return reference_profile
+        except Exception as e:
+            raise InsuranceException(e, sys)
 
-            exclude_columns = [TARGET_COLUMN]
-            base_df = utils.convert_columns_float(df=base_df, exclude_columns=exclude_columns)
-            train_df = utils.convert_columns_float(df=train_df, exclude_columns=exclude_columns)
-            test_df = utils.convert_columns_float(df=test_df, exclude_columns=exclude_columns)
 
-            logging.info(f"Is all required columns present in train dataframe")
-            train_df_columns_status = self.is_required_columns_exists(base_df=base_df, current_df=train_df, report_key_name="missing_columns_in_train_dataset")
-            logging.info(f"Is required columns is present in test dataframe")
-            test_df_columns_status = self.is_required_columns_exists(base_df=base_df, current_df=test_df, report_key_name="missing_columns_in_test_dataset")
+    def initiate_streaming_data_validation(self):
+        try:
+            #train and test files are streamed from disk
+            artifact_store.flush()
+            reference_profile = self.get_reference_profile(streaming=True)
+            base_df = pd.DataFrame(columns=reference_profile["columns"])
+            for split_name, file_path in [("train", self.data_ingestion_artifact.train_file_path), ("test", self.data_ingestion_artifact.test_file_path)]:
+                logging.info(f"Summarizing {split_name} dataframe in chunks of {self.data_validation_config.chunk_size}")
+                #columns are summarized with the kinds of the reference profile, whatever their first chunk holds
+                reference_categorical_columns = {column: isinstance(summary, CategoryCounter) for column, summary in reference_profile["summaries"].items()}
+                summaries, num_rows = self.summarize_file(file_path=file_path, categorical_columns=reference_categorical_columns)
+                summaries = self.drop_missing_values_summaries(summaries=summaries, num_rows=num_rows, report_key_name=f"missing_values_in_{split_name}_dataset")
+
+                logging.info(f"Is all required columns present in {split_name} dataframe")
+                current_df = pd.DataFrame(columns=list(summaries.keys()))
+                if self.is_required_columns_exists(base_df=base_df, current_df=current_df, report_key_name=f"missing_columns_in_{split_name}_dataset"):
+                    logging.info(f"As all columns present in {split_name} dataframe hence detecting data drift")
+                    self.data_drift_from_sketches(base_summaries=reference_profile["summaries"], current_summaries=summaries,
+                                                  report_key_name=f"data_drift_in_{split_name}_dataset")
+        except Exception as e:
+            raise InsuranceException(e, sys)
 
-            if train_df_columns_status:
-                logging.info(f"As all columns present in train dataframe hence detecting data drift ")
-                self.data_drift(base_df=base_df, current_df=train_df, report_key_name="data_drift_in_train_dataset")
-            if test_df_columns_status:
-                logging.info(f"As all columns present in test dataframe hence detecting data drift")
-                self.data_drift(base_df=base_df, current_df=test_df, report_key_name="data_drift_in_test_dataset")
 
+    def initiate_data_validation(self)->artifact_entity.DataValidationArtifact:
+        try:
+            if self.data_ingestion_artifact.profile_file_path is not None:
+                logging.info(f"Adding server side profile from data ingestion to the report")
+                self.validation_eror["server_side_profile"] = utils.read_yaml_file(file_path=self.data_ingestion_artifact.profile_file_path)
+            if self.data_validation_config.streaming:
+                self.initiate_streaming_data_validation()
+            else:
+                self.validate_in_memory()
 
             #write the report
             logging.info(f"Write report in yaml file")
@@ -136,3 +330,47 @@ class DataValidation:
         except Exception as e:
             raise InsuranceException(e, sys)
 
+
+    def get_validation_executor(self):
+        try:
+            #threads suit the numpy/scipy work that releases the GIL, processes the rest
+            if self.data_validation_config.validation_executor == "process":
+                return ProcessPoolExecutor(max_workers=self.data_validation_config.validation_workers)
+            return ThreadPoolExecutor(max_workers=self.data_validation_config.validation_workers)
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def prepare_current_dataframe(self, split_name:str, file_path:str)->pd.DataFrame:
+        try:
+            logging.info(f"Reading {split_name} dataframe")
+            current_df = artifact_store.load_dataframe(file_path=file_path)
+            logging.info(f"Dropping missing values columns from {split_name} dataframe")
+            current_df = self.drop_missing_values_columns(df=current_df, report_key_name=f"missing_values_in_{split_name}_dataset")
+            return utils.convert_columns_float(df=current_df, exclude_columns=[TARGET_COLUMN])
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def validate_in_memory(self):
+        try:
+            reference_profile = self.get_reference_profile()
+            base_df = pd.DataFrame(columns=reference_profile["columns"])
+            splits = [("train", self.data_ingestion_artifact.train_file_path), ("test", self.data_ingestion_artifact.test_file_path)]
+
+            #train and test are independent, they are read and checked for missing values side by side
+            with ThreadPoolExecutor(max_workers=min(self.data_validation_config.validation_workers, len(splits))) as executor:
+                current_dfs = list(executor.map(lambda split: self.prepare_current_dataframe(split_name=split[0], file_path=split[1]), splits))
+
+            drift_futures = []
+            with self.get_validation_executor() as executor:
+                for (split_name, _), current_df in zip(splits, current_dfs):
+                    logging.info(f"Is all required columns present in {split_name} dataframe")
+                    if self.is_required_columns_exists(base_df=base_df, current_df=current_df, report_key_name=f"missing_columns_in_{split_name}_dataset"):
+                        logging.info(f"As all columns present in {split_name} dataframe hence detecting data drift")
+                        drift_futures.append((split_name, self.submit_data_drift(reference_profile=reference_profile, current_df=current_df, executor=executor)))
+                for split_name, split_drift_futures in drift_futures:
+                    self.collect_data_drift(drift_futures=split_drift_futures, report_key_name=f"data_drift_in_{split_name}_dataset")
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
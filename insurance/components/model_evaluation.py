@@ -3,9 +3,9 @@ from insurance.entity import artifact_entity
 from insurance.exception import InsuranceException
 from insurance.logger import logging
 from insurance.predictor import ModelResolver
-from insurance.utils import load_object
-import os, sys
-import pandas as pd
+from insurance.artifact_store import artifact_store
+from insurance.encoder import encode_features
+import sys
 from insurance.config import TARGET_COLUMN
 from sklearn.metrics import r2_score
 
@@ -43,32 +43,30 @@ class ModelEvaluation:
             target_encoder_path=self.model_resolver.get_latest_target_encoder_path()
 
             logging.info(f'Previous trained object of transformer, model and target encoder')
-            transformer=load_object(file_path=transformer_path)
-            model=load_object(file_path=model_path)
-            target_encoder=load_object(file_path=target_encoder_path)
+            transformer=artifact_store.load_object(file_path=transformer_path)
+            model=artifact_store.load_object(file_path=model_path)
+            target_encoder=artifact_store.load_object(file_path=target_encoder_path)
 
             logging.info(f'Currently trained model objects')
-            current_transformer=load_object(file_path=self.data_transformation_artifact.transform_object_path)
-            current_model=load_object(file_path=self.model_trainer_artifact.model_path)
-            current_target_encoder=load_object(file_path=self.data_transformation_artifact.target_encoder_path)
+            current_transformer=artifact_store.load_object(file_path=self.data_transformation_artifact.transform_object_path)
+            current_model=artifact_store.load_object(file_path=self.model_trainer_artifact.model_path)
+            current_target_encoder=artifact_store.load_object(file_path=self.data_transformation_artifact.target_encoder_path)
 
-            test_df=pd.read_csv(self.data_ingestion_artifact.test_file_path)
+            test_df=artifact_store.load_dataframe(file_path=self.data_ingestion_artifact.test_file_path)
             target_df=test_df[TARGET_COLUMN]
             y_true=target_df
 
             input_feature_name=list(transformer.feature_names_in_)
-            for i in input_feature_name:
-                if test_df[i].dtypes == 'O':
-                    test_df[i]=target_encoder.fit_transform(test_df[i])
-
-            input_arr=transformer.transform(test_df[input_feature_name])
+            input_df=encode_features(encoder=target_encoder, df=test_df[input_feature_name])
+            input_arr=transformer.transform(input_df)
             y_pred=model.predict(input_arr)
             previous_model_score=r2_score(y_true=y_true, y_pred=y_pred)
             logging.info(f'Accuracy for previous trained model : {previous_model_score}')
 
 
             input_feature_name=list(current_transformer.feature_names_in_)
-            input_arr=current_transformer.transform(test_df[input_feature_name]) 
+            input_df=encode_features(encoder=current_target_encoder, df=test_df[input_feature_name])
+            input_arr=current_transformer.transform(input_df)
             y_pred=current_model.predict(input_arr)
             current_model_score=r2_score(y_true=y_true, y_pred=y_pred)
             logging.info(f'Accuracy for current trained model : {current_model_score}')  
@@ -1,10 +1,13 @@
 from insurance.entity.config_entity import ModelPusherConfig
-from insurance.entity.artifact_entity import DataTransformationArtifact, ModelTrainerArtifact, ModelPusherArtifact
+from insurance.entity.artifact_entity import DataTransformationArtifact, ModelTrainerArtifact, ModelExportArtifact, ModelPusherArtifact
 from insurance.logger import logging
 from insurance.exception import InsuranceException
-from insurance.predictor import ModelResolver
-from insurance.utils import load_object, save_object
-import os, sys
+from insurance.predictor import ModelResolver, FusedLinearPredictor
+from insurance.utils import link_file
+from insurance.artifact_store import artifact_store
+from insurance.bundle import save_bundle, read_bundle_file_header
+from insurance.blob_store import BlobStore
+import sys
 
 
 
@@ -24,30 +27,103 @@ class ModelPusher:
             raise InsuranceException(e, sys)
 
 
-    def initiate_model_pusher(self,)->ModelPusherArtifact:
+    def get_bundle_objects(self, transformer, model, target_encoder, fused_model=None)->tuple:
+        try:
+            #statistics are training state for warm starts and stay out of the bundle
+            objects={"transformer": transformer, "target_encoder": target_encoder, "model": model}
+            if fused_model is not None:
+                objects["fused_model"]=fused_model
+            schema={"feature_names": [str(name) for name in transformer.feature_names_in_],
+                    "model_name": self.model_trainer_artifact.best_model_name or type(model).__name__}
+            return objects, schema
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def export_model(self,)->ModelExportArtifact:
+        #copies transformer, model and target encoder into the pusher dir, does not depend on model evaluation
         try:
             #load object
             logging.info(f'Loading transformer, model and target encoder')
-            transformer=load_object(file_path=self.data_transformation_artifact.transform_object_path)
-            model=load_object(file_path=self.model_trainer_artifact.model_path)
-            target_encoder=load_object(file_path=self.data_transformation_artifact.target_encoder_path)
+            transformer=artifact_store.load_object(file_path=self.data_transformation_artifact.transform_object_path)
+            model=artifact_store.load_object(file_path=self.model_trainer_artifact.model_path)
+            target_encoder=artifact_store.load_object(file_path=self.data_transformation_artifact.target_encoder_path)
 
             #save pusher dir
             logging.info(f'Saving model into model pusher dir')
-            save_object(file_path=self.model_pusher_config.pusher_transformer_path, obj=transformer)
-            save_object(file_path=self.model_pusher_config.pusher_model_path, obj=model)
-            save_object(file_path=self.model_pusher_config.pusher_target_object_path, obj=target_encoder)
+            artifact_store.save_object(file_path=self.model_pusher_config.pusher_transformer_path, obj=transformer)
+            artifact_store.save_object(file_path=self.model_pusher_config.pusher_model_path, obj=model)
+            artifact_store.save_object(file_path=self.model_pusher_config.pusher_target_object_path, obj=target_encoder)
+
+            logging.info(f'Compiling transformer and model into a fused model')
+            fused_model_path=None
+            fused_model=FusedLinearPredictor.compile(transformer=transformer, model=model)
+            if fused_model is None:
+                logging.info(f'Transformer or model can not be fused, only transformer and model are pushed')
+            else:
+                max_abs_error=fused_model.check_parity(transformer=transformer, model=model, num_rows=self.model_pusher_config.fused_parity_rows)
+                logging.info(f'Fused model matches transformer and model, max absolute error : {max_abs_error}')
+                artifact_store.save_object(file_path=self.model_pusher_config.pusher_fused_model_path, obj=fused_model)
+                fused_model_path=self.model_pusher_config.pusher_fused_model_path
+            #sufficient statistics let the next run warm start from this model
+            statistics_path=None
+            if self.model_trainer_artifact.statistics_path is not None:
+                artifact_store.save_object(file_path=self.model_pusher_config.pusher_statistics_path, obj=artifact_store.load_object(file_path=self.model_trainer_artifact.statistics_path))
+                statistics_path=self.model_pusher_config.pusher_statistics_path
 
+            logging.info(f'Saving model bundle into model pusher dir')
+            objects, schema=self.get_bundle_objects(transformer=transformer, model=model, target_encoder=target_encoder, fused_model=fused_model)
+            save_bundle(file_path=self.model_pusher_config.pusher_bundle_path, objects=objects, schema=schema)
 
+            model_export_artifact=ModelExportArtifact(pusher_model_dir=self.model_pusher_config.pusher_model_dir,
+                                     transformer_path=self.model_pusher_config.pusher_transformer_path,
+                                     model_path=self.model_pusher_config.pusher_model_path,
+                                     target_encoder_path=self.model_pusher_config.pusher_target_object_path,
+                                     fused_model_path=fused_model_path, statistics_path=statistics_path,
+                                     bundle_path=self.model_pusher_config.pusher_bundle_path)
+            logging.info(f'Model Export Artifact : {model_export_artifact}')
+            return model_export_artifact
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def initiate_model_pusher(self, model_export_artifact:ModelExportArtifact=None)->ModelPusherArtifact:
+        try:
+            if model_export_artifact is None:
+                model_export_artifact=self.export_model()
+
+            #written straight to disk into a staging dir, the version only becomes visible to readers once it is published
             logging.info(f'Saving model into saved model dir')
-            transformer_path=self.model_resolver.get_latest_save_transformer_path()
-            model_path=self.model_resolver.get_latest_save_model_path()
-            target_encoder_path=self.model_resolver.get_latest_save_target_encoder_path()
+            version, staging_dir=self.model_resolver.allocate_version()
+            logging.info(f'Allocated version {version}, staging it in {staging_dir}')
+            try:
+                #the exported files are written behind, they have to be on disk before they are linked
+                artifact_store.flush()
+                #the version gets hard links to the exported files instead of a second serialisation, the pusher dir
+                #and the registry share one copy of every object and of the bundle
+                export_paths=[(model_export_artifact.transformer_path, self.model_resolver.get_latest_save_transformer_path(dir_path=staging_dir)),
+                              (model_export_artifact.model_path, self.model_resolver.get_latest_save_model_path(dir_path=staging_dir)),
+                              (model_export_artifact.target_encoder_path, self.model_resolver.get_latest_save_target_encoder_path(dir_path=staging_dir)),
+                              (model_export_artifact.fused_model_path, self.model_resolver.get_latest_save_fused_model_path(dir_path=staging_dir)),
+                              (model_export_artifact.statistics_path, self.model_resolver.get_latest_save_statistics_path(dir_path=staging_dir)),
+                              (model_export_artifact.bundle_path, self.model_resolver.get_latest_save_bundle_path(dir_path=staging_dir))]
+                for export_path, save_path in export_paths:
+                    if export_path is not None:
+                        link_file(src_file_path=export_path, dst_file_path=save_path)
 
-            save_object(file_path=transformer_path, obj=transformer)
-            save_object(file_path=model_path, obj=model)
-            save_object(file_path=target_encoder_path, obj=target_encoder)
+                if self.model_pusher_config.content_addressed_storage:
+                    blob_store=BlobStore(blob_dir=self.model_pusher_config.blob_dir)
+                    blob_store.intern_dir(dir_path=model_export_artifact.pusher_model_dir)
+                    blob_store.intern_dir(dir_path=staging_dir)
 
+                logging.info(f'Publishing model as version {version}')
+                self.model_resolver.publish_version(version=version, staging_dir=staging_dir,
+                    metadata={"r2_train_score": float(self.model_trainer_artifact.r2_train_score),
+                              "r2_test_score": float(self.model_trainer_artifact.r2_test_score),
+                              "model_name": read_bundle_file_header(file_path=model_export_artifact.bundle_path)["schema"]["model_name"]})
+            except Exception:
+                self.model_resolver.discard_version(staging_dir=staging_dir)
+                raise
 
             model_pusher_artifact=ModelPusherArtifact(pusher_model_dir=self.model_pusher_config.pusher_model_dir,
                                      saved_model_dir=self.model_pusher_config.saved_model_dir)
@@ -55,4 +131,4 @@ class ModelPusher:
             logging.info(f'Model Pusher Artifact : {model_pusher_artifact}')
             return model_pusher_artifact
         except Exception as e:
-            raise InsuranceException(e, sys)
\ No newline at end of file
+            raise InsuranceException(e, sys)
@@ -2,21 +2,144 @@ from insurance.entity import config_entity
 from insurance.entity import artifact_entity
 from insurance.logger import logging
 from insurance.exception import InsuranceException
-import os, sys
+import os, sys, time
+import queue
+import multiprocessing
+import importlib.util
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from sklearn.linear_model import LinearRegression
+from sklearn.model_selection import KFold
 from insurance import utils
+from insurance.artifact_store import artifact_store
+from insurance.predictor import ModelResolver
 from sklearn.metrics import r2_score
 
 
+def compute_chunk_statistics(file_path:str, start:int, stop:int)->dict:
+    #Z = [X, 1] so the intercept is solved with the coefficients, the last column of the array is the target
+    try:
+        arr = artifact_store.load_numpy_array_data(file_path=file_path, mmap_mode='r')[start:stop]
+        z = np.empty((arr.shape[0], arr.shape[1]), dtype=np.float64)
+        z[:, :-1], z[:, -1] = arr[:, :-1], 1.0
+        y = np.asarray(arr[:, -1], dtype=np.float64)
+        return {"n": int(arr.shape[0]), "ztz": z.T @ z, "zty": z.T @ y, "y_sum": float(y.sum()), "y_square_sum": float(y @ y)}
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def merge_statistics(statistics:dict, other:dict)->dict:
+    try:
+        return {key: statistics[key] + other[key] for key in statistics}
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def compute_statistics(file_path:str, chunk_size:int, workers:int=1, start_row:int=0)->dict:
+    try:
+        num_rows = artifact_store.load_numpy_array_data(file_path=file_path, mmap_mode='r').shape[0]
+        if num_rows <= start_row:
+            raise Exception(f'No rows found in {file_path} from row {start_row}')
+        starts = list(range(start_row, num_rows, chunk_size))
+        stops = [min(start + chunk_size, num_rows) for start in starts]
+        #workers only get the file path and a row range and open the array themselves
+        if workers > 1 and len(starts) > 1:
+            artifact_store.flush()
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                chunk_statistics = list(executor.map(compute_chunk_statistics, [file_path]*len(starts), starts, stops))
+        else:
+            chunk_statistics = [compute_chunk_statistics(file_path, start, stop) for start, stop in zip(starts, stops)]
+        statistics = chunk_statistics[0]
+        for other in chunk_statistics[1:]:
+            statistics = merge_statistics(statistics, other)
+        return statistics
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def solve_statistics(statistics:dict, ridge_alpha:float=0.0)->np.ndarray:
+    #normal equations, falling back to minimum norm least squares like LinearRegression when X'X is singular.
+    #Forming X'X squares the condition number of X, so the solve has lost all precision long before cond(X'X)
+    #reaches 1/eps, the cutoff is taken at 1/sqrt(eps)
+    try:
+        ztz = statistics["ztz"].copy()
+        ztz[np.arange(ztz.shape[0] - 1), np.arange(ztz.shape[0] - 1)] += ridge_alpha
+        if np.linalg.cond(ztz) < 1/np.sqrt(np.finfo(np.float64).eps):
+            try:
+                return np.linalg.solve(ztz, statistics["zty"])
+            except np.linalg.LinAlgError:
+                pass
+        logging.info(f"X'X is singular or ill conditioned, solving with lstsq")
+        return np.linalg.lstsq(ztz, statistics["zty"], rcond=None)[0]
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def r2_score_from_statistics(statistics:dict, weights:np.ndarray)->float:
+    #sum (y - Zw)^2 = y'y - 2 w'Z'y + w'Z'Zw and sum (y - mean)^2 = y'y - n mean^2
+    try:
+        residual_sum_of_squares = statistics["y_square_sum"] - 2*weights @ statistics["zty"] + weights @ statistics["ztz"] @ weights
+        total_sum_of_squares = statistics["y_square_sum"] - statistics["y_sum"]**2/statistics["n"]
+        return float(1 - residual_sum_of_squares/total_sum_of_squares)
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def build_linear_regression(weights:np.ndarray)->LinearRegression:
+    try:
+        lr = LinearRegression()
+        lr.coef_ = weights[:-1].copy()
+        lr.intercept_ = float(weights[-1])
+        lr.n_features_in_ = weights.shape[0] - 1
+        return lr
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+
+#package each search candidate needs, candidates whose package is not installed are skipped
+SEARCH_CANDIDATE_PACKAGES = {"linear_regression": "sklearn", "ridge": "sklearn", "gradient_boosting": "sklearn", "xgboost": "xgboost"}
+
+
+def get_search_estimator(name:str, params:dict):
+    try:
+        if name == "linear_regression":
+            return LinearRegression(**params)
+        if name == "ridge":
+            from sklearn.linear_model import Ridge
+            return Ridge(**params)
+        if name == "gradient_boosting":
+            from sklearn.ensemble import GradientBoostingRegressor
+            return GradientBoostingRegressor(**params)
+        if name == "xgboost":
+            from xgboost import XGBRegressor
+            return XGBRegressor(**params)
+        raise Exception(f'Unknown search candidate : {name}')
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def evaluate_fold(file_path:str, name:str, params:dict, num_folds:int, fold:int)->float:
+    #runs in a worker process, the array is opened from its memory mapped file instead of being pickled
+    try:
+        arr = utils.load_numpy_array_data(file_path=file_path, mmap_mode='r')
+        train_index, test_index = list(KFold(n_splits=num_folds, shuffle=True, random_state=42).split(np.empty((arr.shape[0], 0))))[fold]
+        estimator = get_search_estimator(name=name, params=params)
+        estimator.fit(arr[train_index, :-1], arr[train_index, -1])
+        return float(r2_score(y_true=arr[test_index, -1], y_pred=estimator.predict(arr[test_index, :-1])))
+    except Exception as e:
+        raise InsuranceException(e, sys)
 
 
 class ModelTrainer:
     def __init__(self, model_trainer_config:config_entity.ModelTrainerConfig,
-                data_transformation_artifact:artifact_entity.DataTransformationArtifact):
+                data_transformation_artifact:artifact_entity.DataTransformationArtifact,
+                data_ingestion_artifact:artifact_entity.DataIngestionArtifact=None):
         try:
             logging.info(f"{'>>'*20} Model Trainer {'<<'*20}")
             self.model_trainer_config = model_trainer_config
             self.data_transformation_artifact= data_transformation_artifact
+            self.data_ingestion_artifact = data_ingestion_artifact
         except Exception as e:
             raise InsuranceException(e, sys)
 
@@ -30,11 +153,192 @@ class ModelTrainer:
             raise InsuranceException(e, sys)
 
 
-    def initiate_model_trainer(self,)->artifact_entity.ModelTrainerArtifact:
+    def load_warm_start_state(self)->dict:
+        #with hash split, train and test rows are written partition by partition in manifest order, so the rows
+        #of the latest saved model are a prefix of both arrays when its partitions are a prefix of the current ones
+        try:
+            partition_file_paths = None if self.data_ingestion_artifact is None else self.data_ingestion_artifact.partition_file_paths
+            if partition_file_paths is None or self.data_ingestion_artifact.split_mode != "hash":
+                logging.info(f'Warm start needs incremental ingestion with hash split, training on all rows')
+                return None
+            model_resolver = ModelResolver(model_registry=self.model_trainer_config.saved_model_dir)
+            statistics_path = model_resolver.get_latest_statistics_path()
+            if statistics_path is None:
+                logging.info(f'Latest saved model has no statistics, training on all rows')
+                return None
+            state = utils.load_object(file_path=statistics_path)
+            partitions = [os.path.basename(partition_file_path) for partition_file_path in partition_file_paths]
+            if state["partitions"] is None or partitions[:len(state["partitions"])] != state["partitions"]:
+                logging.info(f'Partitions of latest saved model are not a prefix of current partitions, training on all rows')
+                return None
+            artifact_store.flush()
+            if utils.get_file_hash(model_resolver.get_latest_transformer_path()) != utils.get_file_hash(self.data_transformation_artifact.transform_object_path):
+                logging.info(f'Transformer differs from the one of latest saved model, training on all rows')
+                return None
+            logging.info(f'Warm starting from {statistics_path} trained on {len(state["partitions"])} partitions')
+            return state
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def fold_statistics(self, file_path:str, statistics:dict)->dict:
+        #adds the rows after the first statistics["n"] rows of the array, all rows when statistics is None
+        try:
+            start_row = 0 if statistics is None else statistics["n"]
+            num_rows = artifact_store.load_numpy_array_data(file_path=file_path, mmap_mode='r').shape[0]
+            if num_rows < start_row:
+                raise Exception(f'{file_path} has {num_rows} rows but warm start statistics have {start_row}')
+            if num_rows == start_row:
+                return statistics
+            new_statistics = compute_statistics(file_path=file_path, chunk_size=self.model_trainer_config.chunk_size,
+                workers=self.model_trainer_config.statistics_workers, start_row=start_row)
+            return new_statistics if statistics is None else merge_statistics(statistics, new_statistics)
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def train_from_statistics(self):
+        try:
+            state = self.load_warm_start_state() if self.model_trainer_config.warm_start else None
+            logging.info(f'Accumulating sufficient statistics of train and test array')
+            train_statistics = self.fold_statistics(file_path=self.data_transformation_artifact.transformed_train_path,
+                statistics=None if state is None else state["statistics"])
+            test_statistics = self.fold_statistics(file_path=self.data_transformation_artifact.transformed_test_path,
+                statistics=None if state is None else state["test_statistics"])
+
+            logging.info(f'Solving normal equations from {train_statistics["n"]} train rows')
+            weights = solve_statistics(statistics=train_statistics, ridge_alpha=self.model_trainer_config.ridge_alpha)
+            model = build_linear_regression(weights=weights)
+
+            if state is not None and self.model_trainer_config.warm_start_parity_check:
+                logging.info(f'Checking warm started model against a model trained on all rows')
+                full_weights = solve_statistics(statistics=self.fold_statistics(file_path=self.data_transformation_artifact.transformed_train_path, statistics=None),
+                    ridge_alpha=self.model_trainer_config.ridge_alpha)
+                if not np.allclose(weights, full_weights, rtol=1e-6, atol=1e-8*np.abs(full_weights).max()):
+                    raise Exception(f'Warm started model does not match full retrain, max weight difference : {np.abs(weights - full_weights).max()}')
+
+            logging.info(f'Calculating r2 score for train and test data from the statistics')
+            r2_train_score = r2_score_from_statistics(statistics=train_statistics, weights=weights)
+            r2_test_score = r2_score_from_statistics(statistics=test_statistics, weights=weights)
+
+            partition_file_paths = None if self.data_ingestion_artifact is None else self.data_ingestion_artifact.partition_file_paths
+            partitions = None
+            if partition_file_paths is not None and self.data_ingestion_artifact.split_mode == "hash":
+                partitions = [os.path.basename(partition_file_path) for partition_file_path in partition_file_paths]
+            artifact_store.save_object(file_path=self.model_trainer_config.statistics_path,
+                obj={"statistics": train_statistics, "test_statistics": test_statistics, "partitions": partitions})
+            return model, r2_train_score, r2_test_score
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def search_model(self)->list:
+        #every fold of every candidate is one task, results are collected as they finish so candidates can be
+        #dropped early and the search stops at the time budget with the candidates that finished all folds
+        try:
+            config = self.model_trainer_config
+            file_path = self.data_transformation_artifact.transformed_train_path
+            candidates = []
+            for name, grid in config.search_candidates.items():
+                if importlib.util.find_spec(SEARCH_CANDIDATE_PACKAGES.get(name, name)) is None:
+                    logging.info(f'Skipping search candidate {name}, its package is not installed')
+                    continue
+                candidates.extend({"name": name, "params": params, "scores": [], "status": "running"} for params in grid)
+
+            #workers open the train array from disk
+            artifact_store.flush()
+            deadline = time.perf_counter() + config.search_time_budget
+            tasks = [(candidate, fold) for candidate in candidates for fold in range(config.search_folds)]
+            results = queue.Queue()
+            running = 0
+            pool = multiprocessing.Pool(processes=config.search_workers)
+            try:
+                next_task = 0
+                while True:
+                    #folds are handed to the pool only as workers free up, folds of a candidate that was stopped
+                    #early or failed are never started
+                    while running < config.search_workers and next_task < len(tasks):
+                        candidate, fold = tasks[next_task]
+                        next_task += 1
+                        if candidate["status"] != "running":
+                            continue
+                        pool.apply_async(evaluate_fold, (file_path, candidate["name"], candidate["params"], config.search_folds, fold),
+                                         callback=lambda score, candidate=candidate: results.put((candidate, score, None)),
+                                         error_callback=lambda error, candidate=candidate: results.put((candidate, None, error)))
+                        running += 1
+                    if running == 0:
+                        break
+                    try:
+                        candidate, score, error = results.get(timeout=max(deadline - time.perf_counter(), 0))
+                    except queue.Empty:
+                        logging.info(f'Search time budget of {config.search_time_budget} seconds is over')
+                        break
+                    running -= 1
+                    if candidate["status"] != "running":
+                        continue
+                    if error is not None:
+                        #one failing candidate does not end the search, it is left out of it
+                        candidate["status"] = "failed"
+                        logging.info(f'{candidate["name"]} {candidate["params"]} failed and is left out of the search : {error}')
+                        continue
+                    candidate["scores"].append(score)
+                    if len(candidate["scores"]) == config.search_folds:
+                        candidate["status"] = "finished"
+                        logging.info(f'{candidate["name"]} {candidate["params"]} : mean r2 {np.mean(candidate["scores"])}')
+
+                    finished_scores = [np.mean(candidate["scores"]) for candidate in candidates if candidate["status"] == "finished"]
+                    best_score = max(finished_scores) if len(finished_scores) > 0 else None
+                    for candidate in candidates:
+                        if (candidate["status"] == "running" and best_score is not None and len(candidate["scores"]) >= config.search_early_stopping_min_folds
+                                and np.mean(candidate["scores"]) < best_score - config.search_early_stopping_margin):
+                            candidate["status"] = "stopped early"
+                            logging.info(f'Stopping {candidate["name"]} {candidate["params"]} early at mean r2 {np.mean(candidate["scores"])}')
+            finally:
+                #folds still running past the budget are killed, so no worker keeps using CPU during the refit of the best candidate
+                if running > 0:
+                    logging.info(f'Terminating search workers with {running} folds still running')
+                    pool.terminate()
+                else:
+                    pool.close()
+                pool.join()
+
+            leaderboard = []
+            for candidate in candidates:
+                status = "timed out" if candidate["status"] == "running" else candidate["status"]
+                leaderboard.append({"name": candidate["name"], "params": candidate["params"], "status": status, "folds": len(candidate["scores"]),
+                                    "mean_r2": float(np.mean(candidate["scores"])) if len(candidate["scores"]) > 0 else None,
+                                    "std_r2": float(np.std(candidate["scores"])) if len(candidate["scores"]) > 0 else None})
+            leaderboard.sort(key=lambda entry: (entry["status"] != "finished", -(entry["mean_r2"] if entry["mean_r2"] is not None else -np.inf)))
+            if len(leaderboard) == 0 or leaderboard[0]["status"] != "finished":
+                raise Exception(f'No search candidate finished all {config.search_folds} folds within {config.search_time_budget} seconds')
+            return leaderboard
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def train_searched_model(self):
+        try:
+            logging.info(f'Searching model with {self.model_trainer_config.search_folds} fold cross validation')
+            leaderboard = self.search_model()
+            best_model_name, best_model_params = leaderboard[0]["name"], leaderboard[0]["params"]
+            logging.info(f'Best model : {best_model_name} {best_model_params} with mean r2 {leaderboard[0]["mean_r2"]}')
+
+            train_arr = artifact_store.load_numpy_array_data(file_path=self.data_transformation_artifact.transformed_train_path, mmap_mode='r')
+            test_arr = artifact_store.load_numpy_array_data(file_path=self.data_transformation_artifact.transformed_test_path, mmap_mode='r')
+            model = get_search_estimator(name=best_model_name, params=best_model_params)
+            model.fit(train_arr[:, :-1], train_arr[:, -1])
+            r2_train_score = r2_score(y_true=train_arr[:, -1], y_pred=model.predict(train_arr[:, :-1]))
+            r2_test_score = r2_score(y_true=test_arr[:, -1], y_pred=model.predict(test_arr[:, :-1]))
+            return model, r2_train_score, r2_test_score, leaderboard
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def train_in_memory(self):
         try:
             logging.info(f'Loading train and test array')
-            train_arr = utils.load_numpy_array_data(file_path=self.data_transformation_artifact.transformed_train_path)
-            test_arr = utils.load_numpy_array_data(file_path=self.data_transformation_artifact.transformed_test_path)
+            train_arr = artifact_store.load_numpy_array_data(file_path=self.data_transformation_artifact.transformed_train_path, mmap_mode='r')
+            test_arr = artifact_store.load_numpy_array_data(file_path=self.data_transformation_artifact.transformed_test_path, mmap_mode='r')
 
             logging.info(f'Splitting input and target feature from both train and test array. ')
             x_train, y_train = train_arr[:, :-1], train_arr[:, -1]
@@ -51,6 +355,23 @@ class ModelTrainer:
             yhat_test = model.predict(x_test)
             r2_test_score =  r2_score(y_true=y_test, y_pred=yhat_test)
 
+            return model, r2_train_score, r2_test_score
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+    def initiate_model_trainer(self,)->artifact_entity.ModelTrainerArtifact:
+        try:
+            statistics_path = None
+            leaderboard = None
+            if self.model_trainer_config.model_search:
+                model, r2_train_score, r2_test_score, leaderboard = self.train_searched_model()
+            elif self.model_trainer_config.sufficient_statistics or self.model_trainer_config.warm_start:
+                model, r2_train_score, r2_test_score = self.train_from_statistics()
+                statistics_path = self.model_trainer_config.statistics_path
+            else:
+                model, r2_train_score, r2_test_score = self.train_in_memory()
+
             logging.info(f'train score : {r2_train_score} and test score : {r2_test_score}')
             logging.info(f'Checking if our model is underfitted or not')
             if r2_test_score < self.model_trainer_config.expected_score:
@@ -63,11 +384,14 @@ class ModelTrainer:
                 raise Exception(f'Train and test score difference : {diff} is more than overfitting threshold : {self.model_trainer_config.overfitting_threshold}')
 
             logging.info(f'Saving model object')
-            utils.save_object(file_path=self.model_trainer_config.model_path, obj=model)
+            artifact_store.save_object(file_path=self.model_trainer_config.model_path, obj=model)
 
             logging.info(f'Preparing the artifact')
             model_trainer_artifact = artifact_entity.ModelTrainerArtifact(model_path=self.model_trainer_config.model_path,
-            r2_train_score=r2_train_score, r2_test_score=r2_test_score)
+            r2_train_score=r2_train_score, r2_test_score=r2_test_score, statistics_path=statistics_path,
+            best_model_name=None if leaderboard is None else leaderboard[0]["name"],
+            best_model_params=None if leaderboard is None else leaderboard[0]["params"],
+            leaderboard=leaderboard)
 
             logging.info(f'Model trainer artifact : {model_trainer_artifact}')
             return model_trainer_artifact
@@ -1,16 +1,33 @@
-import pymongo
-import os, sys
-import json
-import pandas as pd
-import numpy as np
+import os
+import threading
 from dataclasses import dataclass
 
 @dataclass
 class EnvironmentVariable:
     mongo_db_url:str = os.getenv("MONGO_DB_URL")
+    mongo_max_pool_size:int = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
 
 
 env_var = EnvironmentVariable()
-mongo_client = pymongo.MongoClient(env_var.mongo_db_url)
-print(env_var.mongo_db_url)
-TARGET_COLUMN = "expenses"
\ No newline at end of file
+TARGET_COLUMN = "expenses"
+
+_mongo_client = None
+_mongo_client_lock = threading.Lock()
+
+
+def get_mongo_client():
+    #pymongo is only imported, and the pooled client only created, the first time a component needs mongo
+    global _mongo_client
+    if _mongo_client is None:
+        with _mongo_client_lock:
+            if _mongo_client is None:
+                import pymongo
+                _mongo_client = pymongo.MongoClient(env_var.mongo_db_url, maxPoolSize=env_var.mongo_max_pool_size)
+    return _mongo_client
+
+
+def __getattr__(name:str):
+    #keeps `from insurance.config import mongo_client` working for scripts written against the old module
+    if name == "mongo_client":
+        return get_mongo_client()
+    raise AttributeError(f"module {__name__} has no attribute {name}")
@@ -0,0 +1,43 @@
+import pandas as pd
+
+#code given to missing values and to categories that were not seen while fitting
+UNKNOWN_CATEGORY_CODE = -1
+
+
+class CategoricalEncoder:
+    #one sorted category index per column, fitted once at training time and pickled with the model.
+    #transform is a vectorized hash lookup, codes match LabelEncoder for the categories seen in fit
+    def __init__(self, columns:list=None):
+        self.columns = columns
+        self.categories_ = dict()
+
+    def partial_fit(self, df:pd.DataFrame)->"CategoricalEncoder":
+        columns = self.columns if self.columns is not None else [column for column in df.columns if df[column].dtype == 'O']
+        for column in columns:
+            categories = set(self.categories_.get(column, pd.Index([])).tolist())
+            categories.update(df[column].dropna().unique().tolist())
+            self.categories_[column] = pd.Index(sorted(categories))
+        return self
+
+    def fit(self, df:pd.DataFrame)->"CategoricalEncoder":
+        self.categories_ = dict()
+        return self.partial_fit(df)
+
+    def transform(self, df:pd.DataFrame)->pd.DataFrame:
+        #get_indexer returns -1 (UNKNOWN_CATEGORY_CODE) for missing and unseen values
+        codes = {column: categories.get_indexer(df[column]) for column, categories in self.categories_.items() if column in df.columns}
+        return df.assign(**codes)
+
+    def fit_transform(self, df:pd.DataFrame)->pd.DataFrame:
+        return self.fit(df).transform(df)
+
+
+def encode_features(encoder, df:pd.DataFrame)->pd.DataFrame:
+    if isinstance(encoder, CategoricalEncoder):
+        return encoder.transform(df)
+    #registry versions pushed before CategoricalEncoder hold one LabelEncoder that is refitted per column
+    df = df.copy()
+    for column in df.columns:
+        if df[column].dtypes == 'O':
+            df[column] = encoder.fit_transform(df[column])
+    return df
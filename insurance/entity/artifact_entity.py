@@ -5,6 +5,12 @@ class DataIngestionArtifact:
     feature_store_file_path:str
     train_file_path:str
     test_file_path:str
+    ingested_rows:int=None
+    rows_per_second:float=None
+    new_partition_file_path:str=None
+    profile_file_path:str=None
+    partition_file_paths:list=None
+    split_mode:str=None
 
 @dataclass
 class DataValidationArtifact:
@@ -22,6 +28,10 @@ class ModelTrainerArtifact:
     model_path:str
     r2_train_score:float
     r2_test_score:float
+    statistics_path:str=None
+    best_model_name:str=None
+    best_model_params:dict=None
+    leaderboard:list=None
 
 @dataclass
 class ModelEvaluationArtifact:
@@ -29,6 +39,17 @@ class ModelEvaluationArtifact:
     improved_accuracy:float
 
 
+@dataclass
+class ModelExportArtifact:
+    pusher_model_dir:str
+    transformer_path:str
+    model_path:str
+    target_encoder_path:str
+    fused_model_path:str=None
+    statistics_path:str=None
+    bundle_path:str=None
+
+
 @dataclass
 class ModelPusherArtifact:
     pusher_model_dir:str
@@ -9,6 +9,12 @@ TEST_FILE_NAME = "test.csv"
 TRANSFORMER_OBJECT_FILE_NAME = "transformer.pkl"
 TARGET_OBJECT_FILE_NAME = "target.pkl"
 MODEL_FILE_NAME = "model.pkl"
+FUSED_MODEL_FILE_NAME = "fused_model.pkl"
+STATISTICS_FILE_NAME = "statistics.pkl"
+BUNDLE_FILE_NAME = "model.bundle"
+BLOB_DIR_NAME = ".blobs"
+#stage runs of a training run, written into its artifact dir once the run is over
+PIPELINE_RUN_FILE_NAME = "pipeline_run.yaml"
 
 
 
@@ -17,6 +23,20 @@ class TrainingPipelineConfig:
     def __init__(self):
         try:
             self.artifact_dir = os.path.join(os.getcwd(),"artifact",f"{datetime.now().strftime('%m%d%Y__%H%M%S')}")
+            #stages whose inputs did not change since an earlier run reuse that run's artifact. Off by default : the
+            #ingestion fingerprint is a server side profile of the collection plus its max watermark, which costs an
+            #extra aggregation and sort per run and does not notice in place edits that keep that profile unchanged
+            self.stage_cache = False
+            self.stage_cache_dir = "stage_cache"
+            #stages run as soon as their dependencies are done, in a thread or process pool
+            self.pipeline_executor = "thread"
+            self.pipeline_workers = 4
+            #stages hand artifacts to each other in memory and files are written by a background thread. Every
+            #artifact of the run stays in memory until the run ends, so it is off by default and not meant for the
+            #chunked and streaming modes that keep data out of memory
+            self.in_memory_artifacts = False
+            #apply the retention policy of RetentionConfig once the run is done, it can also be run with python -m insurance.retention
+            self.retention = False
         except Exception as e:
             raise InsuranceException(e, sys)
 
@@ -30,6 +50,34 @@ class DataIngestionConfig:
             self.train_file_path = os.path.join(self.data_ingestion_dir, "database", TRAIN_FILE_NAME)
             self.test_file_path = os.path.join(self.data_ingestion_dir, "database", TEST_FILE_NAME)
             self.test_size = 0.2
+            #documents per cursor round-trip, set to None to load the collection in a single list
+            self.batch_size = 10000
+            #number of ranges of partition_field read concurrently, 1 keeps a single cursor
+            self.num_partitions = 1
+            self.partition_field = "_id"
+            #incremental mode only fetches documents newer than the stored watermark and appends
+            #them as a new partition of a feature store that is kept across training runs. The train and test
+            #split is still written from all partitions
+            self.incremental = False
+            self.watermark_field = "_id"
+            self.partitioned_feature_store_dir = os.path.join("feature_store", self.collection_name)
+            #"csv" or "npy", npy stores every dataframe as a directory of memory mapped columns plus a schema file
+            self.file_format = "csv"
+            #write csv copies next to the npy dataframes
+            self.export_csv = False
+            #"random" uses train_test_split, "hash" assigns every row by a stable hash of split_key_columns
+            #(the whole row when None) so the test set stays the same as rows are added
+            self.split_mode = "random"
+            self.split_key_columns = None
+            self.split_chunk_size = 100000
+            #server side profile of the documents about to be exported, the load is rejected when it is
+            #empty or a field has more missing values than preflight_missing_threshold. Costs one aggregation over the
+            #exported documents, off by default
+            self.preflight_profile = False
+            self.preflight_numeric_fields = ["age", "bmi", "children", "expenses"]
+            self.preflight_categorical_fields = ["sex", "smoker", "region"]
+            self.preflight_missing_threshold = 0.5
+            self.profile_file_path = os.path.join(self.data_ingestion_dir, "profile.yaml")
         except Exception as e:
             raise InsuranceException(e, sys)
 
@@ -48,6 +96,17 @@ class DataValidationConfig:
             self.report_file_path = os.path.join(self.data_validation_dir, "report.yaml")
             self.missing_threshold:float = 0.2
             self.base_file_path = os.path.join("insurance.txt")
+            #compiled profile of the base file, reused by every run until the base file content changes
+            self.reference_profile_dir = os.path.join("reference_profile")
+            #streaming validation reads the data chunk by chunk into mergeable quantile sketches and
+            #category counts, drift p-values are then approximate and reported with an error bound
+            self.streaming = False
+            self.chunk_size = 100000
+            self.sketch_size = 2000
+            self.sketch_workers = 1
+            #workers for the per split missing value checks and per column drift tests, "thread" or "process"
+            self.validation_workers = 1
+            self.validation_executor = "thread"
     except Exception as e:
         raise InsuranceException(e, sys)
         
@@ -60,6 +119,18 @@ class DataTransformationConfig:
             self.transformed_train_path = os.path.join(self.data_transformation_dir, "transformed", TRAIN_FILE_NAME.replace("csv", "npz"))
             self.transformed_test_path = os.path.join(self.data_transformation_dir, "transformed", TEST_FILE_NAME.replace("csv", "npz"))
             self.target_encoder_path = os.path.join(self.data_transformation_dir, "target_encoder", TARGET_OBJECT_FILE_NAME)
+            self.categorical_columns = ["sex", "smoker", "region"]
+            #chunked fits the transformer in one streaming pass and writes the transformed arrays chunk by chunk
+            #into preallocated memory mapped files, for train sets that do not fit in memory several times over
+            self.chunked = False
+            self.chunk_size = 100000
+            #quantile sketch size used for the RobustScaler median and IQR of numeric columns in chunked mode
+            self.sketch_size = 2000
+            #reuse_preprocessing transforms with the encoder and transformer of the latest saved model instead of
+            #refitting them, so sufficient statistics of that model stay valid for warm start training. The whole
+            #train and test split is still transformed, not only the rows of new partitions
+            self.reuse_preprocessing = False
+            self.saved_model_dir = os.path.join("saved_models")
     except Exception as e:
         raise InsuranceException(e, sys)
 
@@ -71,6 +142,37 @@ class ModelTrainerConfig:
             self.model_path = os.path.join(self.model_trainer_dir, "model", MODEL_FILE_NAME)
             self.expected_score = 0.7
             self.overfitting_threshold = 0.1
+            #sufficient_statistics trains the linear model from X'X, X'y and the target moments, accumulated
+            #chunk by chunk over the memory mapped arrays in a process pool, memory is O(features^2) not O(rows)
+            self.sufficient_statistics = False
+            self.chunk_size = 100000
+            self.statistics_workers = 1
+            #added to the diagonal of X'X (not the intercept), 0 solves plain least squares
+            self.ridge_alpha = 0.0
+            self.statistics_path = os.path.join(self.model_trainer_dir, "statistics", STATISTICS_FILE_NAME)
+            #warm_start folds only the rows ingested since the latest saved model into its statistics, it needs
+            #incremental ingestion with hash split and reuse_preprocessing, otherwise it trains on all rows. Only the
+            #training is incremental : ingestion still writes the train and test split of every partition and
+            #transformation transforms all of them, so a run still costs time proportional to the whole history
+            self.warm_start = False
+            #also solves from all rows and fails if the warm started model does not match
+            self.warm_start_parity_check = False
+            self.saved_model_dir = os.path.join("saved_models")
+            #model_search picks the model by k-fold cross validation of the candidates below in a process pool,
+            #workers read the memory mapped train array themselves. Candidates whose package is missing are skipped.
+            self.model_search = False
+            self.search_candidates = {
+                "linear_regression": [{}],
+                "ridge": [{"alpha": alpha} for alpha in [0.1, 1.0, 10.0]],
+                "gradient_boosting": [{"n_estimators": 200, "max_depth": max_depth, "learning_rate": 0.05, "random_state": 42} for max_depth in [2, 3]],
+                "xgboost": [{"n_estimators": 200, "max_depth": max_depth, "learning_rate": 0.05, "random_state": 42} for max_depth in [3, 5]]}
+            self.search_folds = 5
+            self.search_workers = 4
+            #wall clock budget of the whole search in seconds, folds not started by then are cancelled
+            self.search_time_budget = 300
+            #a candidate is dropped once the mean r2 of its first folds is this far below the best finished candidate
+            self.search_early_stopping_margin = 0.05
+            self.search_early_stopping_min_folds = 2
     except Exception as e:
         raise InsuranceException(e, sys)
 
@@ -91,7 +193,31 @@ class ModelPusherConfig:
         self.pusher_model_path=os.path.join(self.pusher_model_dir, MODEL_FILE_NAME)
         self.pusher_transformer_path=os.path.join(self.pusher_model_dir, TRANSFORMER_OBJECT_FILE_NAME)
         self.pusher_target_object_path=os.path.join(self.pusher_model_dir, TARGET_OBJECT_FILE_NAME)
-
-
-
-
+        self.pusher_fused_model_path=os.path.join(self.pusher_model_dir, FUSED_MODEL_FILE_NAME)
+        self.pusher_statistics_path=os.path.join(self.pusher_model_dir, STATISTICS_FILE_NAME)
+        #transformer, target encoder, model and fused model in one checksummed file that loads with a single read
+        self.pusher_bundle_path=os.path.join(self.pusher_model_dir, BUNDLE_FILE_NAME)
+        #pushed files are hard links into content addressed blobs, identical objects across the pusher dir and
+        #registry versions are stored once
+        self.content_addressed_storage=True
+        self.blob_dir=os.path.join(self.saved_model_dir, BLOB_DIR_NAME)
+        #number of random rows the fused model is checked against transformer + model before it is pushed
+        self.fused_parity_rows=1000
+
+
+class RetentionConfig:
+    def __init__(self, training_pipeline_config:TrainingPipelineConfig):
+        self.artifact_root_dir=os.path.dirname(training_pipeline_config.artifact_dir)
+        self.saved_model_dir=os.path.join("saved_models")
+        self.blob_dir=os.path.join(self.saved_model_dir, BLOB_DIR_NAME)
+        self.stage_cache_dir=training_pipeline_config.stage_cache_dir
+        #registry versions and artifact runs beyond the newest ones are removed, the live version never is
+        self.keep_last_versions=5
+        self.keep_last_runs=5
+        #versions and runs older than this are removed even within keep_last, None keeps them
+        self.max_age_days=None
+        #kept runs older than the newest hot_runs are cold, their files are gzip compressed
+        self.hot_runs=1
+        self.compress_extensions=[".csv", ".npy", ".npz", ".pkl", ".parquet"]
+        #staging dirs of pushes that crashed, a running push is never this old
+        self.stale_staging_hours=24
@@ -23,3 +23,8 @@ class InsuranceException(Exception):
 
     def __repr__(self):
         return InsuranceException.__name__.__str__() 
+
+
+    def __reduce__(self):
+        #errors of worker processes are pickled back to the parent, the message is kept as it is
+        return (Exception.__new__, (InsuranceException,), self.__dict__)
@@ -2,8 +2,7 @@ from insurance.exception import InsuranceException
 from insurance.logger import logging
 import pandas as pd
 import numpy as np
-from insurance.predictor import ModelResolver
-from insurance.utils import load_object
+from insurance.predictor_cache import get_predictor_cache
 from datetime import datetime
 import os, sys
 PREDICTOR_DIR = 'prediction'
@@ -12,28 +11,15 @@ PREDICTOR_DIR = 'prediction'
 def start_batch_prediction(input_file_path):
     try:
         os.makedirs(PREDICTOR_DIR, exist_ok=True)
-        logging.info(f'Creating model resolver object')
-        model_resolver=ModelResolver(model_registry='saved_models')
         logging.info(f'Reading file : {input_file_path}')
         df=pd.read_csv(input_file_path)
         df.replace({'na' : np.NAN}, inplace=True)
 
-        logging.info(f'Loading transformer to transform dataset')
-        transformer=load_object(file_path=model_resolver.get_latest_transformer_path())
-        logging.info(f'Loading target encoder  to convert predicted column into categorical')
-        target_encoder=load_object(file_path=model_resolver.get_latest_target_encoder_path())
+        #loaded once per process and swapped in the background when a new version is pushed
+        predictor=get_predictor_cache(model_registry='saved_models').get()
+        logging.info(f'Making prediction with version {predictor.version}')
+        prediction=predictor.predict(df)
 
-        """We need to create label encoder object for each categorical variable. We will check later"""
-        input_feature_name=list(transformer.feature_names_in_)
-        for i in input_feature_name:
-            if df[i].dtypes == 'O':
-                df[i]=target_encoder.fit_transform(df[i])
-        input_arr=transformer.transform(df[input_feature_name])
-
-        logging.info(f'Loading model to make prediction')
-        model=load_object(file_path=model_resolver.get_latest_model_path())
-        prediction=model.predict(input_arr)
-        
         df['prediction']=prediction
 
         prediction_file_name=os.path.basename(input_file_path).replace(".txt",f"{datetime.now().strftime('%m%d%Y__%H%M%S')}.csv")
@@ -0,0 +1,106 @@
+import sys, time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from insurance.logger import logging
+from insurance.exception import InsuranceException
+
+
+def run_stage_function(stage_function, upstream_artifacts:dict, in_process:bool)->tuple:
+    #runs in the worker, start and end are wall clock times so stages of different processes line up
+    start_time = time.time()
+    try:
+        artifact = stage_function(upstream_artifacts)
+    except Exception as e:
+        if not in_process:
+            raise e
+        #InsuranceException can not be unpickled in the parent process, its message is passed on instead
+        raise Exception(str(e))
+    return start_time, time.time(), artifact
+
+
+class DAGExecutor:
+    #stages maps a stage name to (function, names of the stages it depends on). A function gets a dict with the
+    #artifacts of its dependencies and returns its own artifact, in process mode it has to be picklable.
+    #Stages run as soon as their dependencies are done, the first failure cancels every stage not started yet.
+    def __init__(self, stages:dict, executor:str="thread", max_workers:int=4):
+        try:
+            if executor not in ("thread", "process"):
+                raise Exception(f"Unknown executor : {executor}, expected thread or process")
+            self.stages = stages
+            self.executor = executor
+            self.max_workers = max_workers
+            self.stage_runs = {stage_name: {"status": "pending", "start_time": None, "end_time": None} for stage_name in stages}
+            self.check_graph()
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def check_graph(self):
+        try:
+            visited, visiting = set(), set()
+            def visit(stage_name, path):
+                if stage_name not in self.stages:
+                    raise Exception(f"Stage {path[-1]} depends on unknown stage {stage_name}")
+                if stage_name in visiting:
+                    raise Exception(f"Stages have a cycle : {' -> '.join(path + [stage_name])}")
+                if stage_name in visited:
+                    return
+                visiting.add(stage_name)
+                for dependency in self.stages[stage_name][1]:
+                    visit(dependency, path + [stage_name])
+                visiting.remove(stage_name)
+                visited.add(stage_name)
+            for stage_name in self.stages:
+                visit(stage_name, [])
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def run(self)->dict:
+        try:
+            artifacts = dict()
+            running = dict()
+            error = None
+            pool = ThreadPoolExecutor(max_workers=self.max_workers) if self.executor == "thread" else ProcessPoolExecutor(max_workers=self.max_workers)
+            try:
+                while error is None:
+                    for stage_name, (stage_function, dependencies) in self.stages.items():
+                        if self.stage_runs[stage_name]["status"] == "pending" and all(dependency in artifacts for dependency in dependencies):
+                            upstream_artifacts = {dependency: artifacts[dependency] for dependency in dependencies}
+                            future = pool.submit(run_stage_function, stage_function, upstream_artifacts, self.executor == "process")
+                            running[future] = stage_name
+                            self.stage_runs[stage_name]["status"] = "submitted"
+                    if len(running) == 0:
+                        break
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        stage_name = running.pop(future)
+                        stage_run = self.stage_runs[stage_name]
+                        try:
+                            stage_run["start_time"], stage_run["end_time"], artifacts[stage_name] = future.result()
+                            stage_run["status"] = "succeeded"
+                            logging.info(f"Stage {stage_name} finished in {stage_run['end_time'] - stage_run['start_time']:.2f} seconds")
+                        except Exception as e:
+                            stage_run["status"] = "failed"
+                            stage_run["end_time"] = time.time()
+                            logging.info(f"Stage {stage_name} failed, cancelling stages that have not started : {e}")
+                            error = error or e
+            finally:
+                #fail fast: queued stages are cancelled, stages already running are left to finish
+                for future, stage_name in running.items():
+                    if future.cancel():
+                        self.stage_runs[stage_name]["status"] = "cancelled"
+                pool.shutdown(wait=True, cancel_futures=True)
+            for future, stage_name in running.items():
+                if not future.cancelled():
+                    stage_run = self.stage_runs[stage_name]
+                    try:
+                        stage_run["start_time"], stage_run["end_time"], artifacts[stage_name] = future.result()
+                        stage_run["status"] = "succeeded"
+                    except Exception:
+                        stage_run["status"] = "failed"
+            for stage_run in self.stage_runs.values():
+                if stage_run["status"] == "pending":
+                    stage_run["status"] = "cancelled"
+            if error is not None:
+                raise error
+            return artifacts
+        except Exception as e:
+            raise InsuranceException(e, sys)
@@ -0,0 +1,199 @@
+import os, sys
+import json
+import hashlib
+from dataclasses import fields
+from typing import Optional
+from insurance.logger import logging
+from insurance.exception import InsuranceException
+from insurance import utils
+from insurance.artifact_store import artifact_store
+
+STAGE_CACHE_DIR = "stage_cache"
+#artifact fields with these suffixes hold paths, a cached artifact is only reused while they all exist
+PATH_FIELD_SUFFIXES = ("_path", "_dir", "_paths")
+
+
+def get_path_hash(path:str)->str:
+    #a file is hashed by content, a directory (columnar dataframe, partitioned feature store) by its relative file names and contents
+    try:
+        if os.path.isfile(path):
+            return utils.get_file_hash(file_path=path)
+        path_hash = hashlib.sha256()
+        for root, dir_names, file_names in os.walk(path):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                file_path = os.path.join(root, file_name)
+                path_hash.update(os.path.relpath(file_path, path).encode())
+                path_hash.update(utils.get_file_hash(file_path=file_path).encode())
+        return path_hash.hexdigest()
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def get_code_hash()->str:
+    #any change to the package source invalidates every stage
+    try:
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        code_hash = hashlib.sha256()
+        for root, dir_names, file_names in os.walk(package_dir):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                if file_name.endswith(".py"):
+                    file_path = os.path.join(root, file_name)
+                    code_hash.update(os.path.relpath(file_path, package_dir).encode())
+                    code_hash.update(utils.get_file_hash(file_path=file_path).encode())
+        return code_hash.hexdigest()
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def get_artifact_paths(artifact)->list:
+    paths = []
+    for field in fields(artifact):
+        value = getattr(artifact, field.name)
+        if field.name.endswith(PATH_FIELD_SUFFIXES) and value is not None:
+            paths.extend(value if isinstance(value, list) else [value])
+    return paths
+
+
+def get_missing_paths(artifact)->list:
+    return [path for path in get_artifact_paths(artifact=artifact) if not os.path.exists(path)]
+
+
+def get_cached_paths(cache_dir:str=STAGE_CACHE_DIR)->list:
+    #every path the entries of the stage cache refer to
+    try:
+        cached_paths = []
+        if not os.path.isdir(cache_dir):
+            return cached_paths
+        for stage_name in sorted(os.listdir(cache_dir)):
+            stage_dir = os.path.join(cache_dir, stage_name)
+            for file_name in sorted(os.listdir(stage_dir)):
+                if file_name.endswith(".pkl"):
+                    cached_paths.extend(get_artifact_paths(artifact=utils.load_object(file_path=os.path.join(stage_dir, file_name))))
+        return cached_paths
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def prune_stage_cache(cache_dir:str=STAGE_CACHE_DIR, dry_run:bool=False)->list:
+    #entries whose artifacts refer to removed or compressed files can never be reused
+    try:
+        removed_entries = []
+        if not os.path.isdir(cache_dir):
+            return removed_entries
+        for stage_name in sorted(os.listdir(cache_dir)):
+            stage_dir = os.path.join(cache_dir, stage_name)
+            for file_name in sorted(os.listdir(stage_dir)):
+                cache_path = os.path.join(stage_dir, file_name)
+                if file_name.endswith(".pkl") and len(get_missing_paths(artifact=utils.load_object(file_path=cache_path))) > 0:
+                    removed_entries.append(cache_path)
+                    if not dry_run:
+                        os.remove(cache_path)
+        logging.info(f"Removed {len(removed_entries)} stale stage cache entries from {cache_dir}")
+        return removed_entries
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+class StageCache:
+    #a stage is skipped when the fingerprint of its inputs (config values, content of upstream artifacts and
+    #input files, code version and any extra state such as the collection profile) matches an earlier run,
+    #its artifact from that run is reused by reference
+    def __init__(self, artifact_dir:str, cache_dir:str=STAGE_CACHE_DIR):
+        try:
+            self.artifact_dir = artifact_dir
+            self.cache_dir = cache_dir
+            self.code_hash = get_code_hash()
+            self.path_hashes = dict()
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def hash_path(self, path:str)->str:
+        try:
+            if path not in self.path_hashes:
+                self.path_hashes[path] = get_path_hash(path=path)
+            return self.path_hashes[path]
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def get_config_values(self, config)->dict:
+        #paths inside the timestamped artifact dir are made relative to it, input files outside it are hashed
+        try:
+            values = dict()
+            for name, value in vars(config).items():
+                if isinstance(value, str) and value.startswith(self.artifact_dir):
+                    value = os.path.relpath(value, self.artifact_dir)
+                elif isinstance(value, str) and os.path.isfile(value):
+                    value = {"path": value, "hash": self.hash_path(path=value)}
+                values[name] = value
+            return values
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def get_artifact_values(self, artifact)->dict:
+        try:
+            #artifacts are hashed from disk, so writes still queued behind have to land first
+            artifact_store.flush()
+            values = dict()
+            for field in fields(artifact):
+                value = getattr(artifact, field.name)
+                if field.name.endswith(PATH_FIELD_SUFFIXES) and value is not None:
+                    paths = value if isinstance(value, list) else [value]
+                    value = [self.hash_path(path=path) for path in paths]
+                values[field.name] = value
+            return values
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def get_fingerprint(self, stage_name:str, config=None, artifacts:Optional[list]=None, extra:Optional[dict]=None)->str:
+        try:
+            artifacts = [] if artifacts is None else artifacts
+            inputs = {"stage": stage_name,
+                      "code": self.code_hash,
+                      "config": None if config is None else self.get_config_values(config=config),
+                      "artifacts": [self.get_artifact_values(artifact=artifact) for artifact in artifacts],
+                      "extra": extra}
+            return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def get_cache_path(self, stage_name:str, fingerprint:str)->str:
+        return os.path.join(self.cache_dir, stage_name, f"{fingerprint}.pkl")
+
+    def get(self, stage_name:str, fingerprint:str):
+        try:
+            cache_path = self.get_cache_path(stage_name=stage_name, fingerprint=fingerprint)
+            if not os.path.exists(cache_path):
+                return None
+            artifact = utils.load_object(file_path=cache_path)
+            missing_paths = get_missing_paths(artifact=artifact)
+            if len(missing_paths) > 0:
+                logging.info(f"Cached {stage_name} artifact refers to removed paths {missing_paths}, running stage")
+                return None
+            return artifact
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def put(self, stage_name:str, fingerprint:str, artifact):
+        try:
+            #written to a temporary file and renamed so a crash never leaves a half written entry
+            cache_path = self.get_cache_path(stage_name=stage_name, fingerprint=fingerprint)
+            utils.save_object(file_path=f"{cache_path}.tmp", obj=artifact)
+            os.replace(f"{cache_path}.tmp", cache_path)
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def run_stage(self, stage_name:str, fingerprint:str, run_stage):
+        try:
+            artifact = self.get(stage_name=stage_name, fingerprint=fingerprint)
+            if artifact is not None:
+                logging.info(f"Skipping {stage_name}, reusing cached artifact {fingerprint[:12]} : {artifact}")
+                return artifact
+            artifact = run_stage()
+            #the entry is only recorded once the artifact's files are completely written
+            artifact_store.flush()
+            self.put(stage_name=stage_name, fingerprint=fingerprint, artifact=artifact)
+            return artifact
+        except Exception as e:
+            raise InsuranceException(e, sys)
@@ -1,62 +1,160 @@
 from insurance.logger import logging
 from insurance.exception import InsuranceException
 import os, sys
-from insurance.utils import get_collection_as_dataframe
+from functools import partial
+from insurance.utils import write_yaml_file
 from insurance.entity import config_entity
-from insurance.entity.config_entity import DataIngestionConfig
 from insurance.components.data_ingestion import DataIngestion
 from insurance.components.data_validation import DataValidation
 from insurance.components.data_transformation import DataTransformation
 from insurance.components.model_trainer import ModelTrainer
 from insurance.components.model_evaluation import ModelEvaluation
 from insurance.components.model_pusher import ModelPusher
+from insurance.pipeline.stage_cache import StageCache, get_path_hash
+from insurance.pipeline.dag import DAGExecutor
+from insurance.predictor import ModelResolver
+from insurance.artifact_store import artifact_store
+from insurance.retention import start_retention
 
+from insurance.entity.config_entity import PIPELINE_RUN_FILE_NAME
 
 
+def initiate_data_ingestion(config, upstream_artifacts:dict):
+    print(config.to_dict())
+    return DataIngestion(data_ingestion_config=config).initiate_data_ingestion()
 
-def start_training_pipeline():
 
-    try:
-        
-        training_pipeline_config = config_entity.TrainingPipelineConfig()
+def initiate_data_validation(config, upstream_artifacts:dict):
+    return DataValidation(data_validation_config=config, data_ingestion_artifact=upstream_artifacts["data_ingestion"]).initiate_data_validation()
+
 
-        # data ingestion config
-        data_ingestion_config = config_entity.DataIngestionConfig(training_pipeline_config = training_pipeline_config)
-        print(data_ingestion_config.to_dict())
-        data_ingestion = DataIngestion(data_ingestion_config=data_ingestion_config)
-        data_ingestion_artifact = data_ingestion.initiate_data_ingestion()
+def initiate_data_transformation(config, upstream_artifacts:dict):
+    return DataTransformation(data_transformation_config=config, data_ingestion_artifact=upstream_artifacts["data_ingestion"]).initiate_data_transformation()
 
-        #data validation config
 
-        data_validation_config = config_entity.DataValidationConfig(training_pipeline_config = training_pipeline_config)
-        data_validation = DataValidation(data_validation_config=data_validation_config, data_ingestion_artifact=data_ingestion_artifact)
-        data_validation_artifact = data_validation.initiate_data_validation()
+def initiate_model_trainer(config, upstream_artifacts:dict):
+    return ModelTrainer(model_trainer_config=config, data_transformation_artifact=upstream_artifacts["data_transformation"],
+                        data_ingestion_artifact=upstream_artifacts["data_ingestion"]).initiate_model_trainer()
 
 
-        #data transformation config
-        data_transformation_config = config_entity.DataTransformationConfig(training_pipeline_config=training_pipeline_config)
-        data_transformation = DataTransformation(data_transformation_config=data_transformation_config, data_ingestion_artifact=data_ingestion_artifact)
-        data_transformation_artifact = data_transformation.initiate_data_transformation()
+def initiate_model_evaluation(config, upstream_artifacts:dict):
+    return ModelEvaluation(model_evaluation_config=config, data_ingestion_artifact=upstream_artifacts["data_ingestion"],
+                           data_transformation_artifact=upstream_artifacts["data_transformation"],
+                           model_trainer_artifact=upstream_artifacts["model_trainer"]).initiate_model_evaluation()
 
 
-        #model trainer 
-        model_trainer_config = config_entity.ModelTrainerConfig(training_pipeline_config=training_pipeline_config)
-        model_trainer = ModelTrainer(model_trainer_config=model_trainer_config, data_transformation_artifact=data_transformation_artifact)
-        model_trainer_artifact = model_trainer.initiate_model_trainer()
-    
+def initiate_model_export(config, upstream_artifacts:dict):
+    return ModelPusher(model_pusher_config=config, data_transformation_artifact=upstream_artifacts["data_transformation"],
+                       model_trainer_artifact=upstream_artifacts["model_trainer"]).export_model()
 
 
-        #model evaluation
+def initiate_model_pusher(config, upstream_artifacts:dict):
+    if not upstream_artifacts["model_evaluation"].is_model_accepted:
+        raise Exception(f'Model was not accepted by model evaluation, it is not pushed')
+    return ModelPusher(model_pusher_config=config, data_transformation_artifact=upstream_artifacts["data_transformation"],
+                       model_trainer_artifact=upstream_artifacts["model_trainer"]).initiate_model_pusher(model_export_artifact=upstream_artifacts["model_export"])
 
-        model_evaluation_config = config_entity.ModelEvaluationConfig(training_pipeline_config=training_pipeline_config)
-        model_evaluation = ModelEvaluation(model_evaluation_config=model_evaluation_config, data_ingestion_artifact=data_ingestion_artifact, data_transformation_artifact=data_transformation_artifact, model_trainer_artifact=model_trainer_artifact)
-        model_evaluation_artifact = model_evaluation.initiate_model_evaluation()
 
+#stage name : (config class, stages it depends on, function that runs it). Validation and transformation only need
+#the ingestion artifact, the export into the pusher dir does not wait for evaluation, only the push into the
+#model registry waits for validation and evaluation
+PIPELINE_STAGES = {
+    "data_ingestion": (config_entity.DataIngestionConfig, [], initiate_data_ingestion),
+    "data_validation": (config_entity.DataValidationConfig, ["data_ingestion"], initiate_data_validation),
+    "data_transformation": (config_entity.DataTransformationConfig, ["data_ingestion"], initiate_data_transformation),
+    "model_trainer": (config_entity.ModelTrainerConfig, ["data_transformation", "data_ingestion"], initiate_model_trainer),
+    "model_evaluation": (config_entity.ModelEvaluationConfig, ["data_ingestion", "data_transformation", "model_trainer"], initiate_model_evaluation),
+    "model_export": (config_entity.ModelPusherConfig, ["data_transformation", "model_trainer"], initiate_model_export),
+    "model_pusher": (config_entity.ModelPusherConfig, ["data_validation", "model_evaluation", "model_export", "data_transformation", "model_trainer"], initiate_model_pusher),
+}
 
-        #model pusher
-        model_pusher_config = config_entity.ModelPusherConfig(training_pipeline_config=training_pipeline_config)
-        model_pusher = ModelPusher(model_pusher_config=model_pusher_config, data_transformation_artifact=data_transformation_artifact, model_trainer_artifact=model_trainer_artifact)
-        model_pusher_artifact= model_pusher.initiate_model_pusher()
+
+def get_registry_state(model_registry:str)->dict:
+    try:
+        latest_dir = ModelResolver(model_registry=model_registry).get_latest_dir_path()
+        return {"latest_dir": latest_dir, "hash": None if latest_dir is None else get_path_hash(path=latest_dir)}
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def uses_registry(stage_name:str, config)->bool:
+    #stages that read the model registry include its state in their fingerprint
+    return (stage_name in ("model_evaluation", "model_pusher")
+            or (stage_name == "data_transformation" and config.reuse_preprocessing)
+            or (stage_name == "model_trainer" and config.warm_start))
+
+
+def get_stage_fingerprint(stage_cache:StageCache, stage_name:str, config, upstream_artifacts:dict, registry_state:dict)->str:
+    try:
+        if stage_name == "data_ingestion":
+            extra = DataIngestion(data_ingestion_config=config).get_source_state()
+        else:
+            extra = registry_state if uses_registry(stage_name=stage_name, config=config) else None
+        return stage_cache.get_fingerprint(stage_name, config=config, artifacts=list(upstream_artifacts.values()), extra=extra)
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def run_pipeline_stage(stage_name:str, training_pipeline_config:config_entity.TrainingPipelineConfig,
+                       stage_cache:StageCache, registry_state:dict, upstream_artifacts:dict):
+    try:
+        config_class, _, initiate_stage = PIPELINE_STAGES[stage_name]
+        config = config_class(training_pipeline_config=training_pipeline_config)
+        if stage_cache is None:
+            artifact = initiate_stage(config, upstream_artifacts)
+        else:
+            fingerprint = get_stage_fingerprint(stage_cache=stage_cache, stage_name=stage_name, config=config,
+                                                upstream_artifacts=upstream_artifacts, registry_state=registry_state)
+            artifact = stage_cache.run_stage(stage_name=stage_name, fingerprint=fingerprint, run_stage=lambda: initiate_stage(config, upstream_artifacts))
+        #stages in other processes only see files, so a worker process writes everything before handing back
+        if training_pipeline_config.pipeline_executor == "process":
+            artifact_store.flush()
+        return artifact
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+
+
+def start_training_pipeline()->dict:
+
+    try:
+        
+        training_pipeline_config = config_entity.TrainingPipelineConfig()
+        artifact_store.enabled = training_pipeline_config.in_memory_artifacts
+        stage_cache = None
+        registry_state = None
+        model_registry = config_entity.ModelPusherConfig(training_pipeline_config=training_pipeline_config).saved_model_dir
+        if training_pipeline_config.stage_cache:
+            stage_cache = StageCache(artifact_dir=training_pipeline_config.artifact_dir, cache_dir=training_pipeline_config.stage_cache_dir)
+            registry_state = get_registry_state(model_registry=model_registry)
+
+        stages = {stage_name: (partial(run_pipeline_stage, stage_name, training_pipeline_config, stage_cache, registry_state), dependencies)
+                  for stage_name, (_, dependencies, _) in PIPELINE_STAGES.items()}
+        dag_executor = DAGExecutor(stages=stages, executor=training_pipeline_config.pipeline_executor,
+                                   max_workers=training_pipeline_config.pipeline_workers)
+        try:
+            artifacts = dag_executor.run()
+        finally:
+            write_yaml_file(file_path=os.path.join(training_pipeline_config.artifact_dir, PIPELINE_RUN_FILE_NAME), data=dag_executor.stage_runs)
+            #every artifact is on disk when the run returns and the cached objects are released
+            artifact_store.clear()
+
+        #after a push the latest registry version is this run's model, a rerun with the same inputs against it
+        #would come to the same results, so they are also recorded under the new registry state
+        if stage_cache is not None:
+            pushed_registry_state = get_registry_state(model_registry=model_registry)
+            if pushed_registry_state != registry_state:
+                for stage_name, (config_class, dependencies, _) in PIPELINE_STAGES.items():
+                    config = config_class(training_pipeline_config=training_pipeline_config)
+                    if uses_registry(stage_name=stage_name, config=config):
+                        fingerprint = get_stage_fingerprint(stage_cache=stage_cache, stage_name=stage_name, config=config,
+                            upstream_artifacts={dependency: artifacts[dependency] for dependency in dependencies}, registry_state=pushed_registry_state)
+                        stage_cache.put(stage_name=stage_name, fingerprint=fingerprint, artifact=artifacts[stage_name])
+
+        if training_pipeline_config.retention:
+            start_retention(retention_config=config_entity.RetentionConfig(training_pipeline_config=training_pipeline_config))
+        return artifacts
         
     except Exception as e:
-        raise InsuranceException(e, sys)
\ No newline at end of file
+        raise InsuranceException(e, sys)
@@ -1,29 +1,243 @@
 import os
+import yaml
+import time
+import shutil
+import numpy as np
+import pandas as pd
+from datetime import datetime
 from typing import Optional
-from insurance.entity.config_entity import TRANSFORMER_OBJECT_FILE_NAME, TARGET_OBJECT_FILE_NAME, MODEL_FILE_NAME
+from contextlib import contextmanager
+from insurance.entity.config_entity import TRANSFORMER_OBJECT_FILE_NAME, TARGET_OBJECT_FILE_NAME, MODEL_FILE_NAME, FUSED_MODEL_FILE_NAME, STATISTICS_FILE_NAME, BUNDLE_FILE_NAME
+from insurance.bundle import load_bundle
 from glob import glob
+try:
+    import fcntl
+except ImportError:
+    #windows
+    fcntl = None
+    import msvcrt
+
+REGISTRY_FILE_NAME = "registry.yaml"
+LATEST_FILE_NAME = "LATEST"
+LOCK_FILE_NAME = ".registry.lock"
+#next version to allocate, it only ever increases so the number of a failed or removed version is never reused
+NEXT_VERSION_FILE_NAME = "NEXT_VERSION"
+#a pusher owns version v once it created saved_models/.staging-v, the dir is renamed to saved_models/v when complete
+STAGING_DIR_PREFIX = ".staging-"
+#parsed registry files shared by every ModelResolver of the process, keyed by path and
+#revalidated with one stat, a replaced file always has a new inode
+_registry_file_cache = dict()
+
+
+def _read_registry_file(file_path:str, parse):
+    try:
+        file_stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    file_key = (file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+    cached = _registry_file_cache.get(file_path)
+    if cached is not None and cached[0] == file_key:
+        return cached[1]
+    with open(file_path, "r") as file_obj:
+        value = parse(file_obj)
+    _registry_file_cache[file_path] = (file_key, value)
+    return value
+
+
+def _lock_file(file_obj):
+    #flock on posix and msvcrt.locking of the first byte on windows, both are released by the OS if the holder dies
+    if fcntl is not None:
+        fcntl.flock(file_obj.fileno(), fcntl.LOCK_EX)
+        return
+    file_obj.seek(0)
+    while True:
+        try:
+            msvcrt.locking(file_obj.fileno(), msvcrt.LK_NBLCK, 1)
+            return
+        except OSError:
+            time.sleep(0.05)
+
+
+def _unlock_file(file_obj):
+    if fcntl is not None:
+        fcntl.flock(file_obj.fileno(), fcntl.LOCK_UN)
+        return
+    file_obj.seek(0)
+    msvcrt.locking(file_obj.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _fsync_path(path:str):
+    #directories can not be opened on windows, NTFS journals the rename itself
+    if os.name == "nt" and os.path.isdir(path):
+        return
+    file_descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(file_descriptor)
+    finally:
+        os.close(file_descriptor)
+
+
+def _replace_file(file_path:str, content:str):
+    with open(f"{file_path}.tmp", "w") as file_obj:
+        file_obj.write(content)
+        file_obj.flush()
+        os.fsync(file_obj.fileno())
+    os.replace(f"{file_path}.tmp", file_path)
+
 
 class ModelResolver:
+    #saved_models/registry.yaml indexes every version with its metadata and saved_models/LATEST names the
+    #latest one. Both are replaced atomically, the index first, so LATEST never names an unindexed version.
+    #Lookups stat LATEST instead of listing the registry, registries of numbered dirs are migrated on first use.
+    #Pushers allocate a version from the NEXT_VERSION counter and publish it with a rename, so pipelines can push
+    #concurrently, allocations and index updates are serialized by a lock file.
     def __init__(self, model_registry:str = "saved_models",
                 transformer_dir_name = "transformer",
                 target_encoder_dir_name = "target_encoder",
-                model_dir_name = "model"):
+                model_dir_name = "model",
+                fused_model_dir_name = "fused_model",
+                statistics_dir_name = "statistics"):
 
         self.model_registry = model_registry
         os.makedirs(self.model_registry, exist_ok=True)
         self.transformer_dir_name = transformer_dir_name
         self.target_encoder_dir_name = target_encoder_dir_name
         self.model_dir_name = model_dir_name
+        self.fused_model_dir_name = fused_model_dir_name
+        self.statistics_dir_name = statistics_dir_name
+        self.registry_file_path = os.path.join(self.model_registry, REGISTRY_FILE_NAME)
+        self.latest_file_path = os.path.join(self.model_registry, LATEST_FILE_NAME)
+        self.next_version_file_path = os.path.join(self.model_registry, NEXT_VERSION_FILE_NAME)
+
 
+    @contextmanager
+    def registry_lock(self):
+        #the lock is released by the OS if the holder dies, a crashed pusher never leaves the registry locked
+        with open(os.path.join(self.model_registry, LOCK_FILE_NAME), "a+") as lock_file:
+            _lock_file(lock_file)
+            try:
+                yield
+            finally:
+                _unlock_file(lock_file)
+
+    def migrate_registry(self)->dict:
+        #builds the index from numbered version dirs of registries written before the index existed,
+        #callers hold registry_lock
+        try:
+            versions = sorted(int(dir_name) for dir_name in os.listdir(self.model_registry)
+                              if dir_name.isdigit() and os.path.isdir(os.path.join(self.model_registry, dir_name)))
+            registry = {"versions": [{"version": version, "dir": f'{version}',
+                                      "created_at": datetime.fromtimestamp(os.path.getmtime(os.path.join(self.model_registry, f'{version}'))).isoformat()}
+                                     for version in versions]}
+            _replace_file(self.registry_file_path, yaml.dump(registry))
+            if len(versions) > 0:
+                _replace_file(self.latest_file_path, f'{versions[-1]}')
+            return registry
+        except Exception as e:
+            raise e
+
+    def get_registry(self)->dict:
+        try:
+            registry = _read_registry_file(self.registry_file_path, parse=yaml.safe_load)
+            if registry is None:
+                with self.registry_lock():
+                    registry = _read_registry_file(self.registry_file_path, parse=yaml.safe_load)
+                    if registry is None:
+                        registry = self.migrate_registry()
+            return registry
+        except Exception as e:
+            raise e
+
+    def get_latest_version(self)->Optional[int]:
+        try:
+            latest_version = _read_registry_file(self.latest_file_path, parse=lambda file_obj: int(file_obj.read().strip()))
+            if latest_version is None:
+                versions = self.get_registry()["versions"]
+                latest_version = versions[-1]["version"] if len(versions) > 0 else None
+            return latest_version
+        except Exception as e:
+            raise e
+
+    def register_version(self, version:int, metadata:Optional[dict]=None):
+        #called once every file of the version is in place, the version becomes visible with the LATEST replace.
+        #Concurrent pushers can finish out of order, LATEST always names the highest registered version
+        try:
+            with self.registry_lock():
+                registry = _read_registry_file(self.registry_file_path, parse=yaml.safe_load)
+                if registry is None:
+                    registry = self.migrate_registry()
+                entry = {"version": version, "dir": f'{version}', "created_at": datetime.now().isoformat()}
+                entry.update(metadata or dict())
+                versions = sorted([existing for existing in registry["versions"] if existing["version"] != version] + [entry],
+                                  key=lambda existing: existing["version"])
+                _replace_file(self.registry_file_path, yaml.dump({"versions": versions}))
+                _replace_file(self.latest_file_path, f'{versions[-1]["version"]}')
+        except Exception as e:
+            raise e
+
+    def allocate_version(self)->tuple:
+        #returns the version and the staging dir it is written to. The counter is advanced under the registry lock,
+        #so concurrent pushers get distinct versions and a discarded version is never handed out again
+        try:
+            #migrates a registry without index before the lock is taken, migration takes it itself
+            self.get_registry()
+            with self.registry_lock():
+                #version and staging dirs of registries from before the counter existed
+                claimed_versions = [int(dir_name[len(STAGING_DIR_PREFIX):]) if dir_name.startswith(STAGING_DIR_PREFIX) else int(dir_name)
+                                    for dir_name in os.listdir(self.model_registry)
+                                    if dir_name.isdigit() or (dir_name.startswith(STAGING_DIR_PREFIX) and dir_name[len(STAGING_DIR_PREFIX):].isdigit())]
+                version = max([self.get_latest_save_version()] + [claimed_version + 1 for claimed_version in claimed_versions])
+                staging_dir = os.path.join(self.model_registry, f'{STAGING_DIR_PREFIX}{version}')
+                os.mkdir(staging_dir)
+                _replace_file(self.next_version_file_path, f'{version + 1}')
+            return version, staging_dir
+        except Exception as e:
+            raise e
+
+    def publish_version(self, version:int, staging_dir:str, metadata:Optional[dict]=None):
+        #readers never see a half written version : files are flushed, the staging dir is renamed into place
+        #and only then the version is registered
+        try:
+            for dir_path, _, file_names in os.walk(staging_dir):
+                for file_name in file_names:
+                    _fsync_path(os.path.join(dir_path, file_name))
+            os.rename(staging_dir, os.path.join(self.model_registry, f'{version}'))
+            _fsync_path(self.model_registry)
+            self.register_version(version=version, metadata=metadata)
+        except Exception as e:
+            raise e
+
+    def remove_version(self, version:int):
+        #unregisters a version and deletes its dir, the live version is never removed
+        try:
+            with self.registry_lock():
+                registry = _read_registry_file(self.registry_file_path, parse=yaml.safe_load)
+                if registry is None:
+                    registry = self.migrate_registry()
+                versions = [existing for existing in registry["versions"] if existing["version"] != version]
+                if len(versions) == 0 or self.get_latest_version() == version:
+                    raise Exception(f'Version {version} is the live version and can not be removed')
+                _replace_file(self.registry_file_path, yaml.dump({"versions": versions}))
+            #renamed first so a partly deleted dir is never mistaken for a version
+            removed_dir = os.path.join(self.model_registry, f'.removed-{version}')
+            os.rename(os.path.join(self.model_registry, f'{version}'), removed_dir)
+            shutil.rmtree(removed_dir)
+        except Exception as e:
+            raise e
+
+    def discard_version(self, staging_dir:str):
+        #frees a version whose push failed, the number is not reused by later pushes
+        try:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        except Exception as e:
+            raise e
 
     def get_latest_dir_path(self)->Optional[str]:
         try:
-            dir_names = os.listdir(self.model_registry)
-            if len(dir_names)==0:
+            latest_version = self.get_latest_version()
+            if latest_version is None:
                 return None
-            dir_names = list(map(int, dir_names))
-            latest_dir_name = max(dir_names)
-            return os.path.join(self.model_registry, f'{latest_dir_name}')
+            return os.path.join(self.model_registry, f'{latest_version}')
         except Exception as e:
             raise e
 
@@ -45,6 +259,55 @@ class ModelResolver:
         except Exception as e:
             raise e
 
+    def get_latest_fused_model_path(self)->Optional[str]:
+        #None when the latest version has no fused model, e.g. it was pushed before fusing or is not linear
+        try:
+            latest_dir = self.get_latest_dir_path()
+            if latest_dir is None:
+                raise Exception(f'Model is not available')
+            fused_model_path = os.path.join(latest_dir, self.fused_model_dir_name, FUSED_MODEL_FILE_NAME)
+            if not os.path.exists(fused_model_path):
+                return None
+            return fused_model_path
+        except Exception as e:
+            raise e
+
+    def get_latest_statistics_path(self)->Optional[str]:
+        #None when there is no saved model or it was not trained from sufficient statistics
+        try:
+            latest_dir = self.get_latest_dir_path()
+            if latest_dir is None:
+                return None
+            statistics_path = os.path.join(latest_dir, self.statistics_dir_name, STATISTICS_FILE_NAME)
+            if not os.path.exists(statistics_path):
+                return None
+            return statistics_path
+        except Exception as e:
+            raise e
+
+    def get_latest_bundle_path(self)->Optional[str]:
+        #None when there is no saved model or the latest version was pushed before bundles
+        try:
+            latest_dir = self.get_latest_dir_path()
+            if latest_dir is None:
+                return None
+            bundle_path = os.path.join(latest_dir, BUNDLE_FILE_NAME)
+            if not os.path.exists(bundle_path):
+                return None
+            return bundle_path
+        except Exception as e:
+            raise e
+
+    def load_latest_bundle(self, use_mmap:bool=False)->Optional[tuple]:
+        #header and objects of the latest bundle read in one go, None when the latest version has no bundle
+        try:
+            bundle_path = self.get_latest_bundle_path()
+            if bundle_path is None:
+                return None
+            return load_bundle(file_path=bundle_path, use_mmap=use_mmap)
+        except Exception as e:
+            raise e
+
     def get_latest_target_encoder_path(self):
         try:
             latest_dir = self.get_latest_dir_path()
@@ -55,33 +318,124 @@ class ModelResolver:
             raise e
 
     
+    def get_latest_save_version(self)->int:
+        try:
+            versions = self.get_registry()["versions"]
+            next_version = _read_registry_file(self.next_version_file_path, parse=lambda file_obj: int(file_obj.read().strip()))
+            return max([next_version or 0] + [entry["version"] + 1 for entry in versions])
+        except Exception as e:
+            raise e
+
     def get_latest_save_dir_path(self)->str:
+        #only a guess while other pipelines may push, pushers write to the staging dir of allocate_version
         try:
-            latest_dir = self.get_latest_dir_path()
-            if latest_dir is None:
-                return os.path.join(self.model_registry, f'{0}')
-            latest_dir_num = int(os.path.basename(self.get_latest_dir_path()))
-            return os.path.join(self.model_registry, f'{latest_dir_num+1}')
+            return os.path.join(self.model_registry, f'{self.get_latest_save_version()}')
         except Exception as e:
             raise e
 
-    def get_latest_save_model_path(self):
+    def get_latest_save_model_path(self, dir_path:Optional[str]=None):
         try:
-            latest_dir = self.get_latest_save_dir_path()
+            latest_dir = self.get_latest_save_dir_path() if dir_path is None else dir_path
             return os.path.join(latest_dir, self.model_dir_name, MODEL_FILE_NAME)
         except Exception as e:
             raise e
 
-    def get_latest_save_transformer_path(self):
+    def get_latest_save_transformer_path(self, dir_path:Optional[str]=None):
         try:
-            latest_dir = self.get_latest_save_dir_path()
+            latest_dir = self.get_latest_save_dir_path() if dir_path is None else dir_path
             return os.path.join(latest_dir, self.transformer_dir_name, TRANSFORMER_OBJECT_FILE_NAME)
         except Exception as e:
             raise e
 
-    def get_latest_save_target_encoder_path(self):
+    def get_latest_save_target_encoder_path(self, dir_path:Optional[str]=None):
         try:
-            latest_dir = self.get_latest_save_dir_path()
+            latest_dir = self.get_latest_save_dir_path() if dir_path is None else dir_path
             return os.path.join(latest_dir, self.target_encoder_dir_name, TARGET_OBJECT_FILE_NAME)
         except Exception as e:
-            raise e
\ No newline at end of file
+            raise e
+
+    def get_latest_save_fused_model_path(self, dir_path:Optional[str]=None):
+        try:
+            latest_dir = self.get_latest_save_dir_path() if dir_path is None else dir_path
+            return os.path.join(latest_dir, self.fused_model_dir_name, FUSED_MODEL_FILE_NAME)
+        except Exception as e:
+            raise e
+
+    def get_latest_save_statistics_path(self, dir_path:Optional[str]=None):
+        try:
+            latest_dir = self.get_latest_save_dir_path() if dir_path is None else dir_path
+            return os.path.join(latest_dir, self.statistics_dir_name, STATISTICS_FILE_NAME)
+        except Exception as e:
+            raise e
+
+    def get_latest_save_bundle_path(self, dir_path:Optional[str]=None):
+        try:
+            latest_dir = self.get_latest_save_dir_path() if dir_path is None else dir_path
+            return os.path.join(latest_dir, BUNDLE_FILE_NAME)
+        except Exception as e:
+            raise e
+
+
+class FusedLinearPredictor:
+    #imputer -> scalers -> linear model folded into one affine map: fill missing values, then X @ coef_ + intercept_.
+    #With x_scaled = (x - center)/scale, coef . x_scaled + b = (coef/scale) . x + (b - coef . center/scale)
+    def __init__(self, feature_names_in_:list, fill_values_:np.ndarray, coef_:np.ndarray, intercept_:float):
+        self.feature_names_in_ = np.asarray(feature_names_in_, dtype=object)
+        self.fill_values_ = np.ascontiguousarray(fill_values_, dtype=np.float64)
+        self.coef_ = np.ascontiguousarray(coef_, dtype=np.float64)
+        self.intercept_ = float(intercept_)
+
+    @classmethod
+    def compile(cls, transformer, model)->Optional["FusedLinearPredictor"]:
+        #returns None when a step cannot be folded, the caller then keeps using transformer + model
+        try:
+            steps = [step for _, step in transformer.steps] if hasattr(transformer, "steps") else [transformer]
+            if not hasattr(model, "coef_") or np.ndim(model.coef_) != 1:
+                return None
+            n_features = len(transformer.feature_names_in_)
+            fill_values = np.zeros(n_features)
+            center, scale = np.zeros(n_features), np.ones(n_features)
+            for position, step in enumerate(steps):
+                name = type(step).__name__
+                if name == "SimpleImputer" and position == 0 and not step.add_indicator and step.statistics_.shape[0] == n_features:
+                    fill_values = step.statistics_.astype(np.float64)
+                elif name == "RobustScaler" or name == "StandardScaler":
+                    #StandardScaler(with_mean=False) still fits mean_ but does not subtract it
+                    step_center = step.center_ if name == "RobustScaler" else (step.mean_ if step.with_mean else None)
+                    step_center = np.zeros(n_features) if step_center is None else step_center
+                    step_scale = np.ones(n_features) if step.scale_ is None else step.scale_
+                    #(((x - c1)/s1) - c2)/s2 = (x - (c1 + c2*s1))/(s1*s2)
+                    center, scale = center + step_center*scale, scale*step_scale
+                else:
+                    return None
+            coef = model.coef_/scale
+            intercept = float(model.intercept_) - float(np.dot(model.coef_, center/scale))
+            return cls(feature_names_in_=list(transformer.feature_names_in_), fill_values_=fill_values, coef_=coef, intercept_=intercept)
+        except Exception as e:
+            raise e
+
+    def predict(self, X)->np.ndarray:
+        try:
+            X = np.array(X, dtype=np.float64, order="C")
+            is_missing = np.isnan(X)
+            if is_missing.any():
+                X = np.where(is_missing, self.fill_values_, X)
+            return X @ self.coef_ + self.intercept_
+        except Exception as e:
+            raise e
+
+    def check_parity(self, transformer, model, num_rows:int=1000, seed:int=42)->float:
+        #scores random rows, a tenth of them missing, both ways and raises if the fused model drifts from the original
+        try:
+            random_state = np.random.default_rng(seed)
+            X = random_state.normal(scale=10, size=(num_rows, self.coef_.shape[0]))
+            X[random_state.random(X.shape) < 0.1] = np.nan
+            X = pd.DataFrame(X, columns=self.feature_names_in_)
+            expected = model.predict(transformer.transform(X))
+            actual = self.predict(X)
+            max_abs_error = float(np.max(np.abs(expected - actual)))
+            if not np.allclose(actual, expected, rtol=1e-6, atol=1e-6*max(1.0, float(np.max(np.abs(expected))))):
+                raise Exception(f'Fused model does not match transformer and model, max absolute error : {max_abs_error}')
+            return max_abs_error
+        except Exception as e:
+            raise e
@@ -0,0 +1,136 @@
+import os, sys
+import threading
+import numpy as np
+import pandas as pd
+from insurance.logger import logging
+from insurance.exception import InsuranceException
+from insurance.entity.config_entity import TRANSFORMER_OBJECT_FILE_NAME, TARGET_OBJECT_FILE_NAME, MODEL_FILE_NAME, FUSED_MODEL_FILE_NAME, BUNDLE_FILE_NAME
+from insurance.predictor import ModelResolver
+from insurance.bundle import load_bundle
+from insurance.utils import load_object
+from insurance.encoder import encode_features
+
+#seconds between two checks of the registry for a new latest version
+PREDICTOR_POLL_INTERVAL = 5.0
+#one cache per registry, shared by every caller of the process
+_predictor_caches = dict()
+_predictor_caches_lock = threading.Lock()
+
+
+class LoadedPredictor:
+    #every object of one registry version, never changed once loaded so any number of batches can use it at once
+    def __init__(self, version:int, target_encoder, transformer, model, fused_model=None):
+        self.version = version
+        self.target_encoder = target_encoder
+        self.transformer = transformer
+        self.model = model
+        self.fused_model = fused_model
+
+    def predict(self, df:pd.DataFrame)->np.ndarray:
+        try:
+            if self.fused_model is not None:
+                input_df = encode_features(encoder=self.target_encoder, df=df[list(self.fused_model.feature_names_in_)])
+                return self.fused_model.predict(input_df.to_numpy(dtype=np.float64))
+            input_df = encode_features(encoder=self.target_encoder, df=df[list(self.transformer.feature_names_in_)])
+            return self.model.predict(self.transformer.transform(input_df))
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+class PredictorCache:
+    #holds the predictor of the latest registry version. A watcher thread polls LATEST (one stat) and loads a
+    #new version next to the one in use, then swaps the reference. Batches keep the predictor they started
+    #with, so in-flight batches finish on the old version and only the very first get() waits for a load.
+    def __init__(self, model_registry:str="saved_models", poll_interval:float=PREDICTOR_POLL_INTERVAL):
+        self.model_resolver = ModelResolver(model_registry=model_registry)
+        self.poll_interval = poll_interval
+        self.predictor = None
+        self.load_lock = threading.Lock()
+        self.watcher_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.watcher = None
+        self.watcher_pid = None
+
+    def load(self, version:int)->LoadedPredictor:
+        #everything is read from the version's own dir, a push during the load can not mix two versions
+        try:
+            version_dir = os.path.join(self.model_resolver.model_registry, f'{version}')
+            bundle_path = os.path.join(version_dir, BUNDLE_FILE_NAME)
+            if os.path.exists(bundle_path):
+                _, objects = load_bundle(file_path=bundle_path)
+                return LoadedPredictor(version=version, target_encoder=objects["target_encoder"], transformer=objects["transformer"],
+                                       model=objects["model"], fused_model=objects.get("fused_model"))
+            #versions pushed before bundles
+            fused_model_path = os.path.join(version_dir, self.model_resolver.fused_model_dir_name, FUSED_MODEL_FILE_NAME)
+            return LoadedPredictor(version=version,
+                                   target_encoder=load_object(file_path=os.path.join(version_dir, self.model_resolver.target_encoder_dir_name, TARGET_OBJECT_FILE_NAME)),
+                                   transformer=load_object(file_path=os.path.join(version_dir, self.model_resolver.transformer_dir_name, TRANSFORMER_OBJECT_FILE_NAME)),
+                                   model=load_object(file_path=os.path.join(version_dir, self.model_resolver.model_dir_name, MODEL_FILE_NAME)),
+                                   fused_model=load_object(file_path=fused_model_path) if os.path.exists(fused_model_path) else None)
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def refresh(self)->bool:
+        #loads and swaps in the latest version if it changed, returns whether it did
+        try:
+            with self.load_lock:
+                latest_version = self.model_resolver.get_latest_version()
+                if latest_version is None:
+                    raise Exception(f'Model is not available')
+                if self.predictor is not None and self.predictor.version == latest_version:
+                    return False
+                logging.info(f'Loading version {latest_version} into the predictor cache')
+                predictor = self.load(version=latest_version)
+                #a single reference assignment, readers see either the old or the new predictor
+                self.predictor = predictor
+                logging.info(f'Predictor cache serves version {latest_version}')
+                return True
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def watch(self):
+        while not self.stop_event.wait(self.poll_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                #the loaded version keeps serving, the next poll tries again
+                logging.info(f'Predictor cache could not refresh, keeps serving version {self.predictor.version} : {e}')
+
+    def start_watcher(self):
+        #threads do not survive a fork, a forked worker starts its own watcher
+        if self.watcher_pid == os.getpid():
+            return
+        with self.watcher_lock:
+            if self.watcher_pid == os.getpid():
+                return
+            #the parent's watcher may have held the load lock at the fork
+            self.load_lock = threading.Lock()
+            self.stop_event = threading.Event()
+            self.watcher = threading.Thread(target=self.watch, name="predictor-cache-watcher", daemon=True)
+            self.watcher.start()
+            self.watcher_pid = os.getpid()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.watcher is not None and self.watcher_pid == os.getpid():
+            self.watcher.join()
+        self.watcher_pid = None
+
+    def get(self)->LoadedPredictor:
+        try:
+            predictor = self.predictor
+            if predictor is None:
+                self.refresh()
+                predictor = self.predictor
+            self.start_watcher()
+            return predictor
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+def get_predictor_cache(model_registry:str="saved_models")->PredictorCache:
+    with _predictor_caches_lock:
+        model_registry = os.path.abspath(model_registry)
+        if model_registry not in _predictor_caches:
+            _predictor_caches[model_registry] = PredictorCache(model_registry=model_registry)
+        return _predictor_caches[model_registry]
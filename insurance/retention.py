@@ -0,0 +1,153 @@
+import argparse
+import os, sys
+import gzip
+import shutil
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+from insurance.logger import logging
+from insurance.exception import InsuranceException
+from insurance.entity import config_entity
+from insurance.predictor import ModelResolver, STAGING_DIR_PREFIX
+from insurance.blob_store import BlobStore
+from insurance.pipeline.stage_cache import prune_stage_cache, get_cached_paths
+
+#name format of the timestamped run dirs created by TrainingPipelineConfig
+RUN_DIR_FORMAT = "%m%d%Y__%H%M%S"
+
+
+def is_expired(created_at:datetime, max_age_days)->bool:
+    return max_age_days is not None and created_at < datetime.now() - timedelta(days=max_age_days)
+
+
+def apply_registry_retention(retention_config:config_entity.RetentionConfig, dry_run:bool=False)->list:
+    try:
+        model_resolver = ModelResolver(model_registry=retention_config.saved_model_dir)
+        versions = sorted(model_resolver.get_registry()["versions"], key=lambda entry: entry["version"])
+        live_version = model_resolver.get_latest_version()
+        removed_versions = []
+        for position, entry in enumerate(reversed(versions)):
+            if entry["version"] == live_version:
+                continue
+            if position >= retention_config.keep_last_versions or is_expired(datetime.fromisoformat(entry["created_at"]), retention_config.max_age_days):
+                removed_versions.append(entry["version"])
+                if not dry_run:
+                    model_resolver.remove_version(version=entry["version"])
+        #staging dirs left behind by pushes that crashed before publishing
+        for dir_name in os.listdir(retention_config.saved_model_dir):
+            dir_path = os.path.join(retention_config.saved_model_dir, dir_name)
+            if dir_name.startswith(STAGING_DIR_PREFIX) and time.time() - os.path.getmtime(dir_path) > retention_config.stale_staging_hours*3600:
+                logging.info(f"Removing stale staging dir {dir_path}")
+                if not dry_run:
+                    model_resolver.discard_version(staging_dir=dir_path)
+        logging.info(f"Removed registry versions {removed_versions}, live version {live_version} is kept")
+        return removed_versions
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def get_run_dirs(artifact_root_dir:str)->list:
+    #(created_at, path) of every run, newest first
+    try:
+        run_dirs = []
+        if not os.path.isdir(artifact_root_dir):
+            return run_dirs
+        for dir_name in os.listdir(artifact_root_dir):
+            try:
+                created_at = datetime.strptime(dir_name, RUN_DIR_FORMAT)
+            except ValueError:
+                continue
+            run_dirs.append((created_at, os.path.join(artifact_root_dir, dir_name)))
+        return sorted(run_dirs, reverse=True)
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def compress_dir(dir_path:str, extensions:list, dry_run:bool=False, blob_dir:Optional[str]=None)->list:
+    #file -> file.gz. Files with other hard links (registry versions, blobs) are skipped, compressing them would
+    #only add a second, compressed copy next to the linked one
+    try:
+        compressed_files = []
+        for root, dir_names, file_names in os.walk(dir_path):
+            if blob_dir is not None:
+                dir_names[:] = [dir_name for dir_name in dir_names if os.path.abspath(os.path.join(root, dir_name)) != os.path.abspath(blob_dir)]
+            for file_name in file_names:
+                file_path = os.path.join(root, file_name)
+                if os.path.splitext(file_name)[1] not in extensions or os.stat(file_path).st_nlink > 1:
+                    continue
+                compressed_files.append(file_path)
+                if dry_run:
+                    continue
+                with open(file_path, "rb") as file_obj, gzip.open(f"{file_path}.gz.tmp", "wb") as compressed_file_obj:
+                    shutil.copyfileobj(file_obj, compressed_file_obj)
+                os.replace(f"{file_path}.gz.tmp", f"{file_path}.gz")
+                os.remove(file_path)
+        return compressed_files
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def is_within(path:str, dir_path:str)->bool:
+    path, dir_path = os.path.abspath(path), os.path.abspath(dir_path)
+    return path == dir_path or path.startswith(dir_path + os.sep)
+
+
+def apply_artifact_retention(retention_config:config_entity.RetentionConfig, dry_run:bool=False)->tuple:
+    #only finished runs are touched : the newest run, runs without a pipeline_run.yaml (still running, concurrent
+    #pipelines may push at the same time) and runs a stage cache entry refers to are always kept as they are
+    try:
+        removed_runs, compressed_runs = [], []
+        cached_paths = get_cached_paths(cache_dir=retention_config.stage_cache_dir)
+        for position, (created_at, run_dir) in enumerate(get_run_dirs(artifact_root_dir=retention_config.artifact_root_dir)):
+            if position == 0 or not os.path.exists(os.path.join(run_dir, config_entity.PIPELINE_RUN_FILE_NAME)):
+                continue
+            if any(is_within(path=cached_path, dir_path=run_dir) for cached_path in cached_paths):
+                logging.info(f"Keeping artifact run {run_dir}, the stage cache refers to it")
+                continue
+            if position >= retention_config.keep_last_runs or is_expired(created_at, retention_config.max_age_days):
+                removed_runs.append(run_dir)
+                if not dry_run:
+                    shutil.rmtree(run_dir)
+            elif position >= retention_config.hot_runs:
+                if len(compress_dir(dir_path=run_dir, extensions=retention_config.compress_extensions, dry_run=dry_run,
+                                    blob_dir=retention_config.blob_dir)) > 0:
+                    compressed_runs.append(run_dir)
+        logging.info(f"Removed artifact runs {removed_runs}, compressed artifact runs {compressed_runs}")
+        return removed_runs, compressed_runs
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def start_retention(retention_config:config_entity.RetentionConfig, dry_run:bool=False)->dict:
+    try:
+        logging.info(f"{'>>'*20} Retention {'<<'*20}")
+        removed_versions = apply_registry_retention(retention_config=retention_config, dry_run=dry_run)
+        #entries that can not be reused anymore are pruned first, so they do not keep their runs from being removed
+        removed_cache_entries = prune_stage_cache(cache_dir=retention_config.stage_cache_dir, dry_run=dry_run)
+        removed_runs, compressed_runs = apply_artifact_retention(retention_config=retention_config, dry_run=dry_run)
+        #blobs are collected last, once the versions and runs linking to them are gone
+        removed_blobs = [] if dry_run else BlobStore(blob_dir=retention_config.blob_dir).collect_garbage()
+        return {"removed_versions": removed_versions, "removed_runs": removed_runs, "compressed_runs": compressed_runs,
+                "removed_blobs": removed_blobs, "removed_cache_entries": removed_cache_entries}
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+if __name__ == "__main__":
+    retention_config = config_entity.RetentionConfig(training_pipeline_config=config_entity.TrainingPipelineConfig())
+    parser = argparse.ArgumentParser(description="Remove old registry versions and artifact runs and compress cold artifacts")
+    parser.add_argument("--keep-last-versions", type=int, default=retention_config.keep_last_versions)
+    parser.add_argument("--keep-last-runs", type=int, default=retention_config.keep_last_runs)
+    parser.add_argument("--max-age-days", type=float, default=retention_config.max_age_days)
+    parser.add_argument("--hot-runs", type=int, default=retention_config.hot_runs)
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be removed or compressed")
+    args = parser.parse_args()
+
+    retention_config.keep_last_versions = args.keep_last_versions
+    retention_config.keep_last_runs = args.keep_last_runs
+    retention_config.max_age_days = args.max_age_days
+    retention_config.hot_runs = args.hot_runs
+    for name, paths in start_retention(retention_config=retention_config, dry_run=args.dry_run).items():
+        print(f"{name} : {len(paths)}")
+        for path in paths:
+            print(f"  {path}")
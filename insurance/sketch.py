@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+from scipy.stats import kstwo
+
+#rank error bounds reported by the sketches hold with this probability
+SKETCH_CONFIDENCE = 0.99
+
+
+class QuantileSketch:
+    #KLL style sketch: level h keeps a buffer of items that each stand for 2**h values. When a buffer
+    #grows past k it is sorted and every other item, from a random offset, is promoted to the next level.
+    #Each compaction moves the rank of any value by +-2**h with zero mean, so the total rank error is
+    #bounded by Hoeffding from the sum of squared weights. Sketches of different chunks can be merged.
+    def __init__(self, k:int=2000, seed:int=None):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.n = 0
+        self.null_count = 0
+        self.squared_weight_sum = 0.0
+        self.random_state = np.random.default_rng(seed)
+
+    def update(self, values)->"QuantileSketch":
+        values = np.asarray(values, dtype=np.float64)
+        is_null = np.isnan(values)
+        self.null_count += int(is_null.sum())
+        values = values[~is_null]
+        self.n += values.shape[0]
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other:"QuantileSketch")->"QuantileSketch":
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.n += other.n
+        self.null_count += other.null_count
+        self.squared_weight_sum += other.squared_weight_sum
+        self._compress()
+        return self
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            if self.levels[level].shape[0] > self.k:
+                items = np.sort(self.levels[level])
+                #an odd item out stays on its level so no weight is lost
+                leftover, items = items[items.shape[0] - items.shape[0] % 2:], items[:items.shape[0] - items.shape[0] % 2]
+                promoted = items[self.random_state.integers(2)::2]
+                self.levels[level] = leftover
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+                self.squared_weight_sum += float(4**level)
+            level += 1
+
+    def weighted_items(self)->tuple:
+        #every retained item with the number of values it stands for, exact while nothing was compacted
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(items_at_level.shape[0], 2.0**level) for level, items_at_level in enumerate(self.levels)])
+        return items, weights
+
+    def cdf(self, x:np.ndarray)->np.ndarray:
+        items, weights = self.weighted_items()
+        order = np.argsort(items, kind="stable")
+        cumulative_weights = np.concatenate([[0.0], np.cumsum(weights[order])])
+        return cumulative_weights[np.searchsorted(items[order], x, side="right")]/max(self.n, 1)
+
+    def quantile(self, q)->np.ndarray:
+        items, weights = self.weighted_items()
+        order = np.argsort(items, kind="stable")
+        cumulative_weights = np.cumsum(weights[order])/max(self.n, 1)
+        positions = np.searchsorted(cumulative_weights, np.asarray(q, dtype=np.float64), side="left")
+        return items[order][np.minimum(positions, items.shape[0] - 1)]
+
+    def support(self)->np.ndarray:
+        return np.concatenate(self.levels)
+
+    def error_bound(self)->float:
+        #normalized rank error that holds with probability SKETCH_CONFIDENCE for any single value
+        if self.n == 0:
+            return 0.0
+        return float(np.sqrt(2*self.squared_weight_sum*np.log(2/(1 - SKETCH_CONFIDENCE)))/self.n)
+
+
+class CategoryCounter:
+    #exact count table for categorical columns, merging adds the counts
+    def __init__(self):
+        self.counts = dict()
+        self.n = 0
+        self.null_count = 0
+
+    def update(self, values)->"CategoryCounter":
+        values = pd.Series(values, dtype=object)
+        self.null_count += int(values.isna().sum())
+        for category, count in values.value_counts(dropna=True).items():
+            self.counts[category] = self.counts.get(category, 0) + int(count)
+            self.n += int(count)
+        return self
+
+    def merge(self, other:"CategoryCounter")->"CategoryCounter":
+        for category, count in other.counts.items():
+            self.counts[category] = self.counts.get(category, 0) + count
+        self.n += other.n
+        self.null_count += other.null_count
+        return self
+
+    def cdf(self, x:np.ndarray)->np.ndarray:
+        categories = np.array(sorted(self.counts), dtype=object)
+        cumulative_counts = np.concatenate([[0], np.cumsum([self.counts[category] for category in categories])])
+        return cumulative_counts[np.searchsorted(categories, x, side="right")]/max(self.n, 1)
+
+    def support(self)->np.ndarray:
+        return np.array(list(self.counts), dtype=object)
+
+    def error_bound(self)->float:
+        return 0.0
+
+
+def new_column_summary(is_categorical:bool, k:int=2000, seed:int=None):
+    return CategoryCounter() if is_categorical else QuantileSketch(k=k, seed=seed)
+
+
+def ks_2samp_sketch(base_summary, current_summary)->tuple:
+    #KS statistic between the sketched distributions, the true statistic is within error_bound of it
+    if base_summary.n == 0 or current_summary.n == 0:
+        raise ValueError("Data passed to ks_2samp_sketch must not be empty")
+    support = np.concatenate([base_summary.support(), current_summary.support()])
+    if support.dtype == object:
+        support = np.array(sorted(set(support.tolist())), dtype=object)
+    statistic = float(np.max(np.abs(base_summary.cdf(support) - current_summary.cdf(support))))
+    m, n = sorted([float(base_summary.n), float(current_summary.n)], reverse=True)
+    pvalue = float(np.clip(kstwo.sf(statistic, np.round(m*n/(m + n))), 0, 1))
+    error_bound = base_summary.error_bound() + current_summary.error_bound()
+    return statistic, pvalue, error_bound
@@ -1,16 +1,32 @@
 import pandas as pd
 import numpy as np
 import os, sys
+import hashlib
+import shutil
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
 from insurance.logger import logging
 from insurance.exception import InsuranceException
-from insurance.config import mongo_client
+from insurance.config import get_mongo_client
 import yaml
 import dill
 
-def get_collection_as_dataframe(database_name:str, collection_name:str)->pd.DataFrame:
+SCHEMA_FILE_NAME = "schema.yaml"
+#cursor batch size of partitioned reads when none is configured
+PARTITION_BATCH_SIZE = 10000
+
+def get_collection_as_dataframe(database_name:str, collection_name:str, batch_size:Optional[int]=None, query:Optional[dict]=None)->pd.DataFrame:
     try:
         logging.info(f"Reading data from database : {database_name} and collection : {collection_name}")
-        df = pd.DataFrame(list(mongo_client[database_name][collection_name].find()))
+        collection = get_mongo_client()[database_name][collection_name]
+        query = query or {}
+        if batch_size is not None:
+            #_id is excluded on the server so it is never transferred
+            logging.info(f"Streaming documents with cursor batch size : {batch_size}")
+            cursor = collection.find(query, projection={"_id": 0}, batch_size=batch_size)
+            df = cursor_to_dataframe(cursor=cursor, batch_size=batch_size)
+        else:
+            df = pd.DataFrame(list(collection.find(query)))
         logging.info(f"found columns : {df.columns}")
         if "_id" in df.columns:
             logging.info("Dropping column : _id")
@@ -21,6 +37,180 @@ def get_collection_as_dataframe(database_name:str, collection_name:str)->pd.Data
         raise InsuranceException(e, sys)
 
 
+def _append_batch_to_columns(columns:dict, batch:list, n_rows:int)->int:
+    try:
+        for document in batch:
+            for key in document:
+                if key not in columns:
+                    #field first seen in this batch, earlier rows are missing it
+                    columns[key] = [np.full(n_rows, None, dtype=object)] if n_rows else []
+        for name, chunks in columns.items():
+            #let pandas pick the narrowest dtype (int64, float64, bool or object) for this batch
+            chunks.append(pd.Series([document.get(name) for document in batch]).to_numpy())
+        return n_rows + len(batch)
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def columns_to_dataframe(data:dict)->pd.DataFrame:
+    #every column stays its own block, so numeric columns of a columnar dataframe remain views into their memory
+    #mapped files. pandas 2 keeps the arrays of a dict as they are with copy=False, older versions consolidate
+    #columns of the same dtype into one block, copying them into memory, hence pandas>=2.0 in requirements.txt.
+    #Operations that consolidate later (e.g. to_numpy over several columns) still copy.
+    try:
+        return pd.DataFrame(data, copy=False)
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def cursor_to_dataframe(cursor, batch_size:int)->pd.DataFrame:
+    try:
+        columns = dict()
+        n_rows = 0
+        batch = []
+        for document in cursor:
+            batch.append(document)
+            if len(batch) == batch_size:
+                n_rows = _append_batch_to_columns(columns=columns, batch=batch, n_rows=n_rows)
+                batch = []
+        if len(batch) > 0:
+            n_rows = _append_batch_to_columns(columns=columns, batch=batch, n_rows=n_rows)
+
+        #concatenate one column at a time so only a single column is ever held twice. Batches can infer different
+        #dtypes (int64, float64 when a value is None, object when all of them are), those are joined as objects and
+        #inferred again so the column gets the dtype a single list of all documents would give, whatever the batch size
+        data = dict()
+        for name in list(columns.keys()):
+            chunks = columns.pop(name)
+            if len({chunk.dtype for chunk in chunks}) > 1 and not all(chunk.dtype.kind in "iuf" for chunk in chunks):
+                chunks = [chunk.astype(object) for chunk in chunks]
+            data[name] = pd.Series(np.concatenate(chunks) if len(chunks) > 0 else np.empty(0, dtype=object), copy=False).infer_objects()
+        return columns_to_dataframe(data=data)
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def get_partition_boundaries(collection, partition_field:str, num_partitions:int)->list:
+    try:
+        #split points are read from the (indexed) partition field so each range holds roughly the same number of documents.
+        #Every split point is one skip/limit probe, the server walks the index to it and a single value is returned,
+        #nothing is iterated on the client
+        query = {partition_field: {"$ne": None}}
+        total_documents = collection.count_documents(query)
+        split_positions = sorted({partition_number*total_documents//num_partitions for partition_number in range(1, num_partitions)} - {0})
+        boundaries = []
+        for split_position in split_positions:
+            documents = list(collection.find(query, projection={partition_field: 1}).sort(partition_field, 1).skip(split_position).limit(1))
+            if len(documents) > 0 and (len(boundaries) == 0 or documents[0][partition_field] != boundaries[-1]):
+                boundaries.append(documents[0][partition_field])
+        return boundaries
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def get_partition_queries(partition_field:str, boundaries:list)->list:
+    #one range per pair of boundaries, plus a last query for documents with a missing or null partition field,
+    #which match none of the ranges
+    try:
+        if len(boundaries) == 0:
+            return [{}]
+        lower_bounds = [None] + boundaries
+        upper_bounds = boundaries + [None]
+        queries = []
+        for lower_bound, upper_bound in zip(lower_bounds, upper_bounds):
+            condition = dict()
+            if lower_bound is not None:
+                condition["$gte"] = lower_bound
+            if upper_bound is not None:
+                condition["$lt"] = upper_bound
+            queries.append({partition_field: condition})
+        queries.append({partition_field: None})
+        return queries
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def _read_partition_as_dataframe(collection, partition_field:str, query:dict, batch_size:int)->pd.DataFrame:
+    try:
+        cursor = collection.find(query, projection={"_id": 0}, batch_size=batch_size).sort(partition_field, 1)
+        return cursor_to_dataframe(cursor=cursor, batch_size=batch_size)
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def get_collection_as_dataframe_parallel(database_name:str, collection_name:str, num_partitions:int,
+                                         partition_field:str="_id", batch_size:Optional[int]=PARTITION_BATCH_SIZE)->pd.DataFrame:
+    try:
+        logging.info(f"Reading data from database : {database_name} and collection : {collection_name} in {num_partitions} partitions on field : {partition_field}")
+        collection = get_mongo_client()[database_name][collection_name]
+        #partitions are always streamed in batches, a whole partition is never buffered as one list of documents
+        batch_size = batch_size or PARTITION_BATCH_SIZE
+        boundaries = get_partition_boundaries(collection=collection, partition_field=partition_field, num_partitions=num_partitions)
+        queries = get_partition_queries(partition_field=partition_field, boundaries=boundaries)
+        logging.info(f"Reading {len(queries)} ranges with a thread pool")
+
+        #pymongo clients are thread safe, every worker takes its own connection from the pool
+        with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+            frames = list(executor.map(lambda query: _read_partition_as_dataframe(collection=collection, partition_field=partition_field,
+                                                                                    query=query, batch_size=batch_size),
+                                       queries))
+
+        #ranges are concatenated in partition field order, documents without the field come last. Like batches,
+        #partitions can infer different dtypes for a column, they are inferred again on the whole column
+        frames = [frame for frame in frames if len(frame.columns) > 0]
+        df = pd.concat(frames, ignore_index=True).infer_objects() if len(frames) > 0 else pd.DataFrame()
+        logging.info(f"Rows and columns in df : {df.shape}")
+        return df
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def get_max_field_value(database_name:str, collection_name:str, field:str):
+    try:
+        collection = get_mongo_client()[database_name][collection_name]
+        document = next(collection.find({field: {"$exists": True}}, projection={field: 1}).sort(field, -1).limit(1), None)
+        return None if document is None else document[field]
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def profile_collection(database_name:str, collection_name:str, numeric_fields:list, categorical_fields:list,
+                       query:Optional[dict]=None, missing_values:Optional[list]=None)->dict:
+    try:
+        missing_values = [None, "na"] if missing_values is None else missing_values
+        #a single $group pass on the server, only one small document comes back
+        logging.info(f"Profiling collection : {collection_name} with an aggregation pipeline")
+        group = {"_id": None, "count": {"$sum": 1}}
+        fields = numeric_fields + categorical_fields
+        for position, field in enumerate(fields):
+            group[f"null_count_{position}"] = {"$sum": {"$cond": [{"$in": [{"$ifNull": [f"${field}", None]}, missing_values]}, 1, 0]}}
+        for position, field in enumerate(numeric_fields):
+            #numbers sort before strings in BSON order so this keeps numbers and drops "na" like values
+            numeric_value = {"$cond": [{"$lt": [f"${field}", ""]}, f"${field}", None]}
+            group[f"min_{position}"] = {"$min": numeric_value}
+            group[f"max_{position}"] = {"$max": numeric_value}
+            group[f"sum_{position}"] = {"$sum": numeric_value}
+        for position, field in enumerate(categorical_fields):
+            group[f"distinct_{position}"] = {"$addToSet": f"${field}"}
+
+        pipeline = ([{"$match": query}] if query else []) + [{"$group": group}]
+        result = next(get_mongo_client()[database_name][collection_name].aggregate(pipeline), {"count": 0})
+
+        count = result["count"]
+        profile = {"count": count, "fields": dict()}
+        for position, field in enumerate(fields):
+            profile["fields"][field] = {"null_ratio": result.get(f"null_count_{position}", 0)/count if count else None}
+        for position, field in enumerate(numeric_fields):
+            profile["fields"][field]["min"] = result.get(f"min_{position}")
+            profile["fields"][field]["max"] = result.get(f"max_{position}")
+            profile["fields"][field]["sum"] = result.get(f"sum_{position}")
+        for position, field in enumerate(categorical_fields):
+            profile["fields"][field]["distinct_values"] = sorted(value for value in result.get(f"distinct_{position}", []) if value not in missing_values)
+        return profile
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
 def convert_columns_float(df:pd.DataFrame, exclude_columns:list)->pd.DataFrame:
     try:
         for column in df.columns:
@@ -34,13 +224,198 @@ def convert_columns_float(df:pd.DataFrame, exclude_columns:list)->pd.DataFrame:
 def write_yaml_file(file_path, data:dict):
     try:
         file_dir = os.path.dirname(file_path)
-        os.makedirs(file_dir, exist_ok=True)
+        if file_dir:
+            os.makedirs(file_dir, exist_ok=True)
         with open(file_path, "w") as file_writer:
             yaml.dump(data, file_writer)
     except Exception as e:
         raise InsuranceException(e, sys)
 
 
+def read_yaml_file(file_path:str)->dict:
+    try:
+        with open(file_path, "rb") as yaml_file:
+            return yaml.safe_load(yaml_file)
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def get_dataframe_path(file_path:str, file_format:str)->str:
+    try:
+        #columnar dataframes are stored in a directory named like the csv file without its extension
+        if file_format == "npy":
+            return os.path.splitext(file_path)[0]
+        if file_format == "csv":
+            return file_path
+        raise Exception(f"Unsupported dataframe file format : {file_format}")
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def save_columnar_dataframe(dir_path:str, df:pd.DataFrame)->None:
+    try:
+        os.makedirs(dir_path, exist_ok=True)
+        schema = {"num_rows": int(df.shape[0]), "columns": []}
+        for position, column in enumerate(df.columns):
+            file_name = f"{position:04d}.npy"
+            values = df[column]
+            column_schema = {"name": column, "file": file_name, "dtype": str(values.dtype)}
+            if values.dtype == 'O':
+                #object columns are dictionary encoded so they can be memory mapped as well, -1 marks a missing value
+                categorical = pd.Categorical(values)
+                column_schema["categories"] = categorical.categories.tolist()
+                array = categorical.codes
+            else:
+                array = np.ascontiguousarray(values.to_numpy())
+            np.save(os.path.join(dir_path, file_name), array)
+            schema["columns"].append(column_schema)
+        write_yaml_file(file_path=os.path.join(dir_path, SCHEMA_FILE_NAME), data=schema)
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def _decode_column(values:np.ndarray, column_schema:dict)->np.ndarray:
+    if "categories" in column_schema:
+        categories = np.array(column_schema["categories"] + [np.nan], dtype=object)
+        return categories[values]
+    if str(values.dtype) != column_schema["dtype"]:
+        raise Exception(f"Column : {column_schema['name']} has dtype {values.dtype}, schema expects {column_schema['dtype']}")
+    return values
+
+
+def load_columnar_dataframe(dir_path:str, mmap_mode:Optional[str]="c")->pd.DataFrame:
+    try:
+        schema = read_yaml_file(file_path=os.path.join(dir_path, SCHEMA_FILE_NAME))
+        data = dict()
+        for column_schema in schema["columns"]:
+            values = np.load(os.path.join(dir_path, column_schema["file"]), mmap_mode=mmap_mode)
+            data[column_schema["name"]] = _decode_column(values=values, column_schema=column_schema)
+        return columns_to_dataframe(data=data)
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+class ColumnarDataFrameWriter:
+    #fills preallocated memory mapped columns chunk by chunk, the layout (row count, dtypes and
+    #categories of object columns) has to be known up front, e.g. from a first pass over the data
+    def __init__(self, dir_path:str, num_rows:int, layout:dict):
+        try:
+            os.makedirs(dir_path, exist_ok=True)
+            self.dir_path = dir_path
+            self.schema = {"num_rows": int(num_rows), "columns": []}
+            self.arrays = dict()
+            self.category_indexes = dict()
+            self.offset = 0
+            for position, (column, column_layout) in enumerate(layout.items()):
+                file_name = f"{position:04d}.npy"
+                column_schema = {"name": column, "file": file_name, "dtype": column_layout["dtype"]}
+                dtype = column_layout["dtype"]
+                if column_layout.get("categories") is not None:
+                    column_schema["categories"] = sorted(column_layout["categories"])
+                    self.category_indexes[column] = pd.Index(column_schema["categories"])
+                    dtype = pd.Categorical([], categories=self.category_indexes[column]).codes.dtype
+                self.arrays[column] = np.lib.format.open_memmap(os.path.join(dir_path, file_name), mode="w+", dtype=dtype, shape=(int(num_rows),))
+                self.schema["columns"].append(column_schema)
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def write(self, df:pd.DataFrame):
+        try:
+            stop = self.offset + df.shape[0]
+            for column, array in self.arrays.items():
+                if column in self.category_indexes:
+                    array[self.offset:stop] = self.category_indexes[column].get_indexer(df[column])
+                else:
+                    array[self.offset:stop] = df[column].to_numpy()
+            self.offset = stop
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+    def close(self):
+        try:
+            if self.offset != self.schema["num_rows"]:
+                raise Exception(f"Wrote {self.offset} rows into {self.dir_path}, expected {self.schema['num_rows']}")
+            for array in self.arrays.values():
+                array.flush()
+            write_yaml_file(file_path=os.path.join(self.dir_path, SCHEMA_FILE_NAME), data=self.schema)
+        except Exception as e:
+            raise InsuranceException(e, sys)
+
+
+def update_columnar_layout(layout:dict, df:pd.DataFrame)->dict:
+    try:
+        for column in df.columns:
+            column_layout = layout.setdefault(column, {"dtype": None, "categories": None})
+            if df[column].dtype == 'O' or column_layout["categories"] is not None:
+                column_layout["dtype"] = "object"
+                column_layout["categories"] = set(column_layout["categories"] or []).union(df[column].dropna().unique().tolist())
+            elif column_layout["dtype"] is None:
+                column_layout["dtype"] = str(df[column].dtype)
+            else:
+                column_layout["dtype"] = str(np.result_type(column_layout["dtype"], df[column].dtype))
+        return layout
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def iter_dataframe_chunks(file_path:str, chunk_size:int):
+    try:
+        if not os.path.isdir(file_path):
+            yield from pd.read_csv(file_path, chunksize=chunk_size)
+            return
+        #columnar chunks are sliced from the memory mapped columns, object columns are decoded one chunk at a time
+        schema = read_yaml_file(file_path=os.path.join(file_path, SCHEMA_FILE_NAME))
+        columns = [(column_schema, np.load(os.path.join(file_path, column_schema["file"]), mmap_mode="r")) for column_schema in schema["columns"]]
+        for start in range(0, schema["num_rows"], chunk_size):
+            yield columns_to_dataframe(data={column_schema["name"]: _decode_column(values=np.array(values[start:start+chunk_size]), column_schema=column_schema)
+                                             for column_schema, values in columns})
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def get_hash_split_mask(df:pd.DataFrame, test_size:float, key_columns:Optional[list]=None)->np.ndarray:
+    try:
+        #numeric columns are hashed as float64 and columns in name order so the
+        #assignment of a row does not depend on dtype inference or column order
+        keys = df[sorted(df.columns) if key_columns is None else key_columns]
+        keys = keys.apply(lambda column: column.astype("float64") if column.dtype != 'O' else column)
+        hashes = pd.util.hash_pandas_object(keys, index=False).to_numpy()
+        return (hashes % 10000) < int(round(test_size*10000))
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def save_dataframe(file_path:str, df:pd.DataFrame, file_format:str="csv")->None:
+    try:
+        if file_format == "npy":
+            save_columnar_dataframe(dir_path=file_path, df=df)
+        else:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            df.to_csv(path_or_buf=file_path, index=False, header=True)
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def load_dataframe(file_path:str)->pd.DataFrame:
+    try:
+        if os.path.isdir(file_path):
+            return load_columnar_dataframe(dir_path=file_path)
+        return pd.read_csv(file_path)
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
+def get_file_hash(file_path:str, chunk_size:int=1024*1024)->str:
+    try:
+        file_hash = hashlib.sha256()
+        with open(file_path, "rb") as file_obj:
+            for block in iter(lambda: file_obj.read(chunk_size), b""):
+                file_hash.update(block)
+        return file_hash.hexdigest()
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
 def save_object(file_path:str, obj:object)->None:
     try:
         logging.info("Entered the save_object method of utils")
@@ -52,6 +427,20 @@ def save_object(file_path:str, obj:object)->None:
         raise InsuranceException(e, sys)
 
 
+def link_file(src_file_path:str, dst_file_path:str)->None:
+    #dst becomes a hard link to src so both paths share one copy, a copy is made when linking is not possible
+    #(e.g. the two paths are on different file systems)
+    try:
+        os.makedirs(os.path.dirname(dst_file_path), exist_ok=True)
+        try:
+            os.link(src_file_path, dst_file_path)
+        except OSError as e:
+            logging.info(f"Could not link {src_file_path} to {dst_file_path}, copying it : {e}")
+            shutil.copyfile(src_file_path, dst_file_path)
+    except Exception as e:
+        raise InsuranceException(e, sys)
+
+
 def load_object(file_path:str)->object:
     try:
         if not os.path.exists(file_path):
@@ -71,8 +460,10 @@ def save_numpy_array_data(file_path:str, array:np.array):
         raise InsuranceException(e, sys)
 
 
-def load_numpy_array_data(file_path:str)->np.array:
+def load_numpy_array_data(file_path:str, mmap_mode:Optional[str]=None)->np.array:
     try:
+        if mmap_mode is not None:
+            return np.load(file_path, mmap_mode=mmap_mode)
         with open(file_path, "rb") as file_obj:
             return np.load(file_obj)
     except Exception as e:
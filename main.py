@@ -2,14 +2,7 @@ from insurance.logger import logging
 from insurance.exception import InsuranceException
 import os, sys
 from insurance.utils import get_collection_as_dataframe
-from insurance.entity import config_entity
-from insurance.entity.config_entity import DataIngestionConfig
-from insurance.components.data_ingestion import DataIngestion
-from insurance.components.data_validation import DataValidation
-from insurance.components.data_transformation import DataTransformation
-from insurance.components.model_trainer import ModelTrainer
-from insurance.components.model_evaluation import ModelEvaluation
-from insurance.components.model_pusher import ModelPusher
+from insurance.pipeline.training_pipeline import start_training_pipeline
 
 
 #def test_logger_and_exception():
@@ -27,43 +20,6 @@ if __name__ == "__main__":
     try:
         #test_logger_and_exception()
         #get_collection_as_dataframe(database_name="INSURANCE", collection_name="INSURANCE_PREMIUM")
-        training_pipeline_config = config_entity.TrainingPipelineConfig()
-        # data ingestion config
-        data_ingestion_config = config_entity.DataIngestionConfig(training_pipeline_config = training_pipeline_config)
-        print(data_ingestion_config.to_dict())
-        data_ingestion = DataIngestion(data_ingestion_config=data_ingestion_config)
-        data_ingestion_artifact = data_ingestion.initiate_data_ingestion()
-
-        #data validation config
-
-        data_validation_config = config_entity.DataValidationConfig(training_pipeline_config = training_pipeline_config)
-        data_validation = DataValidation(data_validation_config=data_validation_config, data_ingestion_artifact=data_ingestion_artifact)
-        data_validation_artifact = data_validation.initiate_data_validation()
-
-
-        #data transformation config
-        data_transformation_config = config_entity.DataTransformationConfig(training_pipeline_config=training_pipeline_config)
-        data_transformation = DataTransformation(data_transformation_config=data_transformation_config, data_ingestion_artifact=data_ingestion_artifact)
-        data_transformation_artifact = data_transformation.initiate_data_transformation()
-
-
-        #model trainer 
-        model_trainer_config = config_entity.ModelTrainerConfig(training_pipeline_config=training_pipeline_config)
-        model_trainer = ModelTrainer(model_trainer_config=model_trainer_config, data_transformation_artifact=data_transformation_artifact)
-        model_trainer_artifact = model_trainer.initiate_model_trainer()
-    
-
-
-        #model evaluation
-
-        model_evaluation_config = config_entity.ModelEvaluationConfig(training_pipeline_config=training_pipeline_config)
-        model_evaluation = ModelEvaluation(model_evaluation_config=model_evaluation_config, data_ingestion_artifact=data_ingestion_artifact, data_transformation_artifact=data_transformation_artifact, model_trainer_artifact=model_trainer_artifact)
-        model_evaluation_artifact = model_evaluation.initiate_model_evaluation()
-
-
-        #model pusher
-        model_pusher_config = config_entity.ModelPusherConfig(training_pipeline_config=training_pipeline_config)
-        model_pusher = ModelPusher(model_pusher_config=model_pusher_config, data_transformation_artifact=data_transformation_artifact, model_trainer_artifact=model_trainer_artifact)
-        model_pusher_artifact= model_pusher.initiate_model_pusher()
+        start_training_pipeline()
     except Exception as e:
         print(e)
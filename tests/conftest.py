@@ -0,0 +1,20 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from insurance import config
+
+
+@pytest.fixture
+def mongo_client(monkeypatch):
+    #get_mongo_client returns the cached client, so every component talks to the in-memory server
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(config, "_mongo_client", client)
+    return client
+
+
+@pytest.fixture(autouse=True)
+def work_dir(tmp_path, monkeypatch):
+    #artifacts, saved_models and stage_cache are relative to the working dir
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
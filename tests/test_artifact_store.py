@@ -0,0 +1,38 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from insurance import utils
+from insurance.artifact_store import ArtifactStore, write_atomically
+
+
+def test_failed_write_keeps_previous_artifact(work_dir):
+    file_path = os.path.join("artifact", "model.pkl")
+    utils.save_object(file_path=file_path, obj={"version": 1})
+
+    def write(path:str):
+        with open(path, "wb") as file_obj:
+            file_obj.write(b"trunc")
+        raise IOError("disk full")
+
+    with pytest.raises(IOError):
+        write_atomically(file_path=file_path, write=write)
+    assert utils.load_object(file_path=file_path) == {"version": 1}
+    assert os.listdir("artifact") == ["model.pkl"]
+
+
+@pytest.mark.parametrize("enabled", [True, False])
+@pytest.mark.parametrize("file_format", ["csv", "npy"])
+def test_artifacts_are_complete_after_flush(work_dir, enabled:bool, file_format:str):
+    artifact_store = ArtifactStore()
+    artifact_store.enabled = enabled
+    df = pd.DataFrame({"age": [19, 33, 45], "region": ["north", None, "south"]})
+    for _ in range(2):
+        #the second save replaces the files and directories of the first
+        dataframe_path = artifact_store.save_dataframe(file_path=os.path.join("artifact", "train.csv"), df=df, file_format=file_format)
+        artifact_store.save_numpy_array_data(file_path=os.path.join("artifact", "train.npy"), array=np.arange(6.0))
+    artifact_store.flush()
+    pd.testing.assert_frame_equal(utils.load_dataframe(file_path=dataframe_path), df, check_dtype=False)
+    np.testing.assert_array_equal(utils.load_numpy_array_data(file_path=os.path.join("artifact", "train.npy")), np.arange(6.0))
+    assert sorted(os.listdir("artifact")) == sorted([os.path.basename(dataframe_path), "train.npy"])
+    artifact_store.clear()
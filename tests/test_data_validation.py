@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+import pytest
+from insurance.components.data_validation import DataValidation
+from insurance.entity import config_entity
+from insurance.sketch import CategoryCounter, QuantileSketch
+
+
+def get_data_validation(chunk_size:int)->DataValidation:
+    data_validation_config = config_entity.DataValidationConfig(training_pipeline_config=config_entity.TrainingPipelineConfig())
+    data_validation_config.chunk_size = chunk_size
+    return DataValidation(data_validation_config=data_validation_config, data_ingestion_artifact=None)
+
+
+@pytest.mark.parametrize("chunk_size", [2, 3, 100])
+def test_column_kinds_do_not_depend_on_the_first_chunk(work_dir, chunk_size:int):
+    #region has no value in the first chunks, empty is missing everywhere
+    df = pd.DataFrame({"age": [19, 33, 45, 28, 61, 50], "region": [None, None, "north", "south", "north", None],
+                       "empty": [np.nan]*6})
+    df.to_csv("current.csv", index=False)
+    summaries, num_rows = get_data_validation(chunk_size=chunk_size).summarize_file(file_path="current.csv")
+    assert num_rows == 6
+    assert list(summaries) == ["age", "region", "empty"]
+    assert isinstance(summaries["region"], CategoryCounter)
+    assert summaries["region"].counts == {"north": 2, "south": 1}
+    assert summaries["region"].null_count == 3
+    assert isinstance(summaries["age"], QuantileSketch) and summaries["age"].n == 6
+    assert isinstance(summaries["empty"], QuantileSketch) and summaries["empty"].null_count == 6
+
+
+def test_known_column_kinds_are_used(work_dir):
+    pd.DataFrame({"children": [0, 1, 2, 3]}).to_csv("current.csv", index=False)
+    summaries, _ = get_data_validation(chunk_size=2).summarize_file(file_path="current.csv", categorical_columns={"children": True})
+    assert isinstance(summaries["children"], CategoryCounter)
+    assert summaries["children"].n == 4
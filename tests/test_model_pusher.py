@@ -0,0 +1,78 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.impute import SimpleImputer
+from sklearn.linear_model import LinearRegression
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import RobustScaler
+from insurance import utils
+from insurance.bundle import load_bundle, read_bundle_file_header
+from insurance.components.model_pusher import ModelPusher
+from insurance.entity import config_entity
+from insurance.entity.artifact_entity import DataTransformationArtifact, ModelTrainerArtifact
+from insurance.predictor import ModelResolver
+from insurance.artifact_store import artifact_store
+
+
+def get_model_pusher(content_addressed_storage:bool)->ModelPusher:
+    training_pipeline_config = config_entity.TrainingPipelineConfig()
+    model_pusher_config = config_entity.ModelPusherConfig(training_pipeline_config=training_pipeline_config)
+    model_pusher_config.content_addressed_storage = content_addressed_storage
+    random_state = np.random.default_rng(3)
+    X = pd.DataFrame(random_state.normal(size=(200, 3)), columns=["age", "bmi", "children"])
+    y = X.to_numpy() @ np.array([250.0, 320.0, 450.0]) + 1000.0
+    transformer = Pipeline(steps=[("Imputer", SimpleImputer(strategy="median")), ("RobustScaler", RobustScaler())]).fit(X)
+    model = LinearRegression().fit(transformer.transform(X), y)
+
+    transformation_dir = os.path.join(training_pipeline_config.artifact_dir, "data_transformation")
+    data_transformation_artifact = DataTransformationArtifact(
+        transform_object_path=os.path.join(transformation_dir, "transformer", config_entity.TRANSFORMER_OBJECT_FILE_NAME),
+        transformed_train_path=None, transformed_test_path=None,
+        target_encoder_path=os.path.join(transformation_dir, "target_encoder", config_entity.TARGET_OBJECT_FILE_NAME))
+    model_trainer_artifact = ModelTrainerArtifact(model_path=os.path.join(training_pipeline_config.artifact_dir, "model_trainer", "model", config_entity.MODEL_FILE_NAME),
+                                                  r2_train_score=0.9, r2_test_score=0.88)
+    utils.save_object(file_path=data_transformation_artifact.transform_object_path, obj=transformer)
+    utils.save_object(file_path=data_transformation_artifact.target_encoder_path, obj={"sex": {"female": 0, "male": 1}})
+    utils.save_object(file_path=model_trainer_artifact.model_path, obj=model)
+    return ModelPusher(model_pusher_config=model_pusher_config, data_transformation_artifact=data_transformation_artifact,
+                       model_trainer_artifact=model_trainer_artifact)
+
+
+@pytest.fixture(autouse=True)
+def write_through():
+    enabled = artifact_store.enabled
+    artifact_store.enabled = False
+    yield
+    artifact_store.enabled = enabled
+
+
+@pytest.mark.parametrize("content_addressed_storage", [True, False])
+def test_pushed_version_shares_the_exported_files(work_dir, content_addressed_storage:bool):
+    model_pusher = get_model_pusher(content_addressed_storage=content_addressed_storage)
+    model_export_artifact = model_pusher.export_model()
+    model_pusher.initiate_model_pusher(model_export_artifact=model_export_artifact)
+
+    model_resolver = ModelResolver(model_registry=model_pusher.model_pusher_config.saved_model_dir)
+    bundle_path = model_resolver.get_latest_bundle_path()
+    #one file for the pusher dir and the registry, the version is only in the registry index
+    assert os.path.samefile(bundle_path, model_export_artifact.bundle_path)
+    assert os.path.samefile(model_resolver.get_latest_model_path(), model_export_artifact.model_path)
+    assert os.path.samefile(model_resolver.get_latest_fused_model_path(), model_export_artifact.fused_model_path)
+    header = read_bundle_file_header(file_path=bundle_path)
+    assert "version" not in header and "created_at" not in header
+    assert header["schema"]["model_name"] == "LinearRegression"
+    assert model_resolver.get_registry()["versions"][0]["model_name"] == "LinearRegression"
+    _, objects = load_bundle(file_path=bundle_path)
+    assert set(objects) == {"transformer", "target_encoder", "model", "fused_model"}
+
+
+def test_identical_models_share_one_blob(work_dir):
+    model_pusher = get_model_pusher(content_addressed_storage=True)
+    model_export_artifact = model_pusher.export_model()
+    for _ in range(2):
+        model_pusher.initiate_model_pusher(model_export_artifact=model_export_artifact)
+    model_resolver = ModelResolver(model_registry=model_pusher.model_pusher_config.saved_model_dir)
+    assert [entry["version"] for entry in model_resolver.get_registry()["versions"]] == [0, 1]
+    assert os.path.samefile(os.path.join(model_resolver.model_registry, "0", config_entity.BUNDLE_FILE_NAME),
+                            os.path.join(model_resolver.model_registry, "1", config_entity.BUNDLE_FILE_NAME))
@@ -0,0 +1,108 @@
+import os
+import numpy as np
+import pytest
+from insurance import utils
+from insurance.components import model_trainer
+from insurance.components.model_trainer import ModelTrainer
+from insurance.entity import config_entity
+from insurance.entity.artifact_entity import DataIngestionArtifact, DataTransformationArtifact
+from insurance.predictor import ModelResolver
+from insurance.artifact_store import artifact_store
+
+
+def get_transformed_rows(num_rows:int, seed:int)->np.ndarray:
+    #scaled features with the target in the last column, like the transformed arrays
+    random_state = np.random.default_rng(seed)
+    X = random_state.normal(size=(num_rows, 6))
+    y = X @ np.array([3.0, -1.0, 4.0, 0.5, 20.0, -2.0]) + 13.0 + random_state.normal(scale=0.5, size=num_rows)
+    return np.column_stack([X, y])
+
+
+def get_model_trainer(work_dir, train_arr:np.ndarray, test_arr:np.ndarray, partitions:list, warm_start:bool)->ModelTrainer:
+    training_pipeline_config = config_entity.TrainingPipelineConfig()
+    model_trainer_config = config_entity.ModelTrainerConfig(training_pipeline_config=training_pipeline_config)
+    model_trainer_config.sufficient_statistics = True
+    model_trainer_config.chunk_size = 64
+    model_trainer_config.warm_start = warm_start
+    transformed_dir = os.path.join(training_pipeline_config.artifact_dir, "data_transformation")
+    data_transformation_artifact = DataTransformationArtifact(
+        transform_object_path=os.path.join(transformed_dir, "transformer", config_entity.TRANSFORMER_OBJECT_FILE_NAME),
+        transformed_train_path=os.path.join(transformed_dir, "transformed", "train.npy"),
+        transformed_test_path=os.path.join(transformed_dir, "transformed", "test.npy"),
+        target_encoder_path=os.path.join(transformed_dir, "target_encoder", config_entity.TARGET_OBJECT_FILE_NAME))
+    #the transformer is reused between ingests, warm start checks that the pushed one is the same file
+    utils.save_object(file_path=data_transformation_artifact.transform_object_path, obj={"transformer": "reused"})
+    utils.save_numpy_array_data(file_path=data_transformation_artifact.transformed_train_path, array=train_arr)
+    utils.save_numpy_array_data(file_path=data_transformation_artifact.transformed_test_path, array=test_arr)
+    data_ingestion_artifact = DataIngestionArtifact(feature_store_file_path=None, train_file_path=None, test_file_path=None,
+                                                    partition_file_paths=[os.path.join(str(work_dir), partition) for partition in partitions],
+                                                    split_mode="hash")
+    return ModelTrainer(model_trainer_config=model_trainer_config, data_transformation_artifact=data_transformation_artifact,
+                        data_ingestion_artifact=data_ingestion_artifact)
+
+
+def push(trainer:ModelTrainer):
+    artifact_store.flush()
+    model_resolver = ModelResolver(model_registry=trainer.model_trainer_config.saved_model_dir)
+    version, staging_dir = model_resolver.allocate_version()
+    utils.save_object(file_path=model_resolver.get_latest_save_statistics_path(dir_path=staging_dir),
+                      obj=utils.load_object(file_path=trainer.model_trainer_config.statistics_path))
+    utils.save_object(file_path=model_resolver.get_latest_save_transformer_path(dir_path=staging_dir),
+                      obj=utils.load_object(file_path=trainer.data_transformation_artifact.transform_object_path))
+    model_resolver.publish_version(version=version, staging_dir=staging_dir)
+
+
+@pytest.fixture(autouse=True)
+def write_through():
+    enabled = artifact_store.enabled
+    artifact_store.enabled = False
+    yield
+    artifact_store.enabled = enabled
+
+
+def test_warm_start_over_two_ingests_matches_full_solve(work_dir, monkeypatch):
+    first_train, first_test = get_transformed_rows(300, seed=1), get_transformed_rows(80, seed=2)
+    second_train, second_test = get_transformed_rows(170, seed=3), get_transformed_rows(40, seed=4)
+    first_trainer = get_model_trainer(work_dir, first_train, first_test, partitions=["part-0"], warm_start=True)
+    first_trainer.train_from_statistics()
+    push(first_trainer)
+
+    start_rows = []
+    compute_statistics = model_trainer.compute_statistics
+    def spy_compute_statistics(file_path, chunk_size, workers=1, start_row=0):
+        start_rows.append(start_row)
+        return compute_statistics(file_path=file_path, chunk_size=chunk_size, workers=workers, start_row=start_row)
+    monkeypatch.setattr(model_trainer, "compute_statistics", spy_compute_statistics)
+
+    #rows of the second ingest are appended after the rows of the first, partition by partition
+    train_arr, test_arr = np.vstack([first_train, second_train]), np.vstack([first_test, second_test])
+    warm_model, warm_r2_train, warm_r2_test = get_model_trainer(work_dir, train_arr, test_arr, partitions=["part-0", "part-1"], warm_start=True).train_from_statistics()
+    assert start_rows == [300, 80]
+
+    full_model, full_r2_train, full_r2_test = get_model_trainer(work_dir, train_arr, test_arr, partitions=["part-0", "part-1"], warm_start=False).train_from_statistics()
+    np.testing.assert_allclose(warm_model.coef_, full_model.coef_, rtol=1e-9)
+    assert warm_model.intercept_ == pytest.approx(full_model.intercept_, rel=1e-9)
+    assert warm_r2_train == pytest.approx(full_r2_train, rel=1e-9)
+    assert warm_r2_test == pytest.approx(full_r2_test, rel=1e-9)
+
+    #and both match least squares on all rows
+    z = np.column_stack([train_arr[:, :-1], np.ones(train_arr.shape[0])])
+    weights = np.linalg.lstsq(z, train_arr[:, -1], rcond=None)[0]
+    np.testing.assert_allclose(warm_model.coef_, weights[:-1], rtol=1e-7)
+
+
+def test_warm_start_falls_back_when_partitions_are_not_a_prefix(work_dir):
+    first_trainer = get_model_trainer(work_dir, get_transformed_rows(200, seed=1), get_transformed_rows(50, seed=2), partitions=["part-0"], warm_start=True)
+    first_trainer.train_from_statistics()
+    push(first_trainer)
+    trainer = get_model_trainer(work_dir, get_transformed_rows(250, seed=5), get_transformed_rows(60, seed=6), partitions=["part-1", "part-2"], warm_start=True)
+    assert trainer.load_warm_start_state() is None
+
+
+def test_search_leaves_failing_candidates_out(work_dir):
+    trainer = get_model_trainer(work_dir, get_transformed_rows(200, seed=5), get_transformed_rows(50, seed=6), partitions=["part-0"], warm_start=False)
+    trainer.model_trainer_config.search_candidates = {"linear_regression": [{}], "ridge": [{"alpha": "not a number"}]}
+    trainer.model_trainer_config.search_workers = 2
+    leaderboard = trainer.search_model()
+    assert [(entry["name"], entry["status"]) for entry in leaderboard] == [("linear_regression", "finished"), ("ridge", "failed")]
+    assert leaderboard[0]["folds"] == trainer.model_trainer_config.search_folds
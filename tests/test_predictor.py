@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.impute import SimpleImputer
+from sklearn.linear_model import LinearRegression, Ridge
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import RobustScaler, StandardScaler, MinMaxScaler
+from insurance.predictor import FusedLinearPredictor, ModelResolver
+
+FEATURE_NAMES = ["age", "sex", "bmi", "children", "smoker", "region"]
+
+
+def get_training_data(num_rows:int=500, seed:int=7)->tuple:
+    random_state = np.random.default_rng(seed)
+    X = pd.DataFrame(random_state.normal(loc=[40, 0.5, 30, 1, 0.2, 1.5], scale=[12, 0.5, 6, 1, 0.4, 1.1], size=(num_rows, len(FEATURE_NAMES))),
+                     columns=FEATURE_NAMES)
+    y = X.to_numpy() @ np.array([250.0, -100.0, 320.0, 450.0, 23000.0, -300.0]) + random_state.normal(scale=500, size=num_rows)
+    X[random_state.random(X.shape) < 0.05] = np.nan
+    return X, y
+
+
+@pytest.mark.parametrize("steps", [
+    [("Imputer", SimpleImputer(strategy="constant", fill_value=0)), ("RobustScaler", RobustScaler())],
+    [("Imputer", SimpleImputer(strategy="median")), ("StandardScaler", StandardScaler())],
+    [("Imputer", SimpleImputer(strategy="mean")), ("StandardScaler", StandardScaler(with_mean=False))],
+    [("Imputer", SimpleImputer(strategy="mean")), ("RobustScaler", RobustScaler(with_centering=False)), ("StandardScaler", StandardScaler())],
+])
+@pytest.mark.parametrize("model", [LinearRegression(), Ridge(alpha=3.0)])
+def test_fused_model_matches_transformer_and_model(steps, model):
+    X, y = get_training_data()
+    transformer = Pipeline(steps=steps).fit(X)
+    model.fit(transformer.transform(X), y)
+    fused_model = FusedLinearPredictor.compile(transformer=transformer, model=model)
+    assert fused_model is not None
+
+    X_test, _ = get_training_data(num_rows=200, seed=11)
+    #whole rows missing as well as single values
+    X_test.iloc[:3] = np.nan
+    assert np.isnan(X_test.to_numpy()).any()
+    expected = model.predict(transformer.transform(X_test))
+    np.testing.assert_allclose(fused_model.predict(X_test.to_numpy()), expected, rtol=1e-9, atol=1e-6)
+    assert fused_model.check_parity(transformer=transformer, model=model) < 1e-6*np.max(np.abs(expected))
+
+
+def test_compile_refuses_steps_it_can_not_fold():
+    X, y = get_training_data()
+    transformer = Pipeline(steps=[("Imputer", SimpleImputer()), ("MinMaxScaler", MinMaxScaler())]).fit(X)
+    model = LinearRegression().fit(transformer.transform(X), y)
+    assert FusedLinearPredictor.compile(transformer=transformer, model=model) is None
+
+
+def test_versions_of_failed_and_removed_pushes_are_not_reused(work_dir):
+    model_resolver = ModelResolver(model_registry="saved_models")
+    for _ in range(2):
+        version, staging_dir = model_resolver.allocate_version()
+        model_resolver.publish_version(version=version, staging_dir=staging_dir)
+    version, staging_dir = model_resolver.allocate_version()
+    assert version == 2
+    model_resolver.discard_version(staging_dir=staging_dir)
+    assert model_resolver.allocate_version()[0] == 3
+
+    #a fresh resolver sees the same counter, removing a version does not free its number
+    model_resolver.remove_version(version=0)
+    assert ModelResolver(model_registry="saved_models").allocate_version()[0] == 4
@@ -0,0 +1,40 @@
+import os
+from datetime import datetime, timedelta
+from insurance import utils
+from insurance.entity import config_entity
+from insurance.entity.artifact_entity import ModelTrainerArtifact
+from insurance.pipeline.stage_cache import StageCache
+from insurance.retention import apply_artifact_retention, RUN_DIR_FORMAT
+
+
+def make_run(artifact_root_dir:str, hours_ago:int, finished:bool=True)->str:
+    run_dir = os.path.join(artifact_root_dir, (datetime.now() - timedelta(hours=hours_ago)).strftime(RUN_DIR_FORMAT))
+    utils.save_object(file_path=os.path.join(run_dir, "model_trainer", "model", config_entity.MODEL_FILE_NAME), obj={"hours_ago": hours_ago})
+    if finished:
+        utils.write_yaml_file(file_path=os.path.join(run_dir, config_entity.PIPELINE_RUN_FILE_NAME), data={})
+    return run_dir
+
+
+def test_artifact_retention_keeps_running_cached_and_linked_runs(work_dir):
+    retention_config = config_entity.RetentionConfig(training_pipeline_config=config_entity.TrainingPipelineConfig())
+    retention_config.keep_last_runs = 3
+    retention_config.hot_runs = 1
+    newest_run = make_run(retention_config.artifact_root_dir, hours_ago=0)
+    linked_run = make_run(retention_config.artifact_root_dir, hours_ago=1)
+    linked_model_path = os.path.join(linked_run, "model_trainer", "model", config_entity.MODEL_FILE_NAME)
+    utils.link_file(src_file_path=linked_model_path, dst_file_path=os.path.join(retention_config.saved_model_dir, "0", "model", config_entity.MODEL_FILE_NAME))
+    compressed_run = make_run(retention_config.artifact_root_dir, hours_ago=2)
+    running_run = make_run(retention_config.artifact_root_dir, hours_ago=3, finished=False)
+    cached_run = make_run(retention_config.artifact_root_dir, hours_ago=4)
+    removed_run = make_run(retention_config.artifact_root_dir, hours_ago=5)
+    StageCache(artifact_dir=cached_run, cache_dir=retention_config.stage_cache_dir).put(
+        stage_name="model_trainer", fingerprint="0"*64,
+        artifact=ModelTrainerArtifact(model_path=os.path.join(cached_run, "model_trainer", "model", config_entity.MODEL_FILE_NAME), r2_train_score=0.9, r2_test_score=0.9))
+
+    removed_runs, compressed_runs = apply_artifact_retention(retention_config=retention_config)
+    assert removed_runs == [removed_run]
+    assert compressed_runs == [compressed_run]
+    #the model linked into the registry is left alone, compressing it would store it twice
+    assert os.path.exists(linked_model_path)
+    for run_dir in [newest_run, running_run, cached_run]:
+        assert os.path.exists(os.path.join(run_dir, "model_trainer", "model", config_entity.MODEL_FILE_NAME))
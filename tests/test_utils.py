@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+import pytest
+from insurance import utils
+
+
+DOCUMENTS = [{"age": 19, "sex": "female", "bmi": 27.9, "children": 0},
+             {"age": None, "sex": "male", "bmi": 33.8, "children": 1},
+             {"age": 28, "sex": None, "bmi": None, "children": 3},
+             {"age": 33, "sex": "male", "bmi": 22.7, "children": 0},
+             {"sex": "male", "bmi": 28.9, "children": 0},
+             {"age": 31, "sex": "female", "bmi": 25.7, "children": 0},
+             {"age": 46, "sex": "female", "bmi": 33.4, "children": 1}]
+
+
+@pytest.fixture
+def collection(mongo_client):
+    collection = mongo_client["INSURANCE"]["INSURANCE_PREMIUM"]
+    collection.insert_many([dict(document) for document in DOCUMENTS])
+    return collection
+
+
+def get_list_dataframe(collection)->pd.DataFrame:
+    return pd.DataFrame(list(collection.find({}, projection={"_id": 0})))
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 3, 100])
+def test_streamed_read_matches_list_read(collection, batch_size):
+    expected = get_list_dataframe(collection)
+    df = utils.get_collection_as_dataframe("INSURANCE", "INSURANCE_PREMIUM", batch_size=batch_size)
+    pd.testing.assert_frame_equal(df, expected)
+    assert df["age"].dtype == np.float64
+
+
+@pytest.mark.parametrize("num_partitions", [2, 3, 5])
+@pytest.mark.parametrize("batch_size", [None, 1, 2])
+def test_parallel_read_matches_serial_read(collection, num_partitions, batch_size):
+    expected = utils.get_collection_as_dataframe("INSURANCE", "INSURANCE_PREMIUM", batch_size=batch_size)
+    df = utils.get_collection_as_dataframe_parallel("INSURANCE", "INSURANCE_PREMIUM", num_partitions=num_partitions, batch_size=batch_size)
+    pd.testing.assert_frame_equal(df, expected)
+
+
+def test_parallel_read_keeps_documents_without_partition_field(collection):
+    collection.update_many({"age": {"$gte": 30}}, {"$set": {"policy_number": 1}})
+    collection.update_one({"age": 19}, {"$set": {"policy_number": 2}})
+    df = utils.get_collection_as_dataframe_parallel("INSURANCE", "INSURANCE_PREMIUM", num_partitions=2, partition_field="policy_number")
+    assert len(df) == len(DOCUMENTS)
+    pd.testing.assert_frame_equal(df.sort_values(["bmi", "children"], ignore_index=True),
+                                  get_list_dataframe(collection).sort_values(["bmi", "children"], ignore_index=True))
+
+
+def test_partition_boundaries_split_evenly(mongo_client):
+    collection = mongo_client["INSURANCE"]["NUMBERS"]
+    collection.insert_many([{"number": number} for number in range(100)])
+    assert utils.get_partition_boundaries(collection=collection, partition_field="number", num_partitions=4) == [25, 50, 75]
+
+
+def test_profile_collection(collection):
+    collection.insert_one({"age": "na", "sex": "na", "bmi": 30.0, "children": 2})
+    profile = utils.profile_collection("INSURANCE", "INSURANCE_PREMIUM", numeric_fields=["age", "bmi"], categorical_fields=["sex"])
+    assert profile["count"] == len(DOCUMENTS) + 1
+    #a missing field, null and "na" all count as missing
+    assert profile["fields"]["age"]["null_ratio"] == pytest.approx(3/8)
+    assert profile["fields"]["sex"]["null_ratio"] == pytest.approx(2/8)
+    assert profile["fields"]["age"]["min"] == 19
+    assert profile["fields"]["age"]["max"] == 46
+    assert profile["fields"]["age"]["sum"] == pytest.approx(19 + 28 + 33 + 31 + 46)
+    assert profile["fields"]["bmi"]["max"] == pytest.approx(33.8)
+    assert profile["fields"]["sex"]["distinct_values"] == ["female", "male"]
+
+
+def test_profile_collection_with_query(collection):
+    profile = utils.profile_collection("INSURANCE", "INSURANCE_PREMIUM", numeric_fields=["bmi"], categorical_fields=[],
+                                       query={"children": 0})
+    assert profile["count"] == 4
+    assert profile["fields"]["bmi"]["min"] == pytest.approx(22.7)
+
+
+def test_columnar_load_keeps_numeric_columns_memory_mapped(work_dir):
+    df = pd.DataFrame({"age": [19, 33, 45], "bmi": [27.9, 33.0, 22.7], "children": [0.0, 1.0, 3.0], "region": ["north", None, "south"]})
+    utils.save_columnar_dataframe(dir_path="columns", df=df)
+    loaded_df = utils.load_columnar_dataframe(dir_path="columns")
+    pd.testing.assert_frame_equal(loaded_df, df)
+    for column in ["age", "bmi", "children"]:
+        values = loaded_df[column].to_numpy()
+        while values.base is not None and not isinstance(values, np.memmap):
+            values = values.base
+        assert isinstance(values, np.memmap), column